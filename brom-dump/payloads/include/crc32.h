@@ -0,0 +1,27 @@
+// SPDX-License-Identifier: GPL-3.0-only
+// SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+#ifndef H_CRC32
+#define H_CRC32
+
+#include <stdint.h>
+
+// CRC32 (zlib) lookup table for one nibble at a time
+static const uint32_t crc32_nibble[16] = {
+	0x00000000, 0x1DB71064, 0x3B6E20C8, 0x26D930AC,
+	0x76DC4190, 0x6B6B51F4, 0x4DB26158, 0x5005713C,
+	0xEDB88320, 0xF00F9344, 0xD6D6A3E8, 0xCB61B38C,
+	0x9B64C2B0, 0x86D3D2D4, 0xA00AE278, 0xBDBDF21C,
+};
+
+static uint32_t crc32_update(uint32_t crc, const uint8_t* data, uint32_t len) {
+	crc = ~crc;
+	while (len--) {
+		crc ^= *data++;
+		crc = (crc >> 4) ^ crc32_nibble[crc & 0xF];
+		crc = (crc >> 4) ^ crc32_nibble[crc & 0xF];
+	}
+	return ~crc;
+}
+
+#endif // H_CRC32
@@ -10,11 +10,28 @@
 #define UART_LSR				(0x14)
 #define UART_LSR_THRE			(0b00100000)
 
+// Binary frames sent over UART, see spft-replay/src/uartdump.py
+#define FRAME_MAGIC				(0x466B744D) // "MtkF"
+#define FRAME_REGION			(0x01) // addr: region start, size: region length
+#define FRAME_DATA				(0x02) // followed by `size` bytes at addr
+#define FRAME_FILL				(0x03) // `size` bytes at addr repeat a 32-bit word
+#define FRAME_DONE				(0x04)
+
 typedef struct s_hardware {
 	volatile uint32_t* uart_thr;
 	volatile uint32_t* uart_lsr;
 } t_hardware;
 
+// Followed by the data and CRC32 of the header and the data
+typedef struct __attribute__((packed)) s_frame_header {
+	uint32_t magic;
+	uint8_t type;
+	uint8_t flags;
+	uint16_t seq;
+	uint32_t addr;
+	uint32_t size;
+} t_frame_header;
+
 void init_standalone(uint32_t uart_base);
 
 void putc_uart(uint8_t chr);
@@ -22,4 +39,8 @@ void putc_wrapper_uart(uint8_t chr);
 void print_hex_value(uint32_t val, uint8_t width);
 void print_uart(uint8_t* str);
 
+void write_uart(const uint8_t* data, uint32_t len);
+void send_frame(uint8_t type, uint32_t addr, uint32_t size,
+                const uint8_t* data, uint32_t data_len);
+
 #endif // H_STANDALONE_UTIL
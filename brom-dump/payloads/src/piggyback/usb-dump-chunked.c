@@ -0,0 +1,79 @@
+// SPDX-License-Identifier: GPL-3.0-only
+// SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+#include <stdint.h>
+#include "common.h"
+#include "crc32.h"
+#include "da-api.h"
+#include "hw-api.h"
+
+#define MAGIC_HELLO_FLAGS	0x3E4D7446
+#define MAGIC_GOODBYE		0x4D746B3C
+
+// Flags sent after MAGIC_HELLO_FLAGS
+#define HELLO_FLAG_CHUNKED	(1 << 1)
+
+// Unlike usb-dump, the host pulls the regions chunk by chunk, so it can
+// request a chunk again when it has been corrupted or lost.
+// After the HELLO the region table is sent: the number of regions and
+// their start addresses and lengths. Then the host sends commands:
+// - CMD_READ, region, offset, length: the chunk is sent back as region,
+//   offset, length, the data and CRC32 of the data. Length is 0 if the
+//   request is out of bounds.
+// - MAGIC_GOODBYE: echoed, then the payload stops.
+#define CMD_READ			0x52454144 // "READ"
+#define MAX_CHUNK_LENGTH	0x10000
+
+static const uint32_t dump_regions[3][2] = {
+	{ MEM_brom_start, MEM_brom_length },
+	{ MEM_sram_start, MEM_sram_length },
+	{ MEM_da_start, MEM_da_length },
+};
+
+static void send_chunk(uint32_t region, uint32_t offset, uint32_t length) {
+	const uint8_t* data = 0;
+
+	if (region >= ARRAY_SIZE(dump_regions) || length > MAX_CHUNK_LENGTH ||
+		offset > dump_regions[region][1] ||
+		length > dump_regions[region][1] - offset) {
+		length = 0;
+	} else {
+		data = (const uint8_t*)(dump_regions[region][0] + offset);
+	}
+
+	DA_usb_writel(region);
+	DA_usb_writel(offset);
+	DA_usb_writel(length);
+	if (length) {
+		DA_usb_write((uint8_t*)data, length);
+	}
+	DA_usb_writel(crc32_update(0, data, length));
+}
+
+void main() {
+	DA_usb_writel(MAGIC_HELLO_FLAGS);
+	DA_usb_writel(HELLO_FLAG_CHUNKED);
+
+	DA_usb_writel(ARRAY_SIZE(dump_regions));
+	for (int i = 0; i < ARRAY_SIZE(dump_regions); i++) {
+		DA_usb_writel(dump_regions[i][0]);
+		DA_usb_writel(dump_regions[i][1]);
+	}
+
+	while (1) {
+		uint32_t cmd = DA_usb_readl();
+		if (cmd == CMD_READ) {
+			uint32_t region = DA_usb_readl();
+			uint32_t offset = DA_usb_readl();
+			uint32_t length = DA_usb_readl();
+			send_chunk(region, offset, length);
+		} else if (cmd == MAGIC_GOODBYE) {
+			DA_usb_writel(MAGIC_GOODBYE);
+			break;
+		}
+	}
+
+	while (1) {
+		do_nothing();
+	}
+}
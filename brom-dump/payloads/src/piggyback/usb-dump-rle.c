@@ -0,0 +1,6 @@
+// SPDX-License-Identifier: GPL-3.0-only
+// SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+// usb-dump with run-length encoded regions, see HELLO_FLAG_RLE
+#define DUMP_RLE
+#include "usb-dump.c"
@@ -7,24 +7,74 @@
 #include "hw-api.h"
 
 #define MAGIC_HELLO			0x3E4D746B
+#define MAGIC_HELLO_FLAGS	0x3E4D7446
 #define MAGIC_GOODBYE		0x4D746B3C
 
+// Flags sent after MAGIC_HELLO_FLAGS
+#define HELLO_FLAG_RLE		(1 << 0)
+
+// Word-level run-length encoding. Every token is a 32-bit word:
+// - RLE_RUN | N is followed by one word repeated N times,
+// - N is followed by N literal words.
+// Literal words are sent straight from memory, so nothing is buffered.
+#define RLE_RUN				0x80000000
+#define RLE_MIN_RUN			256 // shorter runs don't pay for 2 more transfers
+
 static const uint32_t dump_regions[3][2] = {
 	{ MEM_brom_start, MEM_brom_length },
 	{ MEM_sram_start, MEM_sram_length },
 	{ MEM_da_start, MEM_da_length },
 };
 
+#ifdef DUMP_RLE
+static void send_literal(const uint32_t* words, uint32_t count) {
+	if (count) {
+		DA_usb_writel(count);
+		DA_usb_write((uint8_t*)words, count * 4);
+	}
+}
+
+static void send_rle(const uint32_t* words, uint32_t count) {
+	uint32_t literal = 0; // first word not sent yet
+	uint32_t i = 0;
+
+	while (i < count) {
+		uint32_t run = 1;
+		while (i + run < count && words[i + run] == words[i]) {
+			run++;
+		}
+
+		if (run >= RLE_MIN_RUN) {
+			send_literal(&words[literal], i - literal);
+			DA_usb_writel(RLE_RUN | run);
+			DA_usb_write((uint8_t*)&words[i], 4);
+			literal = i + run;
+		}
+		i += run;
+	}
+	send_literal(&words[literal], count - literal);
+}
+#endif
+
 void main() {
+#ifdef DUMP_RLE
+	DA_usb_writel(MAGIC_HELLO_FLAGS);
+	DA_usb_writel(HELLO_FLAG_RLE);
+#else
 	DA_usb_writel(MAGIC_HELLO);
-	
+#endif
+
 	for (int i = 0; i < ARRAY_SIZE(dump_regions); i++) {
 		DA_usb_writel(dump_regions[i][1]);
+#ifdef DUMP_RLE
+		send_rle((const uint32_t*)dump_regions[i][0], dump_regions[i][1] / 4);
+#else
 		DA_usb_write((uint8_t*)dump_regions[i][0], dump_regions[i][1]);
+#endif
 	}
-	
+
 	DA_usb_writel(MAGIC_GOODBYE);
-	
+
 	while (1) {
 		do_nothing();
 	}
@@ -4,8 +4,10 @@
 #include <stdint.h>
 #include "standalone-util.h"
 #include "common.h"
+#include "crc32.h"
 
 t_hardware hardware;
+static uint16_t frame_seq;
 
 void init_standalone(uint32_t uart_base) {
 	hardware.uart_thr = (volatile uint32_t*)(uart_base + UART_THR);
@@ -46,3 +48,30 @@ void print_uart(uint8_t* str) {
 		putc_wrapper_uart(*str);
 	} while (*(++str) != '\0');
 }
+
+// Raw bytes, unlike print_uart
+void write_uart(const uint8_t* data, uint32_t len) {
+	while (len--) {
+		putc_uart(*data++);
+	}
+}
+
+void send_frame(uint8_t type, uint32_t addr, uint32_t size,
+                const uint8_t* data, uint32_t data_len) {
+	t_frame_header header;
+	uint32_t crc;
+
+	header.magic = FRAME_MAGIC;
+	header.type = type;
+	header.flags = 0;
+	header.seq = frame_seq++;
+	header.addr = addr;
+	header.size = size;
+
+	crc = crc32_update(0, (uint8_t*)&header, sizeof(header));
+	crc = crc32_update(crc, data, data_len);
+
+	write_uart((uint8_t*)&header, sizeof(header));
+	write_uart(data, data_len);
+	write_uart((uint8_t*)&crc, sizeof(crc));
+}
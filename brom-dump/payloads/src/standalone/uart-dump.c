@@ -6,30 +6,49 @@
 #include "hw-api.h"
 #include "standalone-util.h"
 
+#define BLOCK_SIZE 1024
+
 static const uint32_t dump_regions[2][2] = {
 	{ MEM_brom_start, MEM_brom_length },
 	{ MEM_sram_start, MEM_sram_length },
 	// the whole DA is our code, no need to dump it here
 };
 
+// Send [addr, addr + size) as one frame, straight from memory. A block
+// repeating a single word (erased or unused memory) is sent as that word
+// only.
+static void send_block(uint32_t addr, uint32_t size) {
+	const volatile uint32_t* words = (const volatile uint32_t*)addr;
+	uint32_t i, count = size / sizeof(uint32_t);
+
+	for (i = 1; i < count; i++) {
+		if (words[i] != words[0])
+			break;
+	}
+
+	if (i >= count)
+		send_frame(FRAME_FILL, addr, size, (const uint8_t*)addr, sizeof(uint32_t));
+	else
+		send_frame(FRAME_DATA, addr, size, (const uint8_t*)addr, size);
+}
+
 void main() {
-	uint32_t i, j, offset;
-	volatile uint32_t value;
+	uint32_t i, offset, start, end;
 
 	init_standalone(HW_reg_uart0_base);
 	print_uart("\n\n");
 
+	// Binary frames instead of hex text: half the bytes on the wire, and
+	// every block is checked with CRC32 by spft-replay (-ud)
 	for (i = 0; i < ARRAY_SIZE(dump_regions); i++) {
-		print_uart("dump:");
-		for (j = 0; j < dump_regions[i][1]; j += sizeof(uint32_t)) {
-			offset = dump_regions[i][0] + j;
-			value = __builtin_bswap32(
-				*(volatile uint32_t *)offset
-			);
-			print_hex_value(value, 8);
+		start = dump_regions[i][0];
+		end = start + dump_regions[i][1];
+		send_frame(FRAME_REGION, start, dump_regions[i][1], 0, 0);
+		for (offset = start; offset < end; offset += BLOCK_SIZE) {
+			send_block(offset, end - offset < BLOCK_SIZE ? end - offset : BLOCK_SIZE);
 		}
-		print_uart("\n");
 	}
+	send_frame(FRAME_DONE, 0, 0, 0, 0);
 
 	print_uart("done :)");
 
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Differential test of the lean replay profile: replay every supported
+# platform against a fresh simulated device twice, with the verbatim SP
+# Flash Tool flow and with `-lean`, and check that both runs leave the
+# device in the same state: memory, PMIC registers, the address jumped to,
+# every memory write in order and every command other than the queries
+# the lean profile may leave out. Reports the round trips saved.
+
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.brom import BromProtocol  # noqa: E402
+from src.common import add_log_levels  # noqa: E402
+from src.manager import DeviceManager  # noqa: E402
+from src.simulator import (  # noqa: E402
+    LINK_PRESETS,
+    SimulatedDevice,
+    SimulatedTransport,
+)
+
+PLATFORMS = [
+    ("MT6252", 0x6250),
+    ("MT6573", 0x6573),
+    ("MT6577", 0x6575),
+    ("MT6580", 0x6580),
+    ("MT6582", 0x6582),
+    ("MT6589", 0x6583),
+]
+
+# Commands that don't change the device state
+QUERY_COMMANDS = {
+    0xA2,  # Legacy read16
+    0xA4,  # Legacy checksum
+    0xAF,  # Legacy read32
+    0xC6,  # Power read16
+    0xD0,  # Read16
+    0xD1,  # Read32
+    0xD8,  # Get target config
+    0xE1,  # Get ME ID
+    0xFC,  # Get HW/SW version
+    0xFD,  # Get HW code
+    0xFE,  # Get preloader version
+    0xFF,  # Get BROM version
+}
+
+
+# Replay a fresh simulated device, return its final state and the round
+# trips it took
+def run(hw_code, link, payload, lean):
+    device = SimulatedDevice(hw_code)
+    writes = []
+    write = device.memory.write
+
+    def record_write(addr, data):
+        writes.append((addr, bytes(data)))
+        write(addr, data)
+
+    device.memory.write = record_write
+
+    transport = SimulatedTransport(device, link)
+    transport.start()
+    brom = BromProtocol(transport)
+    brom.handshake()
+
+    # RAM size detection writes random patterns
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as output_dir:
+        manager = DeviceManager(brom, output_dir, lean=lean)
+        manager.replay(payload, simple_mode=False, skip_remaining_data=False)
+    transport.stop()
+
+    state = {
+        "memory": {
+            page: bytes(data) for page, data in sorted(device.memory.pages.items())
+        },
+        "pmic": dict(device.pmic),
+        "jumped to": device.jumped_to,
+        "writes": writes,
+        "commands": [cmd for cmd in device.executed if cmd not in QUERY_COMMANDS],
+    }
+    return state, transport.round_trips, len(device.executed)
+
+
+def compare(name, hw_code, link, payload):
+    verbatim, verbatim_trips, verbatim_commands = run(hw_code, link, payload, False)
+    lean, lean_trips, lean_commands = run(hw_code, link, payload, True)
+    different = [key for key in verbatim if verbatim[key] != lean[key]]
+    saved = verbatim_trips - lean_trips
+    print(
+        f"{name:<8} {verbatim_commands:>9} {lean_commands:>6} "
+        f"{verbatim_trips:>9} {lean_trips:>6} {saved:>6} "
+        f"{saved / verbatim_trips * 100:>6.1f}%  "
+        + (f"DIFFERENT: {', '.join(different)}" if different else "identical")
+    )
+    return not different
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="lean-replay",
+        description="Check the lean replay profile against the verbatim flow",
+    )
+    parser.add_argument(
+        "--link",
+        choices=LINK_PRESETS.keys(),
+        default="high-speed",
+        help="USB link model of the simulated devices",
+    )
+    parser.add_argument(
+        "--payload-size",
+        type=int,
+        default=128 * 1024,
+        help="Size of the payload pushed to the device, in bytes",
+    )
+    parser.add_argument(
+        "--platform",
+        dest="platforms",
+        action="append",
+        choices=[name for name, _ in PLATFORMS],
+        help="Only check this platform (can be repeated)",
+    )
+    args = parser.parse_args()
+
+    # Simulated devices trigger the same warnings as real ones, hide them
+    add_log_levels()
+    logging.basicConfig(level=logging.ERROR, format="<%(levelname)s> %(message)s")
+
+    payload = bytes(range(256)) * (args.payload_size // 256)
+    print(
+        f"{'':<8} {'commands':>16} {'round trips':>16} {'saved':>14}\n"
+        f"{'platform':<8} {'verbatim':>9} {'lean':>6} {'verbatim':>9} {'lean':>6} "
+        f"{'trips':>6} {'':>7}  final state"
+    )
+    failures = 0
+    for name, hw_code in PLATFORMS:
+        if args.platforms and name not in args.platforms:
+            continue
+        try:
+            if not compare(name, hw_code, args.link, payload):
+                failures += 1
+        except Exception as e:
+            # e.g. MT6252 needs the 1st-stage DA to be built
+            logging.error(f"{name}: {e}")
+            failures += 1
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Measure the host-side cost of the legacy DA upload (MT6252) for
+# different payload sizes. The payload is memory-mapped from a temporary
+# file and sent to a transport that drops the packets, so only the byte
+# swap, the checksum and the packet slicing are measured.
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.brom import BromProtocol  # noqa: E402
+from src.common import add_log_levels, map_file, to_bytes  # noqa: E402
+from src.simulator import da_checksum  # noqa: E402
+from src.transport import AbstractTransport  # noqa: E402
+
+PACKET_SIZE = 1024  # same as UsbTransport.write
+PAYLOAD_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+# Accepts every command and drops the data, slicing it into packets like
+# UsbTransport does
+class NullTransport(AbstractTransport):
+    def __init__(self):
+        self.bytes_out = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read(self, size=1, timeout=-1):
+        return bytes(size)
+
+    def write(self, data, size=1, timeout=-1, progress=True):
+        if isinstance(data, int):
+            data = to_bytes(data, size)
+        data = memoryview(data).cast("B")
+        for off_start in range(0, len(data), PACKET_SIZE):
+            self.bytes_out += len(bytes(data[off_start : off_start + PACKET_SIZE]))
+
+    def echo(self, words, size=1):
+        self.write(words, size)
+
+
+def run_streaming(payload):
+    transport = NullTransport()
+    BromProtocol(transport).send_da_legacy(0x08100000, payload)
+    return transport.bytes_out
+
+
+# The upload as it was before streaming: the payload is read into memory,
+# swapped in a Python loop and sliced with copies, then the checksum is
+# computed in a second pass.
+def run_legacy(path):
+    with open(path, "rb") as fis:
+        da = fis.read()
+    da = bytearray(da[: len(da) // 2 * 2])
+    for i in range(0, len(da) - 1, 2):
+        da[i], da[i + 1] = da[i + 1], da[i]
+    da = bytes(da)
+    bytes_out = 0
+    for off_start in range(0, len(da), PACKET_SIZE):
+        bytes_out += len(da[off_start : off_start + PACKET_SIZE])
+    da_checksum(da)
+    return bytes_out
+
+
+def measure(runner, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        runner(arg)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="legacy-da", description="Benchmark the legacy DA upload"
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Also measure the old pure-Python swap and checksum",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Best of N runs (default: 3)"
+    )
+    args = parser.parse_args()
+
+    add_log_levels()
+    header = ["streaming MB/s", "streaming ms"]
+    if args.legacy:
+        header += ["legacy MB/s", "legacy ms", "speedup"]
+    print(f"{'payload size':>12} " + " ".join(f"{h:>16}" for h in header))
+
+    for size in PAYLOAD_SIZES:
+        with tempfile.NamedTemporaryFile() as fos:
+            fos.write(os.urandom(size))
+            fos.flush()
+            payload = map_file(fos.name)
+            try:
+                elapsed = measure(run_streaming, payload, args.repeat)
+                costs = [size / elapsed / 1e6, elapsed * 1e3]
+                if args.legacy:
+                    legacy = measure(run_legacy, fos.name, args.repeat)
+                    costs += [size / legacy / 1e6, legacy * 1e3, legacy / elapsed]
+            finally:
+                payload.close()
+        print(f"{size:>12} " + " ".join(f"{c:>16.2f}" for c in costs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Run `identify` and `replay` for every supported platform against the
+# simulated device and report per-stage costs: round trips, bytes moved,
+# host CPU time and the wall time a real device would need (host CPU time
+# plus the time modeled for the USB link). Results can be saved as JSON
+# and two saved runs can be compared to catch regressions. With --known
+# the devices are replayed once before measuring, so the replays skip
+# identification like they do for boards in the fingerprint cache.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.brom import BromProtocol  # noqa: E402
+from src.common import add_log_levels  # noqa: E402
+from src.fingerprint import FingerprintCache  # noqa: E402
+from src.manager import DeviceManager  # noqa: E402
+from src.simulator import (  # noqa: E402
+    LINK_PRESETS,
+    SimulatedDevice,
+    SimulatedTransport,
+)
+
+PLATFORMS = [
+    ("MT6252", 0x6250),
+    ("MT6573", 0x6573),
+    ("MT6577", 0x6575),
+    ("MT6580", 0x6580),
+    ("MT6582", 0x6582),
+    ("MT6589", 0x6583),
+]
+
+COUNTERS = ["round_trips", "transfers", "bytes_out", "bytes_in"]
+TIMERS = ["cpu", "link", "wall"]
+
+
+# Stage observer that snapshots transport counters and the process CPU
+# time when a stage starts and stores the difference when it finishes.
+class StageRecorder:
+    def __init__(self, transport):
+        self.transport = transport
+        self.stages = {}
+        self.started = {}
+
+    def snapshot(self):
+        values = {c: getattr(self.transport, c) for c in COUNTERS}
+        values["cpu"] = time.process_time()
+        values["link"] = self.transport.modeled_time
+        return values
+
+    def stage_started(self, name):
+        self.started[name] = self.snapshot()
+
+    def stage_finished(self, name):
+        started = self.started.pop(name)
+        finished = self.snapshot()
+        result = {key: finished[key] - started[key] for key in finished}
+        result["wall"] = result["cpu"] + result["link"]
+        self.stages[name] = result
+
+
+def run_once(hw_code, link, payload, mode, fingerprints=None):
+    transport = SimulatedTransport(SimulatedDevice(hw_code), link)
+    transport.start()
+    brom = BromProtocol(transport)
+    brom.handshake()
+
+    manager = DeviceManager(brom, fingerprints=fingerprints)
+    recorder = StageRecorder(transport)
+    manager.add_observer(recorder)
+    if mode == "identify":
+        manager.identify()
+    else:
+        manager.replay(payload, simple_mode=False, skip_remaining_data=False)
+    transport.stop()
+    return recorder.stages
+
+
+# Counters are deterministic, timers are noisy: keep the best of `repeat`
+def run(hw_code, link, payload, mode, repeat, fingerprints=None):
+    best = None
+    for _ in range(repeat):
+        stages = run_once(hw_code, link, payload, mode, fingerprints)
+        if best is None:
+            best = stages
+            continue
+        for name, result in stages.items():
+            for timer in TIMERS:
+                best[name][timer] = min(best[name][timer], result[timer])
+    return best
+
+
+def total(stages):
+    keys = COUNTERS + TIMERS
+    return {key: sum(stage[key] for stage in stages.values()) for key in keys}
+
+
+def benchmark(args):
+    payload = bytes(range(256)) * (args.payload_size // 256)
+    results = {
+        "link": args.link,
+        "payload_size": len(payload),
+        "repeat": args.repeat,
+        "known": args.known,
+        "platforms": {},
+    }
+    cache_dir = tempfile.TemporaryDirectory()
+    fingerprints = None
+    if args.known:
+        path = os.path.join(cache_dir.name, "fingerprints.json")
+        fingerprints = FingerprintCache(path)
+    for name, hw_code in PLATFORMS:
+        if args.platforms and name not in args.platforms:
+            continue
+        try:
+            identify = run(hw_code, args.link, payload, "identify", args.repeat)
+            if fingerprints:
+                run_once(hw_code, args.link, payload, "replay", fingerprints)
+            stages = run(
+                hw_code, args.link, payload, "replay", args.repeat, fingerprints
+            )
+            results["platforms"][name] = {
+                "identify": identify["identify"],
+                "stages": stages,
+                "total": total(stages),
+            }
+        except Exception as e:
+            # e.g. MT6252 needs the 1st-stage DA to be built
+            logging.error(f"{name}: {e}")
+            results["platforms"][name] = {"error": str(e)}
+    cache_dir.cleanup()
+    return results
+
+
+def format_row(name, result):
+    return (
+        f"{name:<22} {result['round_trips']:>7} {result['transfers']:>7} "
+        f"{result['bytes_out']:>10} {result['bytes_in']:>10} "
+        f"{result['cpu'] * 1000:>9.2f} {result['link'] * 1000:>9.2f} "
+        f"{result['wall'] * 1000:>9.2f}"
+    )
+
+
+def print_results(results):
+    print(
+        f"Link: {results['link']}, payload: {results['payload_size']} bytes, "
+        f"best of {results['repeat']}"
+        + (", known devices" if results.get("known") else "")
+    )
+    for name, platform in results["platforms"].items():
+        print()
+        if "error" in platform:
+            print(f"{name}: skipped ({platform['error']})")
+            continue
+        print(
+            f"{name:<22} {'trips':>7} {'xfers':>7} {'out, B':>10} {'in, B':>10} "
+            f"{'cpu, ms':>9} {'link, ms':>9} {'wall, ms':>9}"
+        )
+        print(format_row("  identify", platform["identify"]))
+        for stage, result in platform["stages"].items():
+            print(format_row(f"  {stage}", result))
+        print(format_row("  replay total", platform["total"]))
+
+
+# Compare two saved runs. Counters must not grow at all, timers are
+# allowed to grow by `threshold` percent or by `min_delta` seconds,
+# whichever is larger, to tolerate measurement noise.
+def compare(old_path, new_path, threshold, min_delta):
+    with open(old_path) as fis:
+        old = json.load(fis)
+    with open(new_path) as fis:
+        new = json.load(fis)
+    if (old["link"], old["payload_size"]) != (new["link"], new["payload_size"]):
+        logging.warning("The runs used different link models or payload sizes")
+    if old.get("known") != new.get("known"):
+        logging.warning("Only one of the runs used known devices")
+
+    regressions = 0
+    for name, new_platform in new["platforms"].items():
+        old_platform = old["platforms"].get(name)
+        if not old_platform or "error" in old_platform or "error" in new_platform:
+            continue
+        old_stages = dict(old_platform["stages"], identify=old_platform["identify"])
+        new_stages = dict(new_platform["stages"], identify=new_platform["identify"])
+        for stage, new_result in new_stages.items():
+            old_result = old_stages.get(stage)
+            if not old_result:
+                continue
+            for key in COUNTERS + TIMERS:
+                before, after = old_result[key], new_result[key]
+                noise = 0
+                if key in TIMERS:
+                    noise = max(before * threshold / 100, min_delta)
+                change = (after - before) / before * 100 if before else 0
+                if after > before + noise:
+                    regressions += 1
+                    mark = "REGRESSION"
+                elif after < before - noise:
+                    mark = "improved"
+                else:
+                    continue
+                print(
+                    f"{mark:<10} {name} {stage} {key}: "
+                    f"{before:.6g} -> {after:.6g} ({change:+.1f}%)"
+                )
+
+    print(f"{regressions} regression(s) found")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="replay", description="Benchmark replays against simulated devices"
+    )
+    parser.add_argument(
+        "--link",
+        choices=LINK_PRESETS.keys(),
+        default="high-speed",
+        help="USB link model used to estimate the wall time",
+    )
+    parser.add_argument(
+        "--payload-size",
+        type=int,
+        default=128 * 1024,
+        help="Size of the payload pushed to the device, in bytes",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Run each platform this many times and keep the best timings",
+    )
+    parser.add_argument(
+        "--platform",
+        dest="platforms",
+        action="append",
+        choices=[name for name, _ in PLATFORMS],
+        help="Only benchmark this platform (can be repeated)",
+    )
+    parser.add_argument(
+        "--known",
+        action="store_true",
+        help="Replay every device once before measuring, so that it is known "
+        "from the fingerprint cache",
+    )
+    parser.add_argument("-o", dest="output", help="Save results to a JSON file")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Compare two JSON files saved with -o instead of running",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="Allowed growth of timings before it's a regression, in percent",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.5,
+        help="Ignore timing changes smaller than this, in milliseconds",
+    )
+    args = parser.parse_args()
+
+    # Simulated devices trigger the same warnings as real ones, hide them
+    add_log_levels()
+    logging.basicConfig(level=logging.ERROR, format="<%(levelname)s> %(message)s")
+
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold, args.min_delta / 1000))
+
+    results = benchmark(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as fos:
+            json.dump(results, fos, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Measure the per-byte cost of the USB receive path for different read
+# sizes. The device is emulated by a source that hands out data in
+# bulk transfers so only the host-side buffering is measured.
+
+import argparse
+import array
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.buffer import RxBuffer  # noqa: E402
+
+PACKET_SIZE = 512
+READ_SIZES = [4, 64, 1024, 16 * 1024, 256 * 1024, 4 * 1024 * 1024, 64 * 1024 * 1024]
+MIN_TOTAL = 4 * 1024 * 1024  # Read at least this many bytes per measurement
+MIN_READS = 4  # Let big reads reach the steady state after the buffer grows
+
+STREAM = memoryview(bytes(RxBuffer.MAX_FILL_SIZE))
+
+
+def bulk_source(max_size):
+    return STREAM[:max_size]
+
+
+# Same sequence of calls as `UsbTransport.read_view`
+def run_rxbuffer(read_size, total):
+    rxbuffer = RxBuffer()
+    for _ in range(total // read_size):
+        if len(rxbuffer) < read_size:
+            rxbuffer.fill(read_size, bulk_source, PACKET_SIZE)
+        rxbuffer.take_view(read_size)
+
+
+# The receive path as it was before RxBuffer: one packet per transfer
+# and the whole buffer rebuilt after every read.
+def run_legacy(read_size, total):
+    rxbuffer = array.array("B")
+    for _ in range(total // read_size):
+        while len(rxbuffer) < read_size:
+            rxbuffer.extend(STREAM[:PACKET_SIZE])
+        result = rxbuffer[:read_size]
+        rxbuffer = rxbuffer[read_size:]
+        bytes(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="rx-buffer", description="Benchmark the USB receive buffer"
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Also measure the old array re-slicing implementation",
+    )
+    args = parser.parse_args()
+
+    runners = [("RxBuffer", run_rxbuffer)]
+    if args.legacy:
+        runners.append(("legacy", run_legacy))
+
+    header = [f"{n} {unit}" for n, _ in runners for unit in ["ns/B", "us/read"]]
+    print(f"{'read size':>12} " + " ".join(f"{h:>18}" for h in header))
+    for read_size in READ_SIZES:
+        total = max(read_size * MIN_READS, MIN_TOTAL)
+        costs = []
+        for _, runner in runners:
+            started = time.perf_counter()
+            runner(read_size, total)
+            elapsed = time.perf_counter() - started
+            costs.append(elapsed / total * 1e9)
+            costs.append(elapsed / (total // read_size) * 1e6)
+        print(f"{read_size:>12} " + " ".join(f"{c:>18.3f}" for c in costs))
+
+
+if __name__ == "__main__":
+    main()
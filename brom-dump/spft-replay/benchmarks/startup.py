@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Measure how fast spft-replay gets going: every scenario starts a fresh
+# interpreter running spft-replay.py and reports the time until the first
+# handshake has completed (taken when its log line arrives) and until the
+# process exits. A separate run with `python3 -X importtime` sums up the
+# time spent importing modules and lists the heavy ones that were loaded.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SPFT_REPLAY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "spft-replay.py"
+)
+
+# Modules only some modes need
+HEAVY_MODULES = ["asyncio", "usb", "usb1", "multiprocessing", "socket", "src.platform"]
+
+
+def scenarios(payload, output_dir):
+    return [
+        ("help", ["-h"]),
+        ("identify MT6589", ["-sim", "6583", "-i", "-o", output_dir]),
+        ("replay MT6252", ["-sim", "6250", "-p", payload, "-pr", "-o", output_dir]),
+    ]
+
+
+# Seconds until the handshake and until the exit of one run
+def run(args):
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, SPFT_REPLAY] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    handshake = None
+    for line in process.stderr:
+        if handshake is None and "Arrival-to-handshake" in line:
+            handshake = time.perf_counter() - started
+    process.wait()
+    return handshake, time.perf_counter() - started
+
+
+# Total import time in seconds and the heavy modules imported
+def import_profile(args):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", SPFT_REPLAY] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    total = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, _, name = line[len("import time:") :].split("|")
+        total += int(self_time)
+        modules.add(name.strip())
+    return total / 1e6, [name for name in HEAVY_MODULES if name in modules]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="startup", description="Benchmark the startup of spft-replay"
+    )
+    parser.add_argument(
+        "-n",
+        dest="runs",
+        type=int,
+        default=10,
+        help="Runs per scenario, the median is reported (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        payload = os.path.join(tmp_dir, "payload.bin")
+        with open(payload, "wb") as fos:
+            fos.write(bytes(4096))
+
+        print(
+            f"{'scenario':<18} {'imports ms':>10} {'handshake ms':>12} "
+            f"{'total ms':>10}  heavy modules"
+        )
+        for name, scenario in scenarios(payload, os.path.join(tmp_dir, "out")):
+            imports, heavy = import_profile(scenario)
+            runs = [run(scenario) for _ in range(args.runs)]
+            handshakes = [handshake for handshake, _ in runs if handshake]
+            handshake = (
+                f"{statistics.median(handshakes) * 1e3:.1f}" if handshakes else "-"
+            )
+            total = statistics.median(total for _, total in runs)
+            print(
+                f"{name:<18} {imports * 1e3:>10.1f} {handshake:>12} "
+                f"{total * 1e3:>10.1f}  {', '.join(heavy) or '-'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Compare the hex text output of the old uart-dump payload with binary
+# frames. The dump of the BROM and SRAM of a simulated MT6252 is encoded
+# both ways, the time a 115200-baud link needs for each is calculated
+# (10 bits per byte with 8N1), and the framed stream is received through
+# a pseudo-terminal by the streaming decoder of spft-replay.
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.common import add_log_levels  # noqa: E402
+from src.uart import UartTransport  # noqa: E402
+from src.uartdump import encode_dump, receive_uart_dump  # noqa: E402
+
+BAUDRATE = 115200
+
+
+# Regions as dumped by uart-dump on MT6252: code-like BROM contents and
+# SRAM that is partly used and partly erased
+def make_regions():
+    sram = os.urandom(0x4000) + bytes(0x6000) + b"\xFF" * 0x2000
+    return [(0x48000000, os.urandom(0x8000)), (0x40000000, sram)]
+
+
+# Output of the hex version of uart-dump, see print_hex_value
+def encode_hex(regions):
+    lines = [b"\r\n\r\n"]
+    for _, data in regions:
+        words = [data[i : i + 4].hex().upper() for i in range(0, len(data), 4)]
+        lines.append(b"dump:" + "".join(words).encode() + b"\r\n")
+    lines.append(b"done :)")
+    return b"".join(lines)
+
+
+def receive_through_pty(stream, output_dir):
+    master, slave = os.openpty()
+    transport = UartTransport(os.ttyname(slave))
+    transport.start()
+
+    def send():
+        view = memoryview(stream)
+        while view:
+            view = view[os.write(master, view[:4096]) :]
+
+    sender = threading.Thread(target=send, daemon=True)
+    started = time.perf_counter()
+    sender.start()
+    dumps = receive_uart_dump(transport, output_dir, idle_timeout=2)
+    elapsed = time.perf_counter() - started
+    sender.join()
+    transport.stop()
+    os.close(master)
+    os.close(slave)
+    return dumps, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="uart-dump", description="Benchmark framed UART dumps"
+    )
+    parser.parse_args()
+
+    add_log_levels()
+    regions = make_regions()
+    size = sum(len(data) for _, data in regions)
+    text = encode_hex(regions)
+    framed = encode_dump(regions)
+
+    print(f"{'format':>12} {'bytes':>12} {'seconds':>12} {'relative':>12}")
+    for name, stream in (("hex text", text), ("framed", framed)):
+        seconds = len(stream) * 10 / BAUDRATE
+        relative = len(stream) / len(text)
+        print(f"{name:>12} {len(stream):>12} {seconds:>12.1f} {relative:>12.2f}")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        dumps, elapsed = receive_through_pty(framed, output_dir)
+        intact = [
+            open(dump.path, "rb").read() == data
+            for dump, (_, data) in zip(dumps, regions)
+        ]
+    print()
+    print(
+        f"Decoded {size} bytes in {len(dumps)} regions through a pty in "
+        f"{elapsed * 1e3:.1f} ms ({size / elapsed / 1e6:.1f} MB/s), "
+        f"{'intact' if all(intact) and len(intact) == len(regions) else 'CORRUPT'}"
+    )
+
+
+if __name__ == "__main__":
+    main()
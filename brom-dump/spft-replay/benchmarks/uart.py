@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Measure UartTransport against a simulated device served on a
+# pseudo-terminal, so no serial hardware is needed. Reports the receive
+# throughput for different read sizes, with and without buffering, and
+# the time `identify` takes on every platform. With --baud the replies
+# are paced like on a real link at that baudrate.
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.brom import BromProtocol  # noqa: E402
+from src.common import add_log_levels  # noqa: E402
+from src.manager import DeviceManager  # noqa: E402
+from src.simulator import PtyDevice, SimulatedDevice  # noqa: E402
+from src.uart import UartTransport  # noqa: E402
+
+READ_SIZES = [4, 64, 1024, 16 * 1024]
+TOTAL = 1024 * 1024
+PLATFORMS = [0x6250, 0x6573, 0x6575, 0x6580, 0x6582, 0x6583]
+
+
+# Read `total` bytes emitted by the device `read_size` bytes at a time
+def run_reads(read_size, total, baudrate, realtime, buffered):
+    device = SimulatedDevice(0x6583)
+    pty_device = PtyDevice(device, realtime)
+    pty_device.start()
+    transport = UartTransport(pty_device.port, baudrate)
+    transport.start()  # flushes the port, send the data after that
+    device.emit(bytes(total))
+    saved_read_size = UartTransport.READ_SIZE
+    if not buffered:
+        UartTransport.READ_SIZE = 1  # one system call per requested read
+    try:
+        started = time.perf_counter()
+        for _ in range(total // read_size):
+            transport.read_view(read_size)
+        return time.perf_counter() - started
+    finally:
+        UartTransport.READ_SIZE = saved_read_size
+        transport.stop()
+        pty_device.stop()
+
+
+def run_identify(hw_code, baudrate, realtime):
+    pty_device = PtyDevice(SimulatedDevice(hw_code), realtime)
+    pty_device.start()
+    transport = UartTransport(pty_device.port, baudrate)
+    transport.start()
+    try:
+        brom = BromProtocol(transport)
+        started = time.perf_counter()
+        brom.handshake()
+        DeviceManager(brom).identify()
+        return time.perf_counter() - started
+    finally:
+        transport.stop()
+        pty_device.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="uart", description="Benchmark the UART transport over a pty"
+    )
+    parser.add_argument(
+        "--baud",
+        type=int,
+        help="Pace the simulated device like a link at this baudrate",
+    )
+    parser.add_argument(
+        "--total",
+        type=int,
+        default=TOTAL,
+        help=f"Bytes received per measurement (default: {TOTAL})",
+    )
+    args = parser.parse_args()
+
+    add_log_levels()
+    baudrate = args.baud or UartTransport.BROM_BAUDRATE
+    realtime = bool(args.baud)
+
+    header = ["buffered MB/s", "unbuffered MB/s"]
+    print(f"{'read size':>12} " + " ".join(f"{h:>16}" for h in header))
+    for read_size in READ_SIZES:
+        costs = [
+            args.total / run_reads(read_size, args.total, baudrate, realtime, b) / 1e6
+            for b in (True, False)
+        ]
+        print(f"{read_size:>12} " + " ".join(f"{c:>16.2f}" for c in costs))
+
+    print()
+    print(f"{'platform':>12} {'identify ms':>16}")
+    for hw_code in PLATFORMS:
+        elapsed = run_identify(hw_code, baudrate, realtime)
+        print(f"{hw_code:>12X} {elapsed * 1e3:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Compare the dump sent by usb-dump with the run-length encoded one of
+# usb-dump-rle and the one pulled chunk by chunk from usb-dump-chunked.
+# A simulated MT6582 with code-like BROM contents and partly used SRAM
+# and DA memory is replayed and dumped every way, and the bytes received
+# and the time modeled for the USB link are reported. The link is modeled
+# per transfer: every token and every literal costs usb-dump-rle a call
+# of DA_usb_write and the host a read.
+
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.brom import BromProtocol  # noqa: E402
+from src.common import add_log_levels  # noqa: E402
+from src.manager import DeviceManager  # noqa: E402
+from src.receiver import HELLO_FLAG_CHUNKED, HELLO_FLAG_RLE  # noqa: E402
+from src.simulator import (  # noqa: E402
+    LINK_PRESETS,
+    SimulatedDevice,
+    SimulatedTransport,
+)
+
+HW_CODE = 0x6582
+PAYLOAD_SIZE = 0x6000
+
+
+# Code is dense, but functions are padded and tables have zero gaps
+def make_code(size):
+    code = bytearray()
+    while len(code) < size:
+        code += random.randbytes(0x200) + bytes(0x40)
+    return bytes(code[:size])
+
+
+def make_device(flags):
+    random.seed(0)  # same memory for both dumps
+    device = SimulatedDevice(HW_CODE, dump_flags=flags)
+    brom, sram, _ = device.profile["dump_regions"]
+    device.memory.write(brom[0], make_code(brom[1]))
+    # stack and variables at both ends of SRAM, the rest is unused
+    device.memory.write(sram[0], random.randbytes(0x1000))
+    device.memory.write(sram[0] + sram[1] - 0x800, random.randbytes(0x800))
+    return device
+
+
+def run(flags, link, payload, output_dir):
+    transport = SimulatedTransport(make_device(flags), link)
+    transport.start()
+    brom = BromProtocol(transport)
+    brom.handshake()
+    manager = DeviceManager(brom, output_dir)
+    manager.replay(payload, simple_mode=False, skip_remaining_data=False)
+
+    bytes_in, link_time = transport.bytes_in, transport.modeled_time
+    cpu = time.process_time()
+    dumps = manager.receive_data()
+    cpu = time.process_time() - cpu
+    transport.stop()
+    contents = [open(dump.path, "rb").read() for dump in dumps]
+    return {
+        "bytes_in": transport.bytes_in - bytes_in,
+        "link": transport.modeled_time - link_time,
+        "cpu": cpu,
+        "contents": contents,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="usb-dump", description="Benchmark run-length encoded USB dumps"
+    )
+    parser.add_argument(
+        "--link",
+        choices=LINK_PRESETS.keys(),
+        default="full-speed",
+        help="Link model of the simulated transport (default: full-speed)",
+    )
+    args = parser.parse_args()
+
+    add_log_levels()
+    logging.disable(logging.WARNING)
+    payload = make_code(PAYLOAD_SIZE)
+
+    print(f"Link: {args.link}")
+    print(f"{'dump':>8} {'in, B':>10} {'link, ms':>10} {'cpu, ms':>10}")
+    results = {}
+    variants = (("raw", 0), ("rle", HELLO_FLAG_RLE), ("chunked", HELLO_FLAG_CHUNKED))
+    for name, flags in variants:
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = results[name] = run(flags, args.link, payload, output_dir)
+        print(
+            f"{name:>8} {result['bytes_in']:>10} {result['link'] * 1e3:>10.2f} "
+            f"{result['cpu'] * 1e3:>10.2f}"
+        )
+
+    ratio = results["rle"]["bytes_in"] / results["raw"]["bytes_in"]
+    same = all(r["contents"] == results["raw"]["contents"] for r in results.values())
+    print()
+    print(f"RLE dump is {ratio:.0%} of the raw one, {'same' if same else 'DIFFERENT'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+# Write a memory image to the SRAM of a simulated MT6582 with
+# write_memory and word by word with write32, and report the round trips,
+# transfers and the time modeled for the USB link. Then write into its
+# BROM, which rejects the command, with write_memory and with a pipelined
+# write32, and check that no word has been sent after the rejection and
+# that the device still replies to commands.
+
+import argparse
+import logging
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.brom import BromProtocol  # noqa: E402
+from src.common import add_log_levels  # noqa: E402
+from src.simulator import (  # noqa: E402
+    LINK_PRESETS,
+    SimulatedDevice,
+    SimulatedTransport,
+)
+
+HW_CODE = 0x6582
+SRAM_BASE = 0x100000
+BROM_BASE = 0x00000000
+WRITE_STATUS = 0x0001
+
+
+def connect(link):
+    device = SimulatedDevice(HW_CODE)
+    transport = SimulatedTransport(device, link)
+    transport.start()
+    brom = BromProtocol(transport)
+    brom.handshake()
+    return device, transport, brom
+
+
+def measure(name, link, write):
+    device, transport, brom = connect(link)
+    before = transport.round_trips, transport.transfers, transport.modeled_time
+    write(brom)
+    round_trips = transport.round_trips - before[0]
+    transfers = transport.transfers - before[1]
+    modeled = transport.modeled_time - before[2]
+    print(f"{name:<14} {round_trips:>7} {transfers:>7} {modeled * 1000:>10.2f}")
+    return device
+
+
+def write_pipelined(brom, addr, words):
+    with brom.pipeline() as pipeline:
+        pipeline.write32(addr, words, WRITE_STATUS)
+
+
+def check_rejected(name, link, write):
+    device, transport, brom = connect(link)
+    bytes_out = transport.bytes_out
+    try:
+        write(brom)
+    except RuntimeError as e:
+        logging.info(f"Rejected as expected: {e}")
+    else:
+        print(f"{name}: FAILED, the write has not been rejected")
+        return False
+    # The header only: command, address and amount of words
+    sent = transport.bytes_out - bytes_out
+    in_sync = brom.get_hw_code() == HW_CODE
+    ok = sent == 9 and in_sync
+    print(
+        f"{name}: {sent} bytes sent, "
+        f"device {'in sync' if in_sync else 'out of sync'}: "
+        f"{'ok' if ok else 'FAILED'}"
+    )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="write-memory", description="Benchmark BROM memory writes"
+    )
+    parser.add_argument(
+        "--link",
+        choices=LINK_PRESETS.keys(),
+        default="high-speed",
+        help="USB link model used to estimate the wall time",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=8 * 1024,
+        help="Size of the memory image, in bytes",
+    )
+    args = parser.parse_args()
+
+    # Simulated devices trigger the same warnings as real ones, hide them
+    add_log_levels()
+    logging.basicConfig(level=logging.ERROR, format="<%(levelname)s> %(message)s")
+
+    random.seed(0)
+    image = random.randbytes(args.size // 4 * 4)
+    words = [
+        int.from_bytes(image[i : i + 4], "little") for i in range(0, len(image), 4)
+    ]
+
+    print(f"{'':<14} {'trips':>7} {'xfers':>7} {'link, ms':>10}")
+    for name, write in (
+        (
+            "write_memory",
+            lambda brom: brom.write_memory(SRAM_BASE, image, 32, WRITE_STATUS),
+        ),
+        (
+            "write32",
+            lambda brom: [
+                brom.write32(SRAM_BASE + i * 4, word, WRITE_STATUS)
+                for i, word in enumerate(words)
+            ],
+        ),
+    ):
+        device = measure(name, args.link, write)
+        if device.memory.read(SRAM_BASE, len(image)) != image:
+            print(f"{name}: the image has not been written correctly")
+            sys.exit(1)
+    print()
+    ok = check_rejected(
+        "Rejected write",
+        args.link,
+        lambda brom: brom.write_memory(
+            BROM_BASE, image, expected_response=WRITE_STATUS
+        ),
+    )
+    # The words are BROM commands, they must not be run
+    ok &= check_rejected(
+        "Rejected pipelined write",
+        args.link,
+        lambda brom: write_pipelined(brom, BROM_BASE, [0xD1, 0x12345678, 1]),
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
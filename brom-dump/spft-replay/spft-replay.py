@@ -4,16 +4,30 @@
 
 import argparse
 import logging
-from functools import partial, partialmethod
+import os
+import sys
+import time
 
 from src.brom import BromProtocol
-from src.common import as_0x
+from src.capture import PcapngCapture
+from src.common import (
+    LOG_LEVEL_BROM_CMD,
+    LOG_LEVEL_BROM_IO,
+    add_log_levels,
+    as_0x,
+    map_file,
+)
+from src.discovery import find_brom_devices, usb_device_path
+from src.fingerprint import FingerprintCache
 from src.manager import DeviceManager
-from src.transport import UsbTransport
-
-LOG_LEVEL_REPLAY = logging.INFO + 1
-LOG_LEVEL_BROM_CMD = logging.INFO - 1
-LOG_LEVEL_BROM_IO = logging.DEBUG - 1
+from src.metrics import accumulate_metrics
+from src.orchestrator import make_job, run_sessions
+from src.payload_cache import cached_payload
+from src.simulator import LINK_PRESETS, PtyDevice, SimulatedDevice, SimulatedTransport
+from src.trace import Tracer
+from src.transport import AsyncUsbTransport, UsbTransport
+from src.uart import UartTransport
+from src.uartdump import receive_uart_dump
 
 
 def main():
@@ -40,6 +54,15 @@ to implement crashing Preloader for old platforms.
         help="Payload mode: replay SP Flash Tool traffic for a device "
         "then push PAYLOAD and jump to it",
     )
+    mode.add_argument(
+        "-pn",
+        dest="mode_payload_name",
+        metavar="NAME",
+        action="store",
+        help="Payload mode with a piggyback payload built in the payloads "
+        "directory, e.g. usb-dump. The payload for the detected SoC is taken "
+        "from the payload cache",
+    )
     mode.add_argument(
         "-s",
         dest="mode_simple_payload",
@@ -48,6 +71,14 @@ to implement crashing Preloader for old platforms.
         help="Simple payload mode: just disable the watchdog then push "
         "PAYLOAD to device and jump to it",
     )
+    mode.add_argument(
+        "-daemon",
+        dest="daemon_socket",
+        metavar="SOCKET",
+        action="store",
+        help="Daemon mode: keep running and accept jobs from clients started "
+        "with -connect SOCKET",
+    )
 
     parser.add_argument(
         "-sr",
@@ -75,6 +106,16 @@ to implement crashing Preloader for old platforms.
         "after jumping to payload (4 bytes at a time).",
     )
 
+    recv.add_argument(
+        "-ud",
+        dest="mode_uart_dump",
+        metavar="PORT",
+        help="[Payload mode only] Receive the framed dump of a standalone "
+        "payload (e.g. uart-dump) from the serial port PORT and save the "
+        "regions to files with sequential names. The port is opened before "
+        "the payload starts, at the rate given by -baud",
+    )
+
     dbg_parser = parser.add_mutually_exclusive_group()
     dbg_parser.add_argument(
         "-v",
@@ -90,47 +131,238 @@ to implement crashing Preloader for old platforms.
         const=LOG_LEVEL_BROM_IO,
         help="Super verbose: also print all read/write operations",
     )
+    parser.add_argument(
+        "-c",
+        dest="capture_path",
+        metavar="CAPTURE",
+        action="store",
+        help="Save raw USB traffic to CAPTURE in pcapng format. The file "
+        "opens in Wireshark like a usbmon capture.",
+    )
+    parser.add_argument(
+        "-sim",
+        dest="simulate_hw_code",
+        metavar="HW_CODE",
+        type=lambda x: int(x, 16),
+        nargs="+",
+        action="store",
+        help="Do not use a real device, talk to a simulated one with the "
+        "specified HW code instead (e.g. 6583 for mt6589). Several codes "
+        "simulate several devices in multi-device mode",
+    )
+    parser.add_argument(
+        "-link",
+        dest="simulate_link",
+        choices=LINK_PRESETS.keys(),
+        default="high-speed",
+        help="[Simulation only] USB link model used to estimate the time "
+        "a real device would need",
+    )
+    parser.add_argument(
+        "-uart",
+        dest="uart_port",
+        metavar="PORT",
+        help="Talk to the device over the serial port PORT (e.g. /dev/ttyUSB0) "
+        "instead of USB. With -sim, use -uart pty to reach the simulated "
+        "device through a pseudo-terminal",
+    )
+    parser.add_argument(
+        "-baud",
+        dest="baudrate",
+        type=int,
+        default=UartTransport.BROM_BAUDRATE,
+        help="[UART only] Baudrate of the serial port (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-o",
+        dest="output_dir",
+        metavar="OUTPUT_DIR",
+        default=".",
+        help="Save received data to OUTPUT_DIR (default: current directory)",
+    )
+    parser.add_argument(
+        "-all",
+        dest="all_devices",
+        action="store_true",
+        help="Multi-device mode: handle every connected device in BROM mode, "
+        "each one in its own process. Logs and data of a device are saved "
+        "to OUTPUT_DIR/<bus-port path>, along with OUTPUT_DIR/summary.json",
+    )
+    parser.add_argument(
+        "-j",
+        dest="workers",
+        metavar="JOBS",
+        type=int,
+        help="[Multi-device and daemon modes only] Maximum number of devices "
+        "handled at once (default: all of them in multi-device mode, 1 in "
+        "daemon mode; daemon jobs should select a device with -path then)",
+    )
+    parser.add_argument(
+        "-trace",
+        dest="trace",
+        action="store_true",
+        help="Save a timeline of every stage, BROM command and transfer to "
+        "OUTPUT_DIR/trace.json (Chrome trace-event format, opens in "
+        "ui.perfetto.dev or chrome://tracing)",
+    )
+    parser.add_argument(
+        "-fresh",
+        dest="fresh",
+        action="store_true",
+        help="Identify the device even if it is known from an earlier session "
+        "(see the fingerprint cache in README.md)",
+    )
+    parser.add_argument(
+        "-lean",
+        dest="lean",
+        action="store_true",
+        help="Leave out the commands of the SP Flash Tool flow that don't "
+        "change the device state (see the lean replay in README.md)",
+    )
+    parser.add_argument(
+        "-metrics",
+        dest="metrics_path",
+        metavar="METRICS",
+        help="Add per-command latency histograms, transport counters and "
+        "retries of every session to the totals saved in METRICS (JSON) and "
+        "next to it in the Prometheus text format (.prom)",
+    )
+    parser.add_argument(
+        "-connect",
+        dest="connect_socket",
+        metavar="SOCKET",
+        help="Do not talk to the device directly, send the job to the daemon "
+        "listening on SOCKET and print its log",
+    )
+    parser.add_argument(
+        "-path",
+        dest="device_path",
+        metavar="PATH",
+        help="Use the device connected to the USB port PATH (bus-port.port, "
+        "e.g. 1-2.3) instead of the first device found",
+    )
+    parser.add_argument(
+        "-async",
+        dest="async_usb",
+        action="store_true",
+        help="[USB only] Use the asynchronous USB transport: bulk transfers "
+        "are kept in flight and driven by an asyncio event loop. Requires the "
+        "libusb1 package",
+    )
     args = parser.parse_args()
 
     init_logging(args)
 
-    # spft-replay supports only the USB transport as of now, but it
-    # shouldn't be hard to implement the UART transport using pyserial.
-    transport = UsbTransport()
-    transport.start()
+    # Sockets are only needed by the daemon and its clients
+    if args.daemon_socket:
+        from src.daemon import ReplayDaemon
+
+        daemon = ReplayDaemon(args.daemon_socket, args.workers or 1, args.metrics_path)
+        daemon.serve_forever()
+        return
+    if args.connect_socket:
+        client_mode(args)
+        return
+    if args.all_devices:
+        multi_device_mode(args)
+        return
+
+    pty_device = None
+    loop = None
+    if args.simulate_hw_code:
+        device = SimulatedDevice(args.simulate_hw_code[0])
+        if args.uart_port:
+            if args.uart_port != "pty":
+                parser.error("-uart must be pty in simulation")
+            pty_device = PtyDevice(device)
+            pty_device.start()
+            transport = UartTransport(pty_device.port, args.baudrate)
+        else:
+            transport = SimulatedTransport(device, args.simulate_link)
+    elif args.uart_port:
+        transport = UartTransport(args.uart_port, args.baudrate)
+    elif args.async_usb:
+        loop = start_event_loop()
+        transport = AsyncUsbTransport(args.device_path)
+    else:
+        transport = UsbTransport(args.device_path)
+    capture = None
+    if args.capture_path:
+        logging.info(f"Saving USB traffic to {args.capture_path}")
+        capture = PcapngCapture(args.capture_path)
+        transport.set_capture(capture)
+    if loop:
+        run_in_loop(loop, transport.start())
+    else:
+        transport.start()
 
-    brom = BromProtocol(transport)
+    brom = BromProtocol(transport, loop)
+    tracer = None
+    if args.trace:
+        tracer = Tracer()
+        brom.set_tracer(tracer)
     try:
         brom.handshake()
+        latency = time.monotonic() - transport.arrived_at
+        logging.info(f"Arrival-to-handshake latency: {latency * 1000:.1f} ms")
     except:
         logging.critical("Handshake error!", exc_info=True)
 
-    manager = DeviceManager(brom)
+    # A simulated device would pass for every real board of its model
+    fingerprints = None
+    if not args.simulate_hw_code:
+        fingerprints = FingerprintCache(refresh=args.fresh)
+    manager = DeviceManager(brom, args.output_dir, fingerprints, args.lean)
+    if tracer:
+        manager.add_observer(tracer)
     if args.mode_identify:
         identify_mode(manager)
-    elif args.mode_payload or args.mode_simple_payload:
+    else:
         payload_mode(args, manager)
 
     logging.info("Stopping transport")
-    transport.stop()
+    if loop:
+        run_in_loop(loop, transport.stop())
+        loop.call_soon_threadsafe(loop.stop)
+    else:
+        transport.stop()
+    if pty_device:
+        pty_device.stop()
+
+    if capture:
+        capture.close()
+    if tracer:
+        trace_path = os.path.join(args.output_dir, "trace.json")
+        platform = manager.platform
+        tracer.save(trace_path, type(platform).__name__ if platform else "spft-replay")
+        logging.info(f"Saved the timeline to {trace_path}")
+
+    for line in brom.metrics.summary():
+        logging.brom(line)
+    if args.metrics_path:
+        accumulate_metrics(args.metrics_path, brom.metrics)
+        logging.info(f"Saved metrics to {args.metrics_path}")
+
+
+# AsyncUsbTransport is driven by an event loop running in a thread of its
+# own, while the replay code keeps running synchronously (see BromProtocol)
+def start_event_loop():
+    import asyncio
+    import threading
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_in_loop(loop, coro):
+    import asyncio
+
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
 
 
 def init_logging(args):
-    # Add some logging levels. Source: https://stackoverflow.com/a/55276759
-    logging.REPLAY = LOG_LEVEL_REPLAY
-    logging.addLevelName(logging.REPLAY, "REPLAY")
-    logging.Logger.replay = partialmethod(logging.Logger.log, logging.REPLAY)
-    logging.replay = partial(logging.log, logging.REPLAY)
-
-    logging.BROM = LOG_LEVEL_BROM_CMD
-    logging.addLevelName(logging.BROM, "BROM CMD")
-    logging.Logger.brom = partialmethod(logging.Logger.log, logging.BROM)
-    logging.brom = partial(logging.log, logging.BROM)
-
-    logging.BROM_IO = LOG_LEVEL_BROM_IO
-    logging.addLevelName(logging.BROM_IO, "BROM I/O")
-    logging.Logger.BROM_IO = partialmethod(logging.Logger.log, logging.BROM_IO)
-    logging.brom_io = partial(logging.log, logging.BROM_IO)
+    add_log_levels()
 
     # Apply program-wide configuration
     log_level = args.log_level if args.log_level else logging.INFO
@@ -139,6 +371,63 @@ def init_logging(args):
     )
 
 
+def make_job_from_args(args, path, hw_code, output_dir):
+    return make_job(
+        path,
+        output_dir,
+        "identify" if args.mode_identify else "payload",
+        payload_path=args.mode_payload or args.mode_simple_payload,
+        payload_name=args.mode_payload_name,
+        simple_mode=bool(args.mode_simple_payload),
+        skip_remaining_data=args.skip_remaining_data,
+        receive=args.mode_payload_receive,
+        simulate_hw_code=hw_code,
+        simulate_link=args.simulate_link,
+        trace=args.trace,
+        fresh=args.fresh,
+        lean=args.lean,
+        log_level=args.log_level or logging.INFO,
+    )
+
+
+def client_mode(args):
+    from src.daemon import submit_job
+
+    hw_code = args.simulate_hw_code[0] if args.simulate_hw_code else None
+    job = make_job_from_args(args, args.device_path, hw_code, args.output_dir)
+    try:
+        result = submit_job(args.connect_socket, job)
+    except:
+        logging.critical("Daemon error!", exc_info=True)
+        sys.exit(1)
+    if result["status"] != "ok":
+        logging.critical(f"Job has failed: {result['error']}")
+        sys.exit(1)
+    logging.info(f"Job has finished in {result['elapsed']:.1f} s")
+
+
+def multi_device_mode(args):
+    if args.capture_path or args.mode_payload_greedy:
+        logging.warning("Captures and greedy mode are not supported, ignoring")
+
+    if args.simulate_hw_code:
+        devices = [
+            (f"sim-{idx}", hw_code)
+            for idx, hw_code in enumerate(args.simulate_hw_code, 1)
+        ]
+    else:
+        devices = [(usb_device_path(d), None) for d in find_brom_devices()]
+    if not devices:
+        logging.critical("No devices in BROM mode found")
+        return
+
+    jobs = [
+        make_job_from_args(args, path, hw_code, os.path.join(args.output_dir, path))
+        for path, hw_code in devices
+    ]
+    run_sessions(jobs, args.output_dir, args.workers, args.metrics_path)
+
+
 def identify_mode(manager):
     try:
         manager.identify()
@@ -147,14 +436,24 @@ def identify_mode(manager):
 
 
 def payload_mode(args, manager):
+    uart_dump = None
     try:
-        # Read the payload from file
+        # Read the payload from file, or from the cache once the SoC is known
         payload = None
         payload_path = args.mode_payload or args.mode_simple_payload
-        with open(payload_path, "rb") as fis:
-            payload = fis.read()
-        payload_len = len(payload)
-        logging.info(f"Payload size {payload_len} bytes ({as_0x(payload_len)})")
+        if args.mode_payload_name:
+            payload = cached_payload(args.mode_payload_name)
+        else:
+            payload = map_file(payload_path)
+            payload_len = len(payload)
+            logging.info(f"Payload size {payload_len} bytes ({as_0x(payload_len)})")
+
+        # Listen before the payload starts, or the beginning would be lost
+        if args.mode_uart_dump and args.mode_uart_dump == args.uart_port:
+            uart_dump = manager.brom.transport
+        elif args.mode_uart_dump:
+            uart_dump = UartTransport(args.mode_uart_dump, args.baudrate)
+            uart_dump.start()
 
         # Launch replay and push payload
         simple_mode = bool(args.mode_simple_payload)
@@ -166,8 +465,13 @@ def payload_mode(args, manager):
             manager.receive_data()
         elif args.mode_payload_greedy:
             manager.receive_greedy()
+        elif uart_dump:
+            receive_uart_dump(uart_dump, args.output_dir)
     except:
         logging.critical("Replay error!", exc_info=True)
+    finally:
+        if uart_dump and uart_dump is not manager.brom.transport:
+            uart_dump.stop()
 
 
 if __name__ == "__main__":
@@ -3,30 +3,188 @@
 # SPDX-FileContributor: chaosmaster <https://github.com/chaosmaster>
 # SPDX-FileContributor: arzamas-16 <https://github.com/arzamas-16>
 
+import array
+import functools
 import logging
-
-from src.common import as_0x, as_hex, from_bytes, to_bytes
-
-
-class BromProtocol:
-    def __init__(self, transport):
+import sys
+import time
+
+from src.common import (
+    as_0x,
+    as_hex,
+    from_bytes,
+    report_write_progress,
+    run_sync,
+    to_bytes,
+)
+from src.metrics import Metrics
+from src.trace import TracingTransport, describe
+from src.transport import AsyncTransportAdapter
+
+# Bytes swapped and sent at a time by `send_da_legacy`. A multiple of the
+# USB packet size, so the DA is split into the same packets as before.
+LEGACY_DA_CHUNK_SIZE = 64 * 1024
+
+
+# XOR of the 16-bit little-endian words of `data`, the DA checksum of
+# BROM. The words are folded as one big integer, halving it every step.
+def xor16(data):
+    words = len(data) // 2
+    value = int.from_bytes(data[: words * 2], "little")
+    while words > 1:
+        half = (words + 1) // 2
+        value = (value >> (half * 16)) ^ (value & ((1 << (half * 16)) - 1))
+        words = half
+    return value
+
+
+# Swap the bytes of every 16-bit word of `data`
+def swap16(data):
+    words = array.array("H")
+    words.frombytes(data)
+    words.byteswap()
+    return memoryview(words).cast("B")
+
+
+# Array of unsigned words of `width` bits
+def word_array(width):
+    for typecode in "BHIL":
+        if array.array(typecode).itemsize == width // 8:
+            return array.array(typecode)
+    raise RuntimeError(f"invalid width {width}")
+
+
+# Copy a list or an array of words into an array of `width`-bit words
+def as_word_array(words, width):
+    result = word_array(width)
+    result.fromlist(list(words))
+    return result
+
+
+# Decode big-endian words received from BROM into an array
+def decode_words(data, width):
+    words = word_array(width)
+    words.frombytes(data)
+    if sys.byteorder == "little" and width > 8:
+        words.byteswap()
+    return words
+
+
+# Encode words as sent to BROM, big-endian
+def encode_words(words, width):
+    if sys.byteorder == "little" and width > 8:
+        words = word_array(width) + words  # copy, the caller's words stay intact
+        words.byteswap()
+    return memoryview(words).cast("B")
+
+
+# Offset of the first byte that differs between two buffers, or None if
+# they are equal. If one buffer is a prefix of the other, they differ
+# right after the end of the shorter one.
+def first_difference(test, gold):
+    size = min(len(test), len(gold))
+    diff = int.from_bytes(test[:size], "big") ^ int.from_bytes(gold[:size], "big")
+    if diff:
+        return size - (diff.bit_length() + 7) // 8
+    return None if len(test) == len(gold) else size
+
+
+# Split [addr, addr + length) into (addr, amount) read commands of at most
+# `max_size` bytes each
+def memory_chunks(addr, length, width, max_size):
+    size = width // 8
+    if addr % size or length % size:
+        raise RuntimeError(
+            f"{as_0x(addr)}+{as_0x(length)} is not aligned to {width}-bit words"
+        )
+    max_amount = max(max_size // size, 1)
+    end = addr + length
+    while addr < end:
+        amount = min((end - addr) // size, max_amount)
+        yield addr, amount
+        addr += amount * size
+
+
+# Record the latency of a command of AsyncBromProtocol in its metrics,
+# and count the command as failed if it raises. Commands made of other
+# commands are recorded once, by the outermost one. While tracing, every
+# command gets a span in the trace, nested ones included.
+def command(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        outermost = not self.depth
+        self.depth += 1
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        except Exception:
+            if outermost:
+                self.metrics.error(name)
+            raise
+        finally:
+            self.depth -= 1
+            finished = time.perf_counter()
+            if outermost:
+                self.metrics.observe(name, finished - started)
+            if self.tracer:
+                args = {"args": describe(args)} if args else None
+                self.tracer.span(name, "brom", started, finished, args)
+
+    return wrapper
+
+
+# The BROM protocol implemented on top of an asynchronous transport, e.g.
+# `await brom.read32(addr)`. Synchronous transports can be used through
+# AsyncTransportAdapter.
+class AsyncBromProtocol:
+    def __init__(self, transport, metrics=None):
         self.transport = transport
+        self.metrics = metrics or Metrics()
+        self.tracer = None  # see `src/trace.py`
+        self.depth = 0  # nesting of commands, see `command`
 
-    def handshake(self):
+    # Queue several commands and execute them in one go, see BromPipeline.
+    # Use `async with` to execute the batch.
+    def pipeline(self):
+        return BromPipeline(self)
+
+    @command
+    async def handshake(self):
         sequence = b"\xA0\x0A\x50\x05"
         i = 0
         while i < len(sequence):
-            self.transport.write(sequence[i])
-            reply = self.transport.read(1)
+            await self.transport.write(sequence[i])
+            reply = await self.transport.read(1)
             if reply and reply[0] == ~sequence[i] & 0xFF:
                 i += 1
             else:
                 i = 0
+                self.metrics.increment("handshake_retries")
         logging.info("Handshake completed!")
 
-    def read_reg(self, reg_size, addr, amount=1, check_status=True):
-        result = []
+    # Most bytes read or written by a single command of `read_memory` and
+    # `write_memory`
+    MAX_READ_SIZE = 64 * 1024
+    MAX_WRITE_SIZE = 64 * 1024
+    # Most bytes sent before reading their echo, see `write_words`
+    WRITE_WINDOW = 1024
+
+    @command
+    async def read_reg(self, reg_size, addr, amount=1, check_status=True):
+        result = (await self.read_words(reg_size, addr, amount, check_status)).tolist()
+
+        # support scalar
+        if len(result) == 1:
+            return result[0]
+        else:
+            return result
 
+    # Read `amount` registers with one command. The whole reply is received
+    # in one read and returned as an array of words.
+    @command
+    async def read_words(self, reg_size, addr, amount, check_status=True):
         # Fall back to 32-bit registers
         read_command = 0xD1
         if reg_size == 16:
@@ -34,45 +192,81 @@ class BromProtocol:
         elif reg_size == 32:
             read_command = 0xD1 if check_status else 0xAF
 
-        self.transport.echo(read_command)
-        self.transport.echo(addr, 4)
-        self.transport.echo(amount, 4)
+        await self.transport.echo(read_command)
+        await self.transport.echo(addr, 4)
+        await self.transport.echo(amount, 4)
 
         if check_status:
-            status = self.transport.read(2)
+            status = await self.transport.read(2)
             if from_bytes(status, 2) > 0xFF:
                 raise RuntimeError(f"status is {as_hex(status, 2)}")
 
-        sz = reg_size // 8
-        for _ in range(amount):
-            data = from_bytes(self.transport.read(sz), sz)
-            result.append(data)
+        data = await self.transport.read_view(amount * reg_size // 8)
+        if len(data) < amount * reg_size // 8:
+            raise RuntimeError(f"no response reading {as_0x(addr)}")
+        result = decode_words(data, reg_size)
 
         if check_status:
-            status = self.transport.read(2)
+            status = await self.transport.read(2)
             if from_bytes(status, 2) > 0xFF:
                 raise RuntimeError(f"status is {as_hex(status, 2)}")
 
-        # support scalar
-        if len(result) == 1:
-            return result[0]
-        else:
-            return result
+        return result
 
-    def read16(self, addr, amount=1, check_status=True):
+    # Read `length` bytes of memory as `width`-bit words, e.g. for dumping
+    # registers. The range is read by as few commands as possible, see
+    # MAX_READ_SIZE. Returns an array of words.
+    @command
+    async def read_memory(self, addr, length, width=32, check_status=True):
+        logging.brom(f"read_memory({as_0x(addr)}, {as_0x(length)}, {width})")
+        result = word_array(width)
+        async for _, words in self.iter_memory(addr, length, width, check_status):
+            result.extend(words)
+        return result
+
+    # Same as above but yields (address, words) for every command, so large
+    # ranges don't have to fit in memory
+    async def iter_memory(self, addr, length, width=32, check_status=True):
+        chunks = memory_chunks(addr, length, width, AsyncBromProtocol.MAX_READ_SIZE)
+        for chunk_addr, amount in chunks:
+            yield chunk_addr, await self.read_words(
+                width, chunk_addr, amount, check_status
+            )
+
+    @command
+    async def read16(self, addr, amount=1, check_status=True):
         logging.brom(f"read16({as_0x(addr)})")
-        return self.read_reg(16, addr, amount, check_status)
+        return await self.read_reg(16, addr, amount, check_status)
 
-    def read32(self, addr, amount=1, check_status=True):
+    @command
+    async def read32(self, addr, amount=1, check_status=True):
         logging.brom(f"read32({as_0x(addr)})")
-        return self.read_reg(32, addr, amount, check_status)
+        return await self.read_reg(32, addr, amount, check_status)
 
     # Some SoCs reply with 0x0000 as OK (mt6589), some reply with 0x0001 (mt6580)
-    def write_reg(self, reg_size, addr, words, expected_response=0, check_status=True):
+    @command
+    async def write_reg(
+        self, reg_size, addr, words, expected_response=0, check_status=True
+    ):
         # support scalar
         if not isinstance(words, list):
             words = [words]
 
+        words = as_word_array(words, reg_size)
+        await self.write_words(reg_size, addr, words, expected_response, check_status)
+
+    # Write an array of registers with one command. The header is sent
+    # first and, if BROM checks the arguments, its status is checked before
+    # any word goes out: BROM doesn't take the words of a rejected command
+    # and would parse them as new commands. The words are then sent in bulk
+    # and their echoes are read back after every WRITE_WINDOW bytes: BROM
+    # echoes everything it receives and must not be left with more unread
+    # echoes than its USB FIFO can hold while a synchronous transport is
+    # busy writing.
+    @command
+    async def write_words(
+        self, reg_size, addr, words, expected_response=0, check_status=True
+    ):
         # Fall back to 32-bit registers
         write_command = 0xD4
         if reg_size == 16:
@@ -80,234 +274,331 @@ class BromProtocol:
         elif reg_size == 32:
             write_command = 0xD4 if check_status else 0xAE
 
-        self.transport.echo(write_command)
-        self.transport.echo(addr, 4)
-        self.transport.echo(len(words), 4)
-
-        if check_status:  # arg check status
-            self.transport.check(self.transport.read(2), to_bytes(expected_response, 2))
+        header = to_bytes(write_command) + to_bytes(addr, 4)
+        header += to_bytes(len(words), 4)
+        data = encode_words(words, reg_size)
+        status = to_bytes(expected_response, 2)
 
-        for word in words:
-            self.transport.echo(word, reg_size // 8)
+        if check_status:
+            await self.transport.write(header, progress=False)
+            reply = await self.transport.read_view(len(header) + 2)
+            self.transport.check(bytes(reply[: len(header)]), header)
+            self.transport.check(bytes(reply[len(header) :]), status)  # arg check
+            chunks = [data]
+            echo_start = 0
+        else:
+            # Legacy BROM doesn't check the arguments
+            chunks = [header, data]
+            echo_start = len(header)
+
+        # Replies: header echo (legacy only), data echo, execution status
+        status_size = 2 if check_status else 0
+        reply = bytearray()
+        sent = 0
+        window_size = AsyncBromProtocol.WRITE_WINDOW
+        for chunk in chunks:
+            for off_start in range(0, len(chunk), window_size):
+                window = chunk[off_start : off_start + window_size]
+                await self.transport.write(window, progress=False)
+                sent += len(window)
+                reply += await self.transport.read_view(sent - len(reply))
+        reply += await self.transport.read_view(status_size)
+        if len(reply) != sent + status_size:
+            raise RuntimeError(f"no response writing {as_0x(addr)}")
 
+        if not check_status:
+            self.transport.check(bytes(reply[:echo_start]), header)
+        echo = memoryview(reply)[echo_start : len(reply) - status_size]
+        offset = first_difference(echo, data)
+        if offset is not None:
+            size = reg_size // 8
+            word_offset = offset // size * size
+            test = as_hex(bytes(echo[word_offset : word_offset + size]))
+            gold = as_hex(bytes(data[word_offset : word_offset + size]))
+            raise RuntimeError(
+                f"Unexpected echo of word {offset // size} at "
+                f"{as_0x(addr + word_offset)}, expected {gold} got {test}"
+            )
         if check_status:  # command execution status
-            self.transport.check(self.transport.read(2), to_bytes(expected_response, 2))
+            self.transport.check(bytes(reply[len(reply) - 2 :]), status)
+
+    # Write `data` to memory as `width`-bit words, e.g. for staging data in
+    # SRAM. `data` is a list or an array of words, or a bytes-like memory
+    # image (little-endian words). Contiguous words are written by as few
+    # commands as possible, see MAX_WRITE_SIZE.
+    @command
+    async def write_memory(
+        self, addr, data, width=32, expected_response=0, check_status=True
+    ):
+        if isinstance(data, (list, array.array)):
+            words = as_word_array(data, width)
+        else:
+            words = word_array(width)
+            words.frombytes(data)
+            if sys.byteorder == "big" and width > 8:
+                words.byteswap()
+        size = width // 8
+        length = len(words) * size
+        logging.brom(f"write_memory({as_0x(addr)}, {as_0x(length)}, {width})")
+
+        max_size = AsyncBromProtocol.MAX_WRITE_SIZE
+        for chunk_addr, amount in memory_chunks(addr, length, width, max_size):
+            start = (chunk_addr - addr) // size
+            await self.write_words(
+                width,
+                chunk_addr,
+                words[start : start + amount],
+                expected_response,
+                check_status,
+            )
 
-    def write16(self, addr, words, expected_response=0, check_status=True):
+    @command
+    async def write16(self, addr, words, expected_response=0, check_status=True):
         logging.brom(f"write16({as_hex(addr)}, [{as_hex(words, 2)}])")
-        self.write_reg(16, addr, words, expected_response, check_status)
+        await self.write_reg(16, addr, words, expected_response, check_status)
 
-    def write32(self, addr, words, expected_response=0, check_status=True):
+    @command
+    async def write32(self, addr, words, expected_response=0, check_status=True):
         logging.brom(f"write32({as_hex(addr)}, [{as_hex(words)}])")
-        self.write_reg(32, addr, words, expected_response, check_status)
+        await self.write_reg(32, addr, words, expected_response, check_status)
 
-    def get_target_config(self):
+    @command
+    async def get_target_config(self):
         logging.brom("Get target config")
-        self.transport.echo(0xD8)
+        await self.transport.echo(0xD8)
 
-        target_config = self.transport.read(4)
-        status = self.transport.read(2)
+        target_config = await self.transport.read(4)
+        status = await self.transport.read(2)
 
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
         return from_bytes(target_config, 4)
 
-    def get_hw_code(self):
+    @command
+    async def get_hw_code(self):
         logging.brom("Get HW code")
-        self.transport.echo(0xFD)
+        await self.transport.echo(0xFD)
 
-        hw_code = self.transport.read(2, timeout=200)
+        hw_code = await self.transport.read(2, timeout=200)
         # Very old platforms don't reply this command
         if not hw_code:
             logging.warning("No response to get_hw_code! Is it a legacy device?")
             return 0x0000  # return special value
 
-        status = self.transport.read(2)
+        status = await self.transport.read(2)
 
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
         return from_bytes(hw_code, 2)
 
-    def get_hw_sw_ver(self):
+    @command
+    async def get_hw_sw_ver(self):
         logging.brom("Get HW/SW version")
-        self.transport.echo(0xFC)
+        await self.transport.echo(0xFC)
 
-        hw_sub_code = self.transport.read(2)
-        hw_ver = self.transport.read(2)
-        sw_ver = self.transport.read(2)
-        status = self.transport.read(2)
+        hw_sub_code = await self.transport.read(2)
+        hw_ver = await self.transport.read(2)
+        sw_ver = await self.transport.read(2)
+        status = await self.transport.read(2)
 
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
         return from_bytes(hw_sub_code, 2), from_bytes(hw_ver, 2), from_bytes(sw_ver, 2)
 
-    def send_da(self, da_address, da_len, sig_len, da):
+    @command
+    async def send_da(self, da_address, da_len, sig_len, da):
         logging.brom(
             f"Send Download Agent to {as_0x(da_address)} "
             f"({da_len} bytes, {sig_len} byte signature)"
         )
-        self.transport.echo(0xD7)
+        await self.transport.echo(0xD7)
 
-        self.transport.echo(da_address, 4)
-        self.transport.echo(da_len, 4)
-        self.transport.echo(sig_len, 4)
+        await self.transport.echo(da_address, 4)
+        await self.transport.echo(da_len, 4)
+        await self.transport.echo(sig_len, 4)
 
-        status = self.transport.read(2)
+        status = await self.transport.read(2)
 
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
-        self.transport.write(da)
+        await self.transport.write(da)
 
-        checksum = from_bytes(self.transport.read(2), 2)
-        status = from_bytes(self.transport.read(2), 2)
+        checksum = from_bytes(await self.transport.read(2), 2)
+        status = from_bytes(await self.transport.read(2), 2)
 
         if status != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
         return checksum
 
-    def send_da_legacy(self, da_address, da):
-        logging.brom(f"Send Download Agent to {as_0x(da_address)} ({len(da)} bytes)")
-
-        # Legacy SP Flash Tool changes endianness before sending the data.
-        da = bytearray(da[: len(da) // 2 * 2])  # remove odd byte if there's any
-        for i in range(0, len(da) - 1, 2):
-            da[i], da[i + 1] = da[i + 1], da[i]
-        da = bytes(da)
-
-        self.transport.echo(0xAD)
-
-        self.transport.echo(da_address, 4)
-        self.transport.echo(len(da) // 2, 4)
-        self.transport.write(da)
-
-    def checksum_legacy(self, address, size):
+    # Legacy SP Flash Tool changes endianness before sending the data. `da`
+    # can be any buffer, e.g. a memory-mapped file: it is swapped and sent
+    # LEGACY_DA_CHUNK_SIZE bytes at a time, so it's never copied as a whole.
+    # Returns the checksum that `checksum_legacy` should report for the DA.
+    @command
+    async def send_da_legacy(self, da_address, da):
+        da = memoryview(da).cast("B")
+        da = da[: len(da) // 2 * 2]  # remove odd byte if there's any
+        da_len = len(da)
+        logging.brom(f"Send Download Agent to {as_0x(da_address)} ({da_len} bytes)")
+
+        await self.transport.echo(0xAD)
+
+        await self.transport.echo(da_address, 4)
+        await self.transport.echo(da_len // 2, 4)
+
+        checksum = 0
+        for off_start in range(0, da_len, LEGACY_DA_CHUNK_SIZE):
+            off_end = min(off_start + LEGACY_DA_CHUNK_SIZE, da_len)
+            chunk = swap16(da[off_start:off_end])
+            checksum ^= xor16(chunk)
+            await self.transport.write(chunk, progress=False)
+            report_write_progress(off_start, off_end, da_len)
+        # The checksum of swapped words is the swapped checksum of the DA
+        return (checksum >> 8) | (checksum & 0xFF) << 8
+
+    @command
+    async def checksum_legacy(self, address, size):
         logging.brom(f"Calculating checksum for {size} bytes as {as_0x(address)}")
-        self.transport.echo(0xA4)
+        await self.transport.echo(0xA4)
 
-        self.transport.echo(address, 4)
-        self.transport.echo(size // 2, 4)
+        await self.transport.echo(address, 4)
+        await self.transport.echo(size // 2, 4)
 
-        checksum = from_bytes(self.transport.read(2), 2)
+        checksum = from_bytes(await self.transport.read(2), 2)
         return checksum
 
-    def jump_da(self, da_address, check_status=True):
+    @command
+    async def jump_da(self, da_address, check_status=True):
         logging.brom(f"Jump to Download Agent at {as_0x(da_address)}")
-        self.transport.echo(0xD5 if check_status else 0xA8)
+        await self.transport.echo(0xD5 if check_status else 0xA8)
 
-        self.transport.echo(da_address, 4)
+        await self.transport.echo(da_address, 4)
 
         if not check_status:
             return
 
-        status = self.transport.read(2)
+        status = await self.transport.read(2)
 
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
-    def uart1_log_enable(self):
+    @command
+    async def uart1_log_enable(self):
         logging.brom("Enable UART1 logging")
-        self.transport.echo(0xDB)
+        await self.transport.echo(0xDB)
 
-        status = self.transport.read(2)
+        status = await self.transport.read(2)
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
-    def power_init(self, reg, val):
+    @command
+    async def power_init(self, reg, val):
         logging.brom(f"Init PMIC at {as_0x(reg)} ({as_hex(val)})")
-        self.transport.echo(0xC4)
+        await self.transport.echo(0xC4)
 
-        self.transport.echo(reg, 4)
-        self.transport.echo(val, 4)
+        await self.transport.echo(reg, 4)
+        await self.transport.echo(val, 4)
 
-        status = self.transport.read(2)
+        status = await self.transport.read(2)
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
-    def power_deinit(self):
+    @command
+    async def power_deinit(self):
         logging.brom("Deinit PMIC")
-        self.transport.echo(0xC5)
+        await self.transport.echo(0xC5)
 
-        status = self.transport.read(2)
+        status = await self.transport.read(2)
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
-    def power_read16(self, reg):
+    @command
+    async def power_read16(self, reg):
         logging.brom(f"PMIC read16({as_0x(reg, 2)})")
-        self.transport.echo(0xC6)
-        self.transport.echo(reg, 2)
+        await self.transport.echo(0xC6)
+        await self.transport.echo(reg, 2)
 
         expected = 0
-        self.transport.check(self.transport.read(2), to_bytes(expected, 2))  # recv ack
         self.transport.check(
-            self.transport.read(2), to_bytes(expected, 2)
+            await self.transport.read(2), to_bytes(expected, 2)
+        )  # recv ack
+        self.transport.check(
+            await self.transport.read(2), to_bytes(expected, 2)
         )  # PMIC read status
 
-        result = from_bytes(self.transport.read(2), 2)
+        result = from_bytes(await self.transport.read(2), 2)
         return result
 
-    def power_write16(self, reg, val):
+    @command
+    async def power_write16(self, reg, val):
         logging.brom(f"PMIC write16({as_hex(reg)}, {as_hex(val)})")
-        self.transport.echo(0xC7)
-        self.transport.echo(reg, 2)
-        self.transport.echo(val, 2)
+        await self.transport.echo(0xC7)
+        await self.transport.echo(reg, 2)
+        await self.transport.echo(val, 2)
 
         expected = 0
-        self.transport.check(self.transport.read(2), to_bytes(expected, 2))  # recv ack
         self.transport.check(
-            self.transport.read(2), to_bytes(expected, 2)
+            await self.transport.read(2), to_bytes(expected, 2)
+        )  # recv ack
+        self.transport.check(
+            await self.transport.read(2), to_bytes(expected, 2)
         )  # PMIC write status
 
-    def get_me_id(self):
+    @command
+    async def get_me_id(self):
         logging.brom("Get ME ID")
-        self.transport.echo(0xE1)
+        await self.transport.echo(0xE1)
 
-        length = from_bytes(self.transport.read(4), 4)
+        length = from_bytes(await self.transport.read(4), 4)
         if length == 0:
             raise RuntimeError("bad ME ID length")
-        me_id = self.transport.read(length)
+        me_id = await self.transport.read(length)
 
-        status = self.transport.read(2)
+        status = await self.transport.read(2)
         if from_bytes(status, 2) != 0:
             raise RuntimeError(f"status is {as_hex(status, 2)}")
 
         return me_id
 
-    def get_preloader_version(self):
+    @command
+    async def get_preloader_version(self):
         logging.brom("Get PRELOADER version")
-        self.transport.write(0xFE)
+        await self.transport.write(0xFE)
 
-        ver = from_bytes(self.transport.read(1))
+        ver = from_bytes(await self.transport.read(1))
         if ver == 0xFE:
             logging.warning("Cannot get PRELOADER version in BROM mode")
         return ver
 
-    def get_brom_version(self):
+    @command
+    async def get_brom_version(self):
         logging.brom("Get BROM version")
-        self.transport.write(0xFF)
+        await self.transport.write(0xFF)
 
-        ver = from_bytes(self.transport.read(1))
+        ver = from_bytes(await self.transport.read(1))
         if ver == 0xFF:
             logging.warning("Cannot get BROM version in PRELOADER mode")
         return ver
 
-    def set_power_reg(self, register, new_value, reference_value):
+    @command
+    async def set_power_reg(self, register, new_value, reference_value):
         # Check current value
         # reference_value - a value obtained from the Wireshark dump of my device
-        pwr = self.power_read16(register)
+        pwr = await self.power_read16(register)
         if pwr != reference_value:
             logging.warning("power_read16 returned non-reference value")
         if pwr == new_value:
             logging.debug("power_read16 value is already set, setting anyway")
 
         # Write even if no change is needed
-        pwr = self.power_write16(register, new_value)
+        pwr = await self.power_write16(register, new_value)
 
         # Check if new value has been set successfully
-        pwr = self.power_read16(register)
+        pwr = await self.power_read16(register)
         if pwr != new_value:
             logging.error(
                 f"Could not set PMIC reg {as_0x(register, 2)} "
@@ -316,9 +607,10 @@ class BromProtocol:
             )
 
     # Inspired by mt6573 Wireshark dump
-    def write16_verify(self, register, new_value, reference_value):
+    @command
+    async def write16_verify(self, register, new_value, reference_value):
         # reference_value - a value obtained from the Wireshark dump of my device
-        old_value = self.read16(register)
+        old_value = await self.read16(register)
         if old_value != reference_value:
             logging.warning(
                 f"Read {as_0x(register)}, "
@@ -326,9 +618,9 @@ class BromProtocol:
                 f"reference is {as_hex(reference_value, size=2)}"
             )
 
-        self.write16(register, new_value)
+        await self.write16(register, new_value)
 
-        check = self.read16(register)
+        check = await self.read16(register)
         if check != new_value:
             logging.warning(
                 f"Set {as_0x(register)} "
@@ -341,13 +633,356 @@ class BromProtocol:
     # it's intended to be used in `platform.py` and `manager.py` because they
     # don't have direct access to transport.
     # Do not call this function from `device.py`.
-    def just_read(self, size):
-        return self.transport.read(size)
+    async def just_read(self, size, timeout=-1):
+        return await self.transport.read(size, timeout)
+
+    # Same as above but returns a view that is valid until the next read
+    async def just_read_view(self, size, timeout=-1):
+        return await self.transport.read_view(size, timeout)
 
     # Write bytes to transport without issuing any command.
     # This function proxies the `write` operaion to underlying transport, and
     # it's intended to be used in `platform.py` and `manager.py` because they
     # don't have direct access to transport.
     # Do not call this function from `device.py`.
+    async def just_write(self, data):
+        await self.transport.write(data)
+
+
+# Synchronous facade over AsyncBromProtocol used by DeviceManager and the
+# platform classes. With a synchronous transport every command runs to
+# completion without an event loop. An asynchronous transport (such as
+# AsyncUsbTransport) must be driven by an event loop running in another
+# thread; pass that `loop` and the commands will be submitted to it, so
+# the replay code can run in a worker thread or an executor.
+class BromProtocol:
+    def __init__(self, transport, loop=None):
+        self.transport = transport
+        # Shared with the transport, which records the traffic
+        self.metrics = Metrics()
+        transport.metrics = self.metrics
+        if loop:
+            self.aio = AsyncBromProtocol(transport, self.metrics)
+            self.loop = loop
+            self.run = self.run_threadsafe
+        else:
+            self.aio = AsyncBromProtocol(AsyncTransportAdapter(transport), self.metrics)
+            self.loop = None
+            self.run = run_sync
+
+    # Only used with an event loop, so asyncio is imported by then anyway
+    def run_threadsafe(self, coro):
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    # Record commands and transfers in a Tracer (see `src/trace.py`) from
+    # now on
+    def set_tracer(self, tracer):
+        self.aio.tracer = tracer
+        self.aio.transport = TracingTransport(self.aio.transport, tracer)
+
+    # Queue several commands and execute them in one go, see BromPipeline
+    def pipeline(self):
+        return BromPipeline(self.aio, self.run)
+
+    def handshake(self):
+        return self.run(self.aio.handshake())
+
+    def read_reg(self, reg_size, addr, amount=1, check_status=True):
+        return self.run(self.aio.read_reg(reg_size, addr, amount, check_status))
+
+    def read16(self, addr, amount=1, check_status=True):
+        return self.run(self.aio.read16(addr, amount, check_status))
+
+    def read32(self, addr, amount=1, check_status=True):
+        return self.run(self.aio.read32(addr, amount, check_status))
+
+    def read_memory(self, addr, length, width=32, check_status=True):
+        return self.run(self.aio.read_memory(addr, length, width, check_status))
+
+    def iter_memory(self, addr, length, width=32, check_status=True):
+        logging.brom(f"iter_memory({as_0x(addr)}, {as_0x(length)}, {width})")
+        max_size = AsyncBromProtocol.MAX_READ_SIZE
+        for chunk_addr, amount in memory_chunks(addr, length, width, max_size):
+            words = self.aio.read_words(width, chunk_addr, amount, check_status)
+            yield chunk_addr, self.run(words)
+
+    def write_reg(self, reg_size, addr, words, expected_response=0, check_status=True):
+        return self.run(
+            self.aio.write_reg(reg_size, addr, words, expected_response, check_status)
+        )
+
+    def write_memory(
+        self, addr, data, width=32, expected_response=0, check_status=True
+    ):
+        return self.run(
+            self.aio.write_memory(addr, data, width, expected_response, check_status)
+        )
+
+    def write16(self, addr, words, expected_response=0, check_status=True):
+        return self.run(self.aio.write16(addr, words, expected_response, check_status))
+
+    def write32(self, addr, words, expected_response=0, check_status=True):
+        return self.run(self.aio.write32(addr, words, expected_response, check_status))
+
+    def get_target_config(self):
+        return self.run(self.aio.get_target_config())
+
+    def get_hw_code(self):
+        return self.run(self.aio.get_hw_code())
+
+    def get_hw_sw_ver(self):
+        return self.run(self.aio.get_hw_sw_ver())
+
+    def send_da(self, da_address, da_len, sig_len, da):
+        return self.run(self.aio.send_da(da_address, da_len, sig_len, da))
+
+    def send_da_legacy(self, da_address, da):
+        return self.run(self.aio.send_da_legacy(da_address, da))
+
+    def checksum_legacy(self, address, size):
+        return self.run(self.aio.checksum_legacy(address, size))
+
+    def jump_da(self, da_address, check_status=True):
+        return self.run(self.aio.jump_da(da_address, check_status))
+
+    def uart1_log_enable(self):
+        return self.run(self.aio.uart1_log_enable())
+
+    def power_init(self, reg, val):
+        return self.run(self.aio.power_init(reg, val))
+
+    def power_deinit(self):
+        return self.run(self.aio.power_deinit())
+
+    def power_read16(self, reg):
+        return self.run(self.aio.power_read16(reg))
+
+    def power_write16(self, reg, val):
+        return self.run(self.aio.power_write16(reg, val))
+
+    def get_me_id(self):
+        return self.run(self.aio.get_me_id())
+
+    def get_preloader_version(self):
+        return self.run(self.aio.get_preloader_version())
+
+    def get_brom_version(self):
+        return self.run(self.aio.get_brom_version())
+
+    def set_power_reg(self, register, new_value, reference_value):
+        return self.run(self.aio.set_power_reg(register, new_value, reference_value))
+
+    def write16_verify(self, register, new_value, reference_value):
+        return self.run(self.aio.write16_verify(register, new_value, reference_value))
+
+    def just_read(self, size, timeout=-1):
+        return self.run(self.aio.just_read(size, timeout))
+
+    def just_read_view(self, size, timeout=-1):
+        view = self.run(self.aio.just_read_view(size, timeout))
+        # The event loop may refill the buffer behind the view at any time
+        return bytes(view) if self.loop else view
+
     def just_write(self, data):
-        self.transport.write(data)
+        return self.run(self.aio.just_write(data))
+
+
+# Pipelined execution of register commands. Instead of waiting for an
+# echo after every byte sequence, the queued commands are serialized into
+# an outbound buffer, sent at once, and all echoes and status words are
+# read back in one bulk read. The replies are checked afterwards in the
+# same order the commands were queued.
+#
+# The same rules as in `AsyncBromProtocol.write_words` apply, so the
+# queue is split into batches sent one after the other: a batch ends with
+# the header of every write whose arguments BROM checks, the words only
+# go out once the status has been checked, and a batch never holds more
+# than WRITE_WINDOW bytes.
+#
+# Only use this for commands that don't depend on each other's results:
+# if the device rejects a command that isn't checked before the end of its
+# batch, everything queued after it will be interpreted as garbage by
+# BROM. The error message points to the first command that diverged.
+#
+# Usage:
+#     with brom.pipeline() as pipeline:
+#         pipeline.write16(0x70014074, 0x0001)
+#         pipeline.read16(0x70014000)
+#     value = pipeline.results[0]
+#
+# AsyncBromProtocol pipelines are used the same way with `async with`.
+class BromPipeline:
+    ECHO = 0  # must match the sent bytes
+    STATUS = 1  # must match the expected response
+    STATUS_OK = 2  # must be at most 0xFF
+    DATA = 3  # register value
+
+    def __init__(self, brom, run=None):
+        self.transport = brom.transport
+        self.metrics = brom.metrics
+        self.tracer = brom.tracer
+        self.run = run
+        self.txbuffer = bytearray()
+        self.expected = []  # (kind, size, gold, command index)
+        self.batches = []  # (txbuffer, expected) queued before the current ones
+        self.commands = []  # command descriptions for error reporting
+        self.reads = []  # indexes of read commands
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.execute_async()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def begin(self, description):
+        logging.brom(f"{description} [pipelined]")
+        self.commands.append(description)
+
+    # End the current batch: everything queued so far is sent and checked
+    # before anything queued later goes out
+    def split(self):
+        if self.txbuffer or self.expected:
+            self.batches.append((self.txbuffer, self.expected))
+            self.txbuffer = bytearray()
+            self.expected = []
+
+    def echo(self, value, size=1):
+        if len(self.txbuffer) + size > AsyncBromProtocol.WRITE_WINDOW:
+            self.split()
+        data = to_bytes(value, size)
+        self.txbuffer += data
+        self.expected.append((BromPipeline.ECHO, size, data, len(self.commands) - 1))
+
+    def expect(self, kind, size, gold=None):
+        self.expected.append((kind, size, gold, len(self.commands) - 1))
+
+    def read_reg(self, reg_size, addr, amount=1, check_status=True):
+        read_command = 0xD1
+        if reg_size == 16:
+            read_command = 0xD0 if check_status else 0xA2
+        elif reg_size == 32:
+            read_command = 0xD1 if check_status else 0xAF
+
+        self.reads.append(len(self.commands) - 1)
+        self.echo(read_command)
+        self.echo(addr, 4)
+        self.echo(amount, 4)
+        if check_status:
+            self.expect(BromPipeline.STATUS_OK, 2)
+        for _ in range(amount):
+            self.expect(BromPipeline.DATA, reg_size // 8)
+        if check_status:
+            self.expect(BromPipeline.STATUS_OK, 2)
+
+    def read16(self, addr, amount=1, check_status=True):
+        self.begin(f"read16({as_0x(addr)})")
+        self.read_reg(16, addr, amount, check_status)
+
+    def read32(self, addr, amount=1, check_status=True):
+        self.begin(f"read32({as_0x(addr)})")
+        self.read_reg(32, addr, amount, check_status)
+
+    def write_reg(self, reg_size, addr, words, expected_response=0, check_status=True):
+        if not isinstance(words, list):
+            words = [words]
+
+        write_command = 0xD4
+        if reg_size == 16:
+            write_command = 0xD2 if check_status else 0xA1
+        elif reg_size == 32:
+            write_command = 0xD4 if check_status else 0xAE
+
+        self.echo(write_command)
+        self.echo(addr, 4)
+        self.echo(len(words), 4)
+        if check_status:
+            self.expect(BromPipeline.STATUS, 2, to_bytes(expected_response, 2))
+            self.split()  # the words of a rejected command must not be sent
+        for word in words:
+            self.echo(word, reg_size // 8)
+        if check_status:
+            self.expect(BromPipeline.STATUS, 2, to_bytes(expected_response, 2))
+
+    def write16(self, addr, words, expected_response=0, check_status=True):
+        self.begin(f"write16({as_hex(addr)}, [{as_hex(words, 2)}])")
+        self.write_reg(16, addr, words, expected_response, check_status)
+
+    def write32(self, addr, words, expected_response=0, check_status=True):
+        self.begin(f"write32({as_hex(addr)}, [{as_hex(words)}])")
+        self.write_reg(32, addr, words, expected_response, check_status)
+
+    def diverged(self, index, message):
+        self.metrics.error("pipeline")
+        return RuntimeError(
+            f"Pipelined command #{index} {self.commands[index]} "
+            f"(out of {len(self.commands)}): {message}"
+        )
+
+    def execute(self):
+        if not self.run:
+            raise RuntimeError("Asynchronous pipelines must use execute_async")
+        return self.run(self.execute_async())
+
+    # Send all queued commands batch by batch, then read and verify the
+    # replies of each batch before sending the next one. Values returned by
+    # read commands are stored in `results` in queue order.
+    async def execute_async(self):
+        if not self.commands:
+            return self.results
+
+        self.split()
+        started = time.perf_counter()
+        values = {}
+        for txbuffer, expected in self.batches:
+            await self.execute_batch(txbuffer, expected, values)
+        finished = time.perf_counter()
+        self.metrics.observe("pipeline", finished - started)
+        if self.tracer:
+            args = {"commands": len(self.commands), "batches": len(self.batches)}
+            self.tracer.span("pipeline", "brom", started, finished, args)
+
+        # support scalar
+        for index in self.reads:
+            value = values.get(index, [])
+            self.results.append(value[0] if len(value) == 1 else value)
+
+        self.batches = []
+        return self.results
+
+    # Register values read are added to `values` by command index
+    async def execute_batch(self, txbuffer, expected, values):
+        total = sum(size for _, size, _, _ in expected)
+        if txbuffer:
+            await self.transport.write(bytes(txbuffer), progress=False)
+        reply = bytes(await self.transport.read_view(total))
+
+        offset = 0
+        for kind, size, gold, index in expected:
+            chunk = bytes(reply[offset : offset + size])
+            offset += size
+            if len(chunk) < size:
+                raise self.diverged(index, "no response")
+            if kind == BromPipeline.ECHO or kind == BromPipeline.STATUS:
+                if chunk != gold:
+                    raise self.diverged(
+                        index, f"expected {as_hex(gold)} got {as_hex(chunk)}"
+                    )
+            elif kind == BromPipeline.STATUS_OK:
+                if from_bytes(chunk, 2) > 0xFF:
+                    raise self.diverged(index, f"status is {as_hex(chunk)}")
+            else:
+                values.setdefault(index, []).append(from_bytes(chunk, size))
@@ -0,0 +1,89 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+
+# Receive buffer with read/write cursors. Incoming data is appended at
+# `tail` and consumed from `head`, so reading does not rebuild the whole
+# buffer like `array[size:]` used to do. The storage is allocated once
+# and only grows when a single read asks for more than it can hold.
+class RxBuffer:
+    DEFAULT_CAPACITY = 64 * 1024
+    MAX_FILL_SIZE = 1024 * 1024  # Upper limit for a single bulk transfer
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.data = bytearray(capacity)
+        self.view = memoryview(self.data)
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def clear(self):
+        self.head = 0
+        self.tail = 0
+
+    # Make sure there are at least `size` bytes of free space after `tail`.
+    # Unread bytes are moved to the beginning of the storage, and the
+    # storage is replaced with a bigger one only if it's still too small.
+    # Moving the unread bytes overwrites the storage, so views returned by
+    # `take_view` are only valid until the next call that modifies the
+    # buffer.
+    def reserve(self, size):
+        if len(self.data) - self.tail >= size:
+            return
+
+        pending = len(self)
+        capacity = len(self.data)
+        while capacity < pending + size:
+            capacity *= 2
+
+        if capacity != len(self.data):
+            data = bytearray(capacity)
+            data[:pending] = self.view[self.head : self.tail]
+            self.data = data
+            self.view = memoryview(self.data)
+        elif pending:
+            # the regions may overlap, copy the (usually tiny) leftover first
+            self.data[:pending] = bytes(self.view[self.head : self.tail])
+        self.head = 0
+        self.tail = pending
+
+    # Append bytes received from a transport
+    def append(self, chunk):
+        size = len(chunk)
+        self.reserve(size)
+        self.view[self.tail : self.tail + size] = chunk
+        self.tail += size
+
+    # Fill the buffer until it holds at least `size` bytes. `source` is a
+    # callable that receives the maximum amount of bytes to fetch and
+    # returns a bytes-like object, or an empty one when no more data can be
+    # read. The requested amount is rounded up to `granularity` (usually
+    # the endpoint's wMaxPacketSize) so a device that replies with full
+    # packets can complete the transfer without waiting for the timeout.
+    def fill(self, size, source, granularity=1):
+        while self.tail - self.head < size:
+            missing = size - (self.tail - self.head)
+            request = -(-missing // granularity) * granularity
+            request = min(request, max(RxBuffer.MAX_FILL_SIZE, granularity))
+            chunk = source(request)
+            if not chunk:
+                break
+            self.append(chunk)
+        return self.tail - self.head >= size
+
+    # Consume up to `size` bytes and return them as a memoryview without
+    # copying. The view is only valid until the next call that modifies
+    # the buffer; use `take` to get an independent `bytes` object.
+    def take_view(self, size):
+        head = self.head
+        end = min(head + size, self.tail)
+        self.head = end
+        if end == self.tail:  # rewind the cursors when empty
+            self.head = 0
+            self.tail = 0
+        return self.view[head:end]
+
+    def take(self, size):
+        return bytes(self.take_view(size))
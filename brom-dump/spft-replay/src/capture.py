@@ -0,0 +1,158 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import struct
+import time
+
+# pcapng block types
+SHB_TYPE = 0x0A0D0D0A  # Section Header Block
+IDB_TYPE = 0x00000001  # Interface Description Block
+EPB_TYPE = 0x00000006  # Enhanced Packet Block
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# Same link type Wireshark uses for Linux usbmon captures (64-byte header)
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+OPT_ENDOFOPT = 0
+OPT_IF_NAME = 2
+OPT_IF_TSRESOL = 9
+
+USBMON_SUBMIT = ord("S")
+USBMON_COMPLETE = ord("C")
+USBMON_XFER_BULK = 3
+USBMON_NO_SETUP = b"-"
+USBMON_DATA_PRESENT = b"\x00"
+USBMON_NO_DATA_IN = b"<"
+USBMON_NO_DATA_OUT = b">"
+
+# struct usbmon_packet from linux/Documentation/usb/usbmon.rst
+USBMON_HEADER = struct.Struct("<QBBBBHccqiiII8siiII")
+
+
+def pad4(size):
+    return -size % 4
+
+
+def pcapng_option(code, value):
+    return struct.pack("<HH", code, len(value)) + value + b"\x00" * pad4(len(value))
+
+
+def pcapng_block(block_type, body):
+    total = 12 + len(body)
+    return struct.pack("<II", block_type, total) + body + struct.pack("<I", total)
+
+
+# Record raw transport traffic into a pcapng file that Wireshark opens as
+# a usbmon capture. Each transfer is stored as a pair of Submit/Complete
+# URBs just like the kernel does, with the payload attached to the Submit
+# URB for OUT transfers and to the Complete URB for IN transfers.
+class PcapngCapture:
+    def __init__(self, path, busnum=1, devnum=1):
+        self.path = path
+        self.busnum = busnum
+        self.devnum = devnum
+        self.urb_id = 0
+        self.fos = open(path, "wb")
+        self.write_headers()
+
+    def write_headers(self):
+        shb = struct.pack("<IHHq", BYTE_ORDER_MAGIC, 1, 0, -1)
+        shb += pcapng_option(OPT_ENDOFOPT, b"")
+        self.fos.write(pcapng_block(SHB_TYPE, shb))
+
+        idb = struct.pack("<HHI", LINKTYPE_USB_LINUX_MMAPPED, 0, 0)
+        idb += pcapng_option(OPT_IF_NAME, b"usbmon")
+        idb += pcapng_option(OPT_IF_TSRESOL, b"\x06")  # microseconds
+        idb += pcapng_option(OPT_ENDOFOPT, b"")
+        self.fos.write(pcapng_block(IDB_TYPE, idb))
+
+    # Set bus and device numbers shown by Wireshark, e.g. after the
+    # transport has found the device.
+    def set_device(self, busnum, devnum):
+        self.busnum = busnum
+        self.devnum = devnum
+
+    def write_urb(self, urb_type, endpoint, timestamp, status, length, data, flag):
+        ts_sec = int(timestamp)
+        ts_usec = int((timestamp - ts_sec) * 1000000)
+        header = USBMON_HEADER.pack(
+            self.urb_id,
+            urb_type,
+            USBMON_XFER_BULK,
+            endpoint,
+            self.devnum,
+            self.busnum,
+            USBMON_NO_SETUP,
+            flag,
+            ts_sec,
+            ts_usec,
+            status,
+            length,
+            len(data),
+            b"\x00" * 8,
+            0,
+            0,
+            0,
+            0,
+        )
+        packet = header + bytes(data)
+
+        ts = ts_sec * 1000000 + ts_usec
+        epb = struct.pack(
+            "<IIIII", 0, ts >> 32, ts & 0xFFFFFFFF, len(packet), len(packet)
+        )
+        epb += packet + b"\x00" * pad4(len(packet))
+        epb += pcapng_option(OPT_ENDOFOPT, b"")
+        self.fos.write(pcapng_block(EPB_TYPE, epb))
+
+    # Record a host-to-device transfer
+    def record_out(self, endpoint, data, submitted_at, status=0):
+        completed_at = time.time()
+        self.urb_id += 1
+        self.write_urb(
+            USBMON_SUBMIT,
+            endpoint & 0x7F,
+            submitted_at,
+            -115,  # -EINPROGRESS, as reported by usbmon for pending URBs
+            len(data),
+            data,
+            USBMON_DATA_PRESENT,
+        )
+        self.write_urb(
+            USBMON_COMPLETE,
+            endpoint & 0x7F,
+            completed_at,
+            status,
+            len(data),
+            b"",
+            USBMON_NO_DATA_OUT,
+        )
+
+    # Record a device-to-host transfer. `requested` is the buffer size
+    # passed to the transfer, `data` is what the device actually sent.
+    def record_in(self, endpoint, requested, data, submitted_at, status=0):
+        completed_at = time.time()
+        self.urb_id += 1
+        self.write_urb(
+            USBMON_SUBMIT,
+            endpoint | 0x80,
+            submitted_at,
+            -115,
+            requested,
+            b"",
+            USBMON_NO_DATA_IN,
+        )
+        self.write_urb(
+            USBMON_COMPLETE,
+            endpoint | 0x80,
+            completed_at,
+            status,
+            len(data),
+            data,
+            USBMON_DATA_PRESENT,
+        )
+
+    def close(self):
+        if self.fos:
+            self.fos.close()
+            self.fos = None
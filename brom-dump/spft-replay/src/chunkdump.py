@@ -0,0 +1,162 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import json
+import logging
+import os
+import struct
+import zlib
+
+from src.common import as_0x, from_bytes
+from src.receiver import MAGIC_GOODBYE, DumpFile
+
+# Protocol of the usb-dump-chunked piggyback, see
+# `payloads/src/piggyback/usb-dump-chunked.c`. After the HELLO the
+# payload sends its region table, then the host requests chunks:
+#     -> CMD_READ, region, offset, length
+#     <- region, offset, length, data, CRC32 of the data
+# and finishes with GOODBYE. All words are big-endian.
+CMD_READ = 0x52454144  # READ
+CHUNK_REQUEST = struct.Struct(">IIII")
+CHUNK_HEADER = struct.Struct(">III")
+CHUNK_SIZE = 0x10000  # MAX_CHUNK_LENGTH of the payload
+MAX_ATTEMPTS = 5
+DRAIN_TIMEOUT = 100  # ms
+STATE_FILE = "dump-state.json"
+
+
+# Progress of a chunked dump saved in OUTPUT_DIR/dump-state.json after
+# every chunk: the region table and how many bytes of each region have
+# been verified. A dump interrupted by a timeout or an unplugged cable is
+# resumed by running the same replay again with the same output directory.
+class DumpState:
+    def __init__(self, path, regions):
+        self.path = path
+        self.regions = regions
+        self.verified = [0] * len(regions)
+
+    @staticmethod
+    def load(path, regions):
+        state = DumpState(path, regions)
+        try:
+            with open(path) as fis:
+                saved = json.load(fis)
+        except (OSError, ValueError):
+            return state
+        if [tuple(region) for region in saved.get("regions", [])] != regions:
+            logging.warning(f"{path} belongs to other regions, starting over")
+            return state
+        state.verified = saved["verified"]
+        return state
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as fos:
+            json.dump({"regions": self.regions, "verified": self.verified}, fos)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# Receives a chunked dump after the HELLO sequence and its flags. Every
+# chunk is checked against the request and its CRC32; a bad, short or
+# missing chunk is requested again, up to MAX_ATTEMPTS times.
+class ChunkedReceiver:
+    def __init__(self, brom, output_dir, chunk_size=CHUNK_SIZE):
+        self.brom = brom
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.retries = 0
+
+    def receive(self):
+        count = self.read_word()
+        regions = [(self.read_word(), self.read_word()) for _ in range(count)]
+        state = DumpState.load(os.path.join(self.output_dir, STATE_FILE), regions)
+
+        dumps = []
+        for idx, (addr, size) in enumerate(regions):
+            path = os.path.join(self.output_dir, f"dump-{idx + 1}.bin")
+            verified = state.verified[idx]
+            if verified and not os.path.exists(path):
+                verified = 0
+            if verified:
+                logging.info(f"Resuming {path} after {verified} out of {size} bytes")
+            else:
+                logging.info(f"Reading {size} bytes at {as_0x(addr)} into {path}")
+
+            with DumpFile(path, size, resume_from=verified) as dump:
+                while verified < size:
+                    length = min(self.chunk_size, size - verified)
+                    dump.write(self.fetch(idx, verified, length))
+                    verified += length
+                    state.verified[idx] = verified
+                    state.save()
+            dumps.append(dump)
+
+        self.brom.just_write(MAGIC_GOODBYE.to_bytes(4, "big"))
+        if self.read_word() != MAGIC_GOODBYE:
+            logging.warning("Expected GOODBYE sequence")
+        else:
+            logging.info("Received GOODBYE sequence")
+        if self.retries:
+            logging.warning(f"{self.retries} chunks had to be requested again")
+        state.remove()
+        return dumps
+
+    def read_word(self):
+        data = self.brom.just_read(4)
+        if len(data) < 4:
+            raise RuntimeError("Device stopped sending data")
+        return from_bytes(data, 4)
+
+    # Read exactly `size` bytes, fewer only if the device stops sending
+    def read_exactly(self, size):
+        result = bytearray()
+        while len(result) < size:
+            data = self.brom.just_read_view(size - len(result))
+            if not data:
+                break
+            result += data
+        return result
+
+    # Throw away whatever is left of a failed chunk
+    def drain(self):
+        while self.brom.just_read_view(self.chunk_size, timeout=DRAIN_TIMEOUT):
+            pass
+
+    # Request a chunk once. Returns its data, or None and what went wrong.
+    def request(self, region, offset, length):
+        self.brom.just_write(CHUNK_REQUEST.pack(CMD_READ, region, offset, length))
+        header = self.read_exactly(CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            return None, "no reply"
+        if CHUNK_HEADER.unpack(header) != (region, offset, length):
+            return None, f"reply to another request {CHUNK_HEADER.unpack(header)}"
+        data = self.read_exactly(length + 4)
+        if len(data) < length + 4:
+            return None, f"only {len(data)} out of {length + 4} bytes received"
+        (crc,) = struct.unpack_from(">I", data, length)
+        if zlib.crc32(memoryview(data)[:length]) != crc:
+            return None, "CRC mismatch"
+        return data[:length], None
+
+    def fetch(self, region, offset, length):
+        for attempt in range(MAX_ATTEMPTS):
+            data, error = self.request(region, offset, length)
+            if error is None:
+                return data
+            logging.warning(
+                f"Chunk of region {region + 1} at {as_0x(offset)}: {error}, "
+                f"attempt {attempt + 1} out of {MAX_ATTEMPTS}"
+            )
+            self.retries += 1
+            self.brom.metrics.increment("chunk_retries")
+            self.drain()
+        raise RuntimeError(
+            f"Could not receive {length} bytes of region {region + 1} at "
+            f"{as_0x(offset)}, run the replay again to resume the dump"
+        )
@@ -4,8 +4,41 @@
 # SPDX-FileContributor: arzamas-16 <https://github.com/arzamas-16>
 
 import logging
+import mmap
 import struct
 import time
+from functools import partial, partialmethod
+
+LOG_LEVEL_REPLAY = logging.INFO + 1
+LOG_LEVEL_BROM_CMD = logging.INFO - 1
+LOG_LEVEL_BROM_IO = logging.DEBUG - 1
+
+
+# Add some logging levels. Source: https://stackoverflow.com/a/55276759
+# Every entry point calls this, only the first call patches `logging`.
+def add_log_levels():
+    if hasattr(logging, "REPLAY"):
+        return
+    logging.REPLAY = LOG_LEVEL_REPLAY
+    logging.addLevelName(logging.REPLAY, "REPLAY")
+    logging.Logger.replay = partialmethod(logging.Logger.log, logging.REPLAY)
+    logging.replay = partial(logging.log, logging.REPLAY)
+
+    logging.BROM = LOG_LEVEL_BROM_CMD
+    logging.addLevelName(logging.BROM, "BROM CMD")
+    logging.Logger.brom = partialmethod(logging.Logger.log, logging.BROM)
+    logging.brom = partial(logging.log, logging.BROM)
+
+    logging.BROM_IO = LOG_LEVEL_BROM_IO
+    logging.addLevelName(logging.BROM_IO, "BROM I/O")
+    logging.Logger.BROM_IO = partialmethod(logging.Logger.log, logging.BROM_IO)
+    logging.brom_io = partial(logging.log, logging.BROM_IO)
+
+
+# Map a file into memory read-only, e.g. a payload that is sent in chunks
+def map_file(path):
+    with open(path, "rb") as fis:
+        return mmap.mmap(fis.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 def bit(n):
@@ -32,6 +65,18 @@ def from_bytes(value, size=1, endian=">"):
     }.get(size, lambda: raise_(RuntimeError("invalid size")))()
 
 
+# Run a coroutine that never suspends without an event loop. This is how
+# the synchronous API drives the asynchronous implementation when the
+# underlying transport is synchronous.
+def run_sync(coro):
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("Coroutine has suspended, it needs an event loop")
+
+
 # Represent an object as hex string
 def as_hex(obj, size=4):
     if isinstance(obj, list) or isinstance(obj, tuple):
@@ -0,0 +1,194 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+
+from src.metrics import Metrics, accumulate_metrics
+from src.orchestrator import LOG_FORMAT, create_transport, execute_job, make_job
+
+# Long-running spft-replay service. The libusb backend is initialized
+# once and jobs are accepted over a Unix socket, so stations processing
+# many boards don't pay the startup and teardown costs for every one.
+#
+# The protocol is newline-delimited JSON. A client connects, sends a job
+# (the arguments of `src.orchestrator.make_job`) and receives messages
+# until the result, then the daemon closes the connection:
+#     {"type": "queued", "position": 1}
+#     {"type": "log", "level": 21, "message": "[...] <REPLAY> Identify"}
+#     {"type": "result", "result": {"status": "ok", ...}}
+# Invalid jobs and jobs the daemon could not run to the end are answered
+# with {"type": "error", "message": "..."}.
+
+
+# Connection of a client waiting for its job
+class JobClient:
+    def __init__(self, sock, job):
+        self.sock = sock
+        self.job = job
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode()
+        try:
+            with self.lock:
+                self.sock.sendall(data)
+        except OSError:
+            pass  # the client has gone away, finish the job anyway
+
+
+# Forward log records of a job to its client. Jobs run in worker threads,
+# so records are matched with jobs by the thread that emitted them. The
+# log level of every job is applied here, see `ReplayDaemon.set_client`.
+class JobLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.clients = {}  # thread ID -> JobClient
+        self.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    def emit(self, record):
+        client = self.clients.get(record.thread)
+        if client and record.levelno >= client.job["log_level"]:
+            client.send(
+                {"type": "log", "level": record.levelno, "message": self.format(record)}
+            )
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            job = make_job(**json.loads(self.rfile.readline()))
+        except (ValueError, TypeError, RuntimeError) as e:
+            JobClient(self.request, None).send({"type": "error", "message": str(e)})
+            return
+        client = JobClient(self.request, job)
+        self.server.daemon.submit(client)
+        client.done.wait()
+
+
+class ReplayDaemon:
+    def __init__(self, socket_path, workers=1, metrics_path=None):
+        self.socket_path = socket_path
+        self.workers = workers
+        self.metrics_path = metrics_path
+        self.metrics_lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.backend = None
+        self.server = None
+        self.log_handler = JobLogHandler()
+        self.console_level = logging.root.level
+        self.level_lock = threading.Lock()
+
+    def submit(self, client):
+        self.jobs.put(client)
+        client.send({"type": "queued", "position": self.jobs.qsize()})
+
+    # Register the client of the job of this thread, None once it is done.
+    # The root logger lets through what the console or any running job
+    # wants and every handler drops the rest. Keeping it no lower than that
+    # spares the BROM I/O logging of the other sessions.
+    def set_client(self, client):
+        with self.level_lock:
+            if client:
+                self.log_handler.clients[threading.get_ident()] = client
+            else:
+                del self.log_handler.clients[threading.get_ident()]
+            clients = self.log_handler.clients.values()
+            levels = [client.job["log_level"] for client in clients]
+            logging.root.setLevel(min([self.console_level] + levels))
+
+    # Run jobs until the daemon stops. Whatever happens to a job, its client
+    # gets an answer and the worker goes on with the next one.
+    def worker(self):
+        while True:
+            client = self.jobs.get()
+            job = client.job
+            device = job["path"] or "any device"
+            logging.info(f"Starting {job['mode']} job for {device}")
+            self.set_client(client)
+            try:
+                # Waiting for the next device replaces the settle delay
+                transport = create_transport(job, backend=self.backend, reset_delay=0)
+                result = execute_job(job, transport)
+                logging.info(f"Job has finished: {result['status']}")
+                if self.metrics_path:
+                    self.save_metrics(result["metrics"])
+                client.send({"type": "result", "result": result})
+            except Exception as e:
+                logging.error("Job has failed", exc_info=True)
+                client.send({"type": "error", "message": str(e)})
+            finally:
+                self.set_client(None)
+                client.done.set()
+
+    def save_metrics(self, values):
+        try:
+            with self.metrics_lock:
+                accumulate_metrics(self.metrics_path, Metrics.from_dict(values))
+        except OSError:
+            logging.error(
+                f"Could not save metrics to {self.metrics_path}", exc_info=True
+            )
+
+    def serve_forever(self):
+        import usb.backend.libusb1
+
+        logging.info("Init backend")
+        self.backend = usb.backend.libusb1.get_backend()
+        if not self.backend:
+            logging.warning("Could not initialize the libusb1 backend")
+
+        # Replace a socket left over by a daemon that has crashed
+        if os.path.exists(self.socket_path):
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                raise RuntimeError(f"{self.socket_path} exists and is not a socket")
+            os.unlink(self.socket_path)
+
+        # Records of jobs logging more than the daemon only go to the jobs
+        for handler in logging.root.handlers:
+            handler.setLevel(max(handler.level, self.console_level))
+        logging.root.addHandler(self.log_handler)
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, JobRequestHandler
+        )
+        self.server.daemon_threads = True
+        self.server.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        logging.info(f"Listening on {self.socket_path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket_path)
+            logging.root.removeHandler(self.log_handler)
+
+
+# Send a job to the daemon and print its log as it arrives. Returns the
+# result of the job.
+def submit_job(socket_path, job):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(job) + "\n").encode())
+        for line in sock.makefile("r"):
+            message = json.loads(line)
+            if message["type"] == "queued":
+                logging.info(f"Job queued at position {message['position']}")
+            elif message["type"] == "log":
+                print(message["message"], flush=True)
+            elif message["type"] == "error":
+                raise RuntimeError(
+                    f"Daemon could not run the job: {message['message']}"
+                )
+            elif message["type"] == "result":
+                return message["result"]
+    raise RuntimeError("Daemon has closed the connection")
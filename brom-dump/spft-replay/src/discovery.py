@@ -0,0 +1,141 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import logging
+import time
+
+from src.common import as_hex
+
+BROM_VID = 0x0E8D
+BROM_PID = 0x0003
+
+
+# Physical location of a USB device as "bus-port.port...". Unlike the
+# device address it doesn't change when the device re-enumerates, so it
+# can be used to tell several connected phones apart.
+def usb_device_path(device):
+    ports = device.port_numbers or ()
+    return f"{device.bus}-{'.'.join(str(port) for port in ports)}"
+
+
+# Same as `usb_device_path` for a python-libusb1 device
+def libusb1_device_path(device):
+    ports = device.getPortNumberList() or ()
+    return f"{device.getBusNumber()}-{'.'.join(str(port) for port in ports)}"
+
+
+# All connected devices in BROM mode
+def find_brom_devices(backend=None):
+    # pyusb is only loaded when a real device is needed
+    import usb.core
+
+    return list(
+        usb.core.find(
+            find_all=True, idVendor=BROM_VID, idProduct=BROM_PID, backend=backend
+        )
+    )
+
+
+# Wait for a device in BROM mode to show up. BROM only listens for a
+# short time before the watchdog or the preloader takes over, so the
+# device has to be noticed as soon as it enumerates.
+#
+# libusb hotplug events are used when python-libusb1 is installed and the
+# platform supports them. Otherwise the bus is polled, with the interval
+# adapted to the time a scan takes so polling costs at most
+# POLL_DUTY_CYCLE of a CPU while still reacting within milliseconds.
+#
+# `arrived_at` is the time.monotonic() timestamp of the moment the device
+# has been noticed, e.g. for measuring arrival-to-handshake latency.
+class DeviceWatcher:
+    MIN_POLL_INTERVAL = 0.002  # seconds
+    MAX_POLL_INTERVAL = 0.25
+    POLL_DUTY_CYCLE = 0.05
+    HOTPLUG_TIMEOUT = 0.25  # wake up now and then to handle Ctrl+C
+
+    # A watcher is created for every session, the fallback to polling is
+    # only reported once
+    polling_reported = False
+
+    def __init__(self, backend=None, path=None):
+        self.backend = backend
+        self.path = path
+        self.arrived_at = None
+        self.method = None
+
+    def matches(self, path):
+        return not self.path or path == self.path
+
+    def wait(self):
+        logging.info(
+            f"Waiting for device in BROM mode "
+            f"({as_hex(BROM_VID, 2)}:{as_hex(BROM_PID, 2)})"
+            + (f" at {self.path}" if self.path else "")
+        )
+        path = self.wait_hotplug()
+        device = self.wait_polling(path)
+        logging.info(f"Found device at {usb_device_path(device)} ({self.method})")
+        return device
+
+    # Returns the path of the arrived device, or None if hotplug events
+    # are not available
+    def wait_hotplug(self):
+        try:
+            import usb1
+        except ImportError:
+            self.report_polling("the libusb1 package is not installed")
+            return None
+        if not usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+            self.report_polling("not supported by libusb on this platform")
+            return None
+
+        arrived = []
+
+        def on_arrival(context, device, event):
+            path = libusb1_device_path(device)
+            if self.matches(path):
+                arrived.append((time.monotonic(), path))
+            return False  # keep the callback registered
+
+        with usb1.USBContext() as context:
+            # Devices that are already connected are reported right away
+            handle = context.hotplugRegisterCallback(
+                on_arrival,
+                events=usb1.HOTPLUG_EVENT_DEVICE_ARRIVED,
+                flags=usb1.HOTPLUG_ENUMERATE,
+                vendor_id=BROM_VID,
+                product_id=BROM_PID,
+            )
+            while not arrived:
+                context.handleEventsTimeout(DeviceWatcher.HOTPLUG_TIMEOUT)
+            context.hotplugDeregisterCallback(handle)
+
+        self.arrived_at, path = arrived[0]
+        self.method = "hotplug"
+        return path
+
+    def report_polling(self, reason):
+        if not DeviceWatcher.polling_reported:
+            logging.info(f"Hotplug events are unavailable ({reason}), polling the bus")
+            DeviceWatcher.polling_reported = True
+
+    # Poll the bus until a matching device shows up. Also used to get a
+    # pyusb device after a hotplug event, then it should be found at once.
+    def wait_polling(self, path=None):
+        interval = DeviceWatcher.MIN_POLL_INTERVAL
+        while True:
+            started = time.monotonic()
+            for device in find_brom_devices(self.backend):
+                if self.matches(usb_device_path(device)) and (
+                    not path or usb_device_path(device) == path
+                ):
+                    if not self.method:
+                        self.arrived_at = time.monotonic()
+                        self.method = f"polling every {interval * 1000:.0f} ms"
+                    return device
+            scan_time = time.monotonic() - started
+
+            interval = scan_time / DeviceWatcher.POLL_DUTY_CYCLE
+            interval = max(interval, DeviceWatcher.MIN_POLL_INTERVAL)
+            interval = min(interval, DeviceWatcher.MAX_POLL_INTERVAL)
+            time.sleep(interval)
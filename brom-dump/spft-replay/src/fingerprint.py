@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from src.common import as_hex
+
+CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "spft-replay",
+    "fingerprints.json",
+)
+DEFAULT_TTL = 30 * 24 * 60 * 60  # seconds
+DEFAULT_MAX_ENTRIES = 256
+
+
+# Key of a device: its HW code and ME ID, which is unique for every chip.
+# Legacy BROM has no ME ID, so the chip revision is all we can tell apart.
+def fingerprint_key(hw_code, me_id=None, version=None):
+    if me_id is not None:
+        return f"{hw_code:04x}-{me_id.hex()}"
+    return "-".join(f"{x:04x}" for x in [hw_code] + list(version))
+
+
+# Facts about devices seen in earlier sessions, so that a known board
+# doesn't have to be identified again: the platform it was detected as,
+# its IDs and versions, the values of the registers read while it was
+# identified and the RAM sizes found (which are still verified, see
+# `src/ramsize.py`). An entry is a dict of such facts, see
+# `AbstractPlatform.facts`.
+#
+# Entries expire `ttl` seconds after the device was identified, then it
+# is identified again. The least recently seen entries are evicted when
+# there are more than `max_entries`. With `refresh` no entry is used but
+# the entries of the devices identified are still saved. The file is
+# protected by a file lock because several spft-replay processes may
+# share it.
+#
+# Usage:
+#     cache = FingerprintCache()
+#     facts = cache.get(fingerprint_key(hw_code, me_id))
+#     ...
+#     cache.put(fingerprint_key(hw_code, me_id), facts)
+class FingerprintCache:
+    def __init__(
+        self,
+        path=CACHE_PATH,
+        ttl=DEFAULT_TTL,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        refresh=False,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+
+    # Read the entries, let the caller modify them and save them back
+    @contextmanager
+    def locked_entries(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as fis:
+                    entries = json.load(fis)
+            except (OSError, ValueError):
+                entries = {}
+            yield entries
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as fos:
+                json.dump(entries, fos, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def expired(self, entry, now):
+        return now - entry["facts"].get("identified", 0) > self.ttl
+
+    # Facts about the device with `key`, None if it is not known
+    def get(self, key):
+        if self.refresh:
+            return None
+        now = time.time()
+        try:
+            with self.locked_entries() as entries:
+                entry = entries.get(key)
+                if entry is None:
+                    return None
+                if self.expired(entry, now):
+                    del entries[key]
+                    return None
+                entry["seen"] = now
+                return dict(entry["facts"])
+        except OSError:
+            logging.warning(f"Could not read {self.path}", exc_info=True)
+            return None
+
+    # Save the facts about a device. Facts without the time the device has
+    # been identified at are new.
+    def put(self, key, facts):
+        now = time.time()
+        facts.setdefault("identified", now)
+        try:
+            with self.locked_entries() as entries:
+                entries[key] = {"facts": facts, "seen": now}
+                for name in [n for n, e in entries.items() if self.expired(e, now)]:
+                    del entries[name]
+                by_age = sorted(entries, key=lambda name: entries[name]["seen"])
+                for name in by_age[: max(len(entries) - self.max_entries, 0)]:
+                    del entries[name]
+        except OSError:
+            logging.warning(f"Could not save {self.path}", exc_info=True)
+
+
+# Log the facts of a known device like identification would
+def describe_facts(facts):
+    if facts.get("me_id"):
+        yield f"ME ID: {facts['me_id'].upper()}"
+    if facts.get("version"):
+        version = ", ".join(as_hex(x, 2) for x in facts["version"])
+        yield f"HW subcode, HW version, SW version: {version}"
+    if "brom_version" in facts:
+        yield f"BROM version: {as_hex(facts['brom_version'], 1)}"
+    for addr, value in facts.get("registers", {}).items():
+        yield f"{addr}: {as_hex(value)}"
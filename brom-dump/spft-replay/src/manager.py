@@ -2,19 +2,61 @@
 # SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
 
 import logging
+import os
+from contextlib import contextmanager
 
+from src.chunkdump import ChunkedReceiver
 from src.common import as_hex, from_bytes, target_config_to_string
-from src.platform import MT6252, MT6573, MT6577, MT6580, MT6582, MT6589
+from src.fingerprint import describe_facts, fingerprint_key
+from src.receiver import (
+    HELLO_FLAG_CHUNKED,
+    HELLO_FLAG_RLE,
+    MAGIC_GOODBYE,
+    MAGIC_HELLO,
+    MAGIC_HELLO_FLAGS,
+    RLE_RUN,
+    DumpFile,
+)
+
+# Supported SoCs: (HW code, version) -> platform class in `src/platform.py`
+# and the name to log. Version None matches any revision, otherwise the
+# HW subcode, HW version and SW version must match.
+PLATFORMS = {
+    (0x6250, (0x8B00, 0xCF00, 0x0101)): ("MT6252", "MT6252CA"),
+    (0x6573, None): ("MT6573", None),
+    (0x6575, (0x8B00, 0xCB00, 0xE201)): ("MT6577", "MT6575E2"),
+    (0x6580, None): ("MT6580", None),
+    (0x6582, None): ("MT6582", None),
+    (0x6583, None): ("MT6589", None),  # The code is 0x6583 but the SoC is 6589
+}
+# SoCs that are identified faster than they are looked up by ME ID in the
+# fingerprint cache
+UNCACHED_HW_CODES = [0x6583]
 
 
 class DeviceManager:
-    def __init__(self, brom):
+    RECV_CHUNK_SIZE = 1024 * 1024  # Upper limit of memory used for a dump
+
+    # `fingerprints` is a FingerprintCache (see `src/fingerprint.py`) that
+    # lets known devices skip identification, None to identify every device.
+    # `lean` replays the lean profile of the platform, see `profile_rows`
+    # in `src/replay.py`.
+    def __init__(self, brom, output_dir=".", fingerprints=None, lean=False):
         self.brom = brom
+        self.output_dir = output_dir
+        self.fingerprints = fingerprints
+        self.lean = lean
+        self.fingerprint = None  # key of the device in `fingerprints`
         self.platform = None
         self.payload = None
+        self.observers = []
 
     # Print chip IDs
     def identify(self):
+        with self.stage("identify"):
+            self.identify_chip()
+
+    def identify_chip(self):
         hw_code = self.brom.get_hw_code()
 
         is_legacy = hw_code == 0x0000
@@ -55,10 +97,27 @@ class DeviceManager:
         for line in target_config_to_string(config):
             logging.info(line)
 
-    # Request chip ID and replay its traffic
-    def replay(self, payload, simple_mode, skip_remaining_data):
-        self.payload = payload
-
+    # Notify observers (e.g. benchmarks) about the stage being executed.
+    # Observers implement `stage_started(name)` and `stage_finished(name)`.
+    @contextmanager
+    def stage(self, name, description=None):
+        if description:
+            logging.replay(description)
+        for observer in self.observers:
+            observer.stage_started(name)
+        try:
+            yield
+        finally:
+            for observer in self.observers:
+                observer.stage_finished(name)
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    # Request chip ID and create a platform instance for it. With the
+    # fingerprint cache, the device is recognized by its ME ID (the chip
+    # revision on legacy BROM) and a known device is not identified again.
+    def detect_platform(self):
         hw_code = self.brom.get_hw_code()
 
         is_legacy = hw_code == 0x0000
@@ -68,103 +127,207 @@ class DeviceManager:
 
         logging.replay(f"HW code: {as_hex(hw_code, 2)}")
 
-        if hw_code == 0x6250:
-            ver = tuple(
-                [
-                    self.brom.read16(0x80010000 + x, check_status=False)
-                    for x in [0xC, 0x0, 0x4]
-                ]
-            )
-            if ver == (0x8B00, 0xCF00, 0x0101):
-                logging.replay("Detected MT6252CA")
-                self.platform = MT6252(self.brom)
-            else:
-                raise Exception(
-                    "Unsupported hardware " f"{', '.join(as_hex(x, 2) for x in ver)}"
-                )
-        elif hw_code == 0x6573:
-            self.platform = MT6573(self.brom)
-        elif hw_code == 0x6575:
-            # There are multiple revisions of mt6575 SoCs
-            ver = self.brom.get_hw_sw_ver()
-            if ver == (0x8B00, 0xCB00, 0xE201):
-                logging.replay("Detected MT6575E2")
-                self.platform = MT6577(self.brom)
+        ver = None
+        me_id = None
+        facts = None
+        if self.fingerprints and hw_code not in UNCACHED_HW_CODES:
+            if is_legacy:
+                ver = self.read_legacy_version()
             else:
+                me_id = self.brom.get_me_id()
+            self.fingerprint = fingerprint_key(hw_code, me_id, ver)
+            facts = self.fingerprints.get(self.fingerprint)
+            # Entries of another SoC with the same ME ID are no use
+            names = [name for name, _ in PLATFORMS.values()]
+            if facts and (
+                facts.get("hw_code") != hw_code or facts.get("platform") not in names
+            ):
+                facts = None
+
+        if facts:
+            name = facts["platform"]
+            self.brom.metrics.increment("fingerprint_hits")
+            logging.replay(f"Known device {self.fingerprint} ({name})")
+            for line in describe_facts(facts):
+                logging.replay(line)
+        else:
+            if self.fingerprint:
+                self.brom.metrics.increment("fingerprint_misses")
+            name = self.resolve_platform(hw_code, is_legacy, ver)
+
+        # Platform classes are only imported once a device needs one
+        from src import platform
+
+        instance = getattr(platform, name)(self.brom)
+        instance.lean = self.lean
+        if facts:
+            instance.facts = facts
+            instance.known = True
+        else:
+            instance.facts.update(platform=name, hw_code=hw_code)
+            if me_id:
+                instance.facts["me_id"] = me_id.hex()
+            if ver:
+                instance.facts["version"] = list(ver)
+        return instance
+
+    # HW subcode, HW version and SW version of a legacy device
+    def read_legacy_version(self):
+        return tuple(
+            self.brom.read16(0x80010000 + x, check_status=False)
+            for x in [0xC, 0x0, 0x4]
+        )
+
+    # Name of the platform class for a device. `ver` is read if needed
+    # and not known yet.
+    def resolve_platform(self, hw_code, is_legacy, ver=None):
+        key = (hw_code, None)
+        if key not in PLATFORMS:
+            if not any(code == hw_code for code, _ in PLATFORMS):
+                raise Exception("Unsupported hardware!")
+            # There are multiple revisions of some SoCs
+            if ver is None and is_legacy:
+                ver = self.read_legacy_version()
+            elif ver is None:
+                ver = self.brom.get_hw_sw_ver()
+            key = (hw_code, tuple(ver))
+            if key not in PLATFORMS:
                 raise Exception(
                     "Unsupported hardware " f"{', '.join(as_hex(x, 2) for x in ver)}"
                 )
-        elif hw_code == 0x6580:
-            self.platform = MT6580(self.brom)
-        elif hw_code == 0x6582:
-            self.platform = MT6582(self.brom)
-        elif hw_code == 0x6583:  # The code is 0x6583 but the SoC is 6589
-            self.platform = MT6589(self.brom)
-        else:
-            raise Exception("Unsupported hardware!")
 
-        if simple_mode:
-            logging.replay("Disable watchdog")
-            self.platform.disable_watchdog()
-        else:
-            logging.replay("Identify")
-            self.platform.identify_chip()
-
-            logging.replay("Initialize PMIC")
-            self.platform.init_pmic()
-
-            logging.replay("Disable watchdog")
-            self.platform.disable_watchdog()
-
-            logging.replay("Initialize RTC")
-            self.platform.init_rtc()
+        name, description = PLATFORMS[key]
+        if description:
+            logging.replay(f"Detected {description}")
+        return name
 
-            logging.replay("Identify software components")
-            self.platform.identify_software()
-
-            logging.replay("Initialize external memory interface")
-            self.platform.init_emi()
+    # Request chip ID and replay its traffic. `payload` is either bytes or
+    # a callable that returns the payload for the detected platform.
+    def replay(self, payload, simple_mode, skip_remaining_data):
+        with self.stage("detect_platform"):
+            self.platform = self.detect_platform()
 
-        logging.replay("Send payload")
-        self.platform.send_payload(self.payload)
+        self.payload = payload(self.platform) if callable(payload) else payload
 
-        logging.replay("Jump to payload")
-        self.platform.jump_to_payload()
+        if simple_mode:
+            stages = [("disable_watchdog", "Disable watchdog")]
+        else:
+            stages = [
+                ("identify_chip", "Identify"),
+                ("init_pmic", "Initialize PMIC"),
+                ("disable_watchdog", "Disable watchdog"),
+                ("init_rtc", "Initialize RTC"),
+                ("identify_software", "Identify software components"),
+                ("init_emi", "Initialize external memory interface"),
+            ]
+        for name, description in stages:
+            if self.platform.known and name in self.platform.QUERY_STAGES:
+                logging.replay(f"{description}: skipped, the device is known")
+                continue
+            with self.stage(name, description):
+                getattr(self.platform, name)()
+        if self.fingerprint and not simple_mode:
+            self.fingerprints.put(self.fingerprint, self.platform.facts)
+
+        with self.stage("send_payload", "Send payload"):
+            self.platform.send_payload(self.payload)
+
+        with self.stage("jump_to_payload", "Jump to payload"):
+            self.platform.jump_to_payload()
 
         if skip_remaining_data:
             logging.replay("Do not handle remaining data")
         else:
-            logging.replay("Wait for remaining data")
-            self.platform.recv_remaining_data()
+            with self.stage("recv_remaining_data", "Wait for remaining data"):
+                self.platform.recv_remaining_data()
 
     def receive_data(self):
+        with self.stage("receive_data"):
+            return self.receive_dumps()
+
+    def receive_dumps(self):
         logging.info("Waiting for custom payload response")
 
         # This function is prone to errors.
         # TODO: add more try-except!
 
+        flags = 0
         seq = from_bytes(self.brom.just_read(4), 4)
-        if seq == 0x3E4D746B:  # >Mtk
+        if seq == MAGIC_HELLO:
             logging.info("Received HELLO sequence")
+        elif seq == MAGIC_HELLO_FLAGS:
+            flags = self.read_word()
+            logging.info(f"Received HELLO sequence, flags {as_hex(flags)}")
         else:
             logging.warning(
                 f"Received invalid data {as_hex(seq)}, " "expected HELLO sequence"
             )
+        rle = bool(flags & HELLO_FLAG_RLE)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        if flags & HELLO_FLAG_CHUNKED:
+            return ChunkedReceiver(self.brom, self.output_dir).receive()
 
         idx = 1
+        dumps = []
         size = from_bytes(self.brom.just_read(4), 4)
-        while size != 0x4D746B3C:  # <Mtk
-            logging.info(f"Reading {size} bytes")
-            data = self.brom.just_read(size)
-            filename = f"dump-{idx}.bin"
-            with open(filename, "wb") as fos:
-                fos.write(data)
-            logging.info(f"Saved to {filename}")
+        while size != MAGIC_GOODBYE:
+            filename = os.path.join(self.output_dir, f"dump-{idx}.bin")
+            logging.info(f"Reading {size} bytes into {filename}")
+            with DumpFile(filename, size) as dump:
+                if rle:
+                    self.receive_rle(dump, size)
+                else:
+                    self.receive_raw(dump, size)
+            dumps.append(dump)
 
             idx += 1
             size = from_bytes(self.brom.just_read(4), 4)
 
         logging.info("Received GOODBYE sequence")
+        return dumps
+
+    def read_word(self):
+        data = self.brom.just_read(4)
+        if len(data) < 4:
+            raise RuntimeError("Device stopped sending data")
+        return from_bytes(data, 4)
+
+    # Receive `size` bytes sent as they are into `dump`
+    def receive_raw(self, dump, size):
+        remaining = size
+        while remaining:
+            chunk_sz = min(remaining, DeviceManager.RECV_CHUNK_SIZE)
+            data = self.brom.just_read_view(chunk_sz)
+            if not data:
+                raise RuntimeError(
+                    f"Device stopped sending data after "
+                    f"{dump.received} out of {dump.size} bytes"
+                )
+            dump.write(data)
+            remaining -= len(data)
+
+    # Receive a region of `size` bytes encoded by usb-dump-rle into `dump`
+    def receive_rle(self, dump, size):
+        remaining = size
+        while remaining:
+            token = self.read_word()
+            count = (token & ~RLE_RUN) * 4
+            if not count or count > remaining:
+                raise RuntimeError(
+                    f"Invalid RLE token {as_hex(token)} "
+                    f"after {dump.received} out of {size} bytes"
+                )
+            if token & RLE_RUN:
+                value = self.brom.just_read(4)
+                if len(value) < 4:
+                    raise RuntimeError("Device stopped sending data")
+                block = value * (min(count, DeviceManager.RECV_CHUNK_SIZE) // 4)
+                for offset in range(0, count, len(block)):
+                    dump.write(block[: count - offset])
+            else:
+                self.receive_raw(dump, count)
+            remaining -= count
 
     def receive_greedy(self):
         logging.info("Greedy mode! Waiting for incoming data... :)")
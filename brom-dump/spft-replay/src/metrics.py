@@ -0,0 +1,235 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import bisect
+import json
+import os
+
+# Upper bounds of the latency buckets in seconds, from a pipelined echo
+# over USB to the BROM timeout
+LATENCY_BUCKETS = [
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+]
+TRANSPORT_COUNTERS = ["bytes_in", "bytes_out", "reads", "writes", "timeouts"]
+PREFIX = "spft_replay"
+
+
+# Latency histogram with fixed buckets. `counts` has one more bucket for
+# the values above the last bound; they are not cumulative.
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    # Approximate quantile: the upper bound of the bucket it falls into
+    def quantile(self, q):
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + [float("inf")], self.counts):
+            total += count
+            if total >= rank and count:
+                return bound
+        return 0.0
+
+    def to_dict(self):
+        return {"counts": self.counts, "sum": self.sum, "count": self.count}
+
+    @staticmethod
+    def from_dict(values):
+        histogram = Histogram()
+        if len(values["counts"]) != len(histogram.counts):
+            raise RuntimeError("Metrics were saved with other latency buckets")
+        histogram.counts = list(values["counts"])
+        histogram.sum = values["sum"]
+        histogram.count = values["count"]
+        return histogram
+
+
+# Counters and latency histograms of a session. BromProtocol records the
+# latency of every command (see `src/brom.py`), transports record the
+# bytes moved and reads that have timed out, and anything else can count
+# events such as retries. Recording only updates a few numbers, so
+# metrics are always on.
+#
+# Metrics of several sessions can be merged, e.g. to aggregate all the
+# sessions of a station, and exported as JSON or in the Prometheus text
+# format.
+class Metrics:
+    def __init__(self):
+        self.sessions = 1
+        self.commands = {}  # name -> Histogram
+        self.errors = {}  # command name -> count
+        self.transport = dict.fromkeys(TRANSPORT_COUNTERS, 0)
+        self.events = {}  # name -> count
+
+    def observe(self, command, seconds):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram()
+        histogram.observe(seconds)
+
+    def error(self, command):
+        self.errors[command] = self.errors.get(command, 0) + 1
+
+    def increment(self, event, amount=1):
+        self.events[event] = self.events.get(event, 0) + amount
+
+    # A read that returns less than requested has timed out
+    def record_read(self, requested, received):
+        self.transport["reads"] += 1
+        self.transport["bytes_in"] += received
+        if received < requested:
+            self.transport["timeouts"] += 1
+
+    def record_write(self, size):
+        self.transport["writes"] += 1
+        self.transport["bytes_out"] += size
+
+    def merge(self, other):
+        self.sessions += other.sessions
+        for command, histogram in other.commands.items():
+            self.commands.setdefault(command, Histogram()).merge(histogram)
+        for command, count in other.errors.items():
+            self.errors[command] = self.errors.get(command, 0) + count
+        for counter, value in other.transport.items():
+            self.transport[counter] = self.transport.get(counter, 0) + value
+        for event, count in other.events.items():
+            self.increment(event, count)
+
+    def to_dict(self):
+        return {
+            "sessions": self.sessions,
+            "buckets": LATENCY_BUCKETS,
+            "commands": {
+                name: histogram.to_dict()
+                for name, histogram in sorted(self.commands.items())
+            },
+            "errors": dict(sorted(self.errors.items())),
+            "transport": self.transport,
+            "events": dict(sorted(self.events.items())),
+        }
+
+    @staticmethod
+    def from_dict(values):
+        metrics = Metrics()
+        metrics.sessions = values["sessions"]
+        metrics.commands = {
+            name: Histogram.from_dict(histogram)
+            for name, histogram in values["commands"].items()
+        }
+        metrics.errors = dict(values["errors"])
+        metrics.transport.update(values["transport"])
+        metrics.events = dict(values["events"])
+        return metrics
+
+    def to_prometheus(self):
+        lines = []
+
+        def family(name, kind, description):
+            lines.append(f"# HELP {PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+        family("sessions_total", "counter", "Sessions the metrics were taken from")
+        lines.append(f"{PREFIX}_sessions_total {self.sessions}")
+
+        name = f"{PREFIX}_command_duration_seconds"
+        family("command_duration_seconds", "histogram", "Latency of BROM commands")
+        for command, histogram in sorted(self.commands.items()):
+            total = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                total += count
+                labels = f'command="{command}",le="{bound}"'
+                lines.append(f"{name}_bucket{{{labels}}} {total}")
+            lines.append(
+                f'{name}_bucket{{command="{command}",le="+Inf"}} {histogram.count}'
+            )
+            lines.append(f'{name}_sum{{command="{command}"}} {histogram.sum:.9f}')
+            lines.append(f'{name}_count{{command="{command}"}} {histogram.count}')
+
+        family("command_errors_total", "counter", "BROM commands that have failed")
+        name = f"{PREFIX}_command_errors_total"
+        for command, count in sorted(self.errors.items()):
+            lines.append(f'{name}{{command="{command}"}} {count}')
+
+        family("transport_total", "counter", "Transport reads, writes and bytes")
+        for counter, value in self.transport.items():
+            lines.append(f'{PREFIX}_transport_total{{counter="{counter}"}} {value}')
+
+        family("events_total", "counter", "Retries and other events")
+        for event, count in sorted(self.events.items()):
+            lines.append(f'{PREFIX}_events_total{{event="{event}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    # Save as `path` (JSON) and `path` with a .prom extension (Prometheus)
+    def save(self, path):
+        prom_path = os.path.splitext(path)[0] + ".prom"
+        for target, text in (
+            (path, json.dumps(self.to_dict(), indent=1)),
+            (prom_path, self.to_prometheus()),
+        ):
+            tmp_path = f"{target}.tmp"
+            with open(tmp_path, "w") as fos:
+                fos.write(text)
+            os.replace(tmp_path, target)
+
+    @staticmethod
+    def load(path):
+        with open(path) as fis:
+            return Metrics.from_dict(json.load(fis))
+
+    # One line per command for the log, slowest first
+    def summary(self):
+        commands = sorted(
+            self.commands.items(), key=lambda item: item[1].sum, reverse=True
+        )
+        for command, histogram in commands:
+            yield (
+                f"{command}: {histogram.count} calls, {histogram.sum * 1000:.1f} ms, "
+                f"p50 <= {histogram.quantile(0.5) * 1000:g} ms, "
+                f"p99 <= {histogram.quantile(0.99) * 1000:g} ms"
+            )
+        transport = self.transport
+        yield (
+            f"transport: {transport['reads']} reads, {transport['writes']} writes, "
+            f"{transport['bytes_in']} bytes in, {transport['bytes_out']} bytes out, "
+            f"{transport['timeouts']} timeouts"
+        )
+
+
+# Add `metrics` to the totals saved in `path`, e.g. all the sessions of
+# a station. The totals are created on first use.
+def accumulate_metrics(path, metrics):
+    try:
+        totals = Metrics.load(path)
+    except FileNotFoundError:
+        totals = Metrics()
+        totals.sessions = 0
+    totals.merge(metrics)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    totals.save(path)
+    return totals
@@ -0,0 +1,222 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import json
+import logging
+import os
+import time
+
+from src.brom import BromProtocol
+from src.common import add_log_levels, map_file
+from src.fingerprint import FingerprintCache
+from src.manager import DeviceManager
+from src.metrics import Metrics, accumulate_metrics
+from src.payload_cache import cached_payload
+from src.simulator import SimulatedDevice, SimulatedTransport
+from src.trace import Tracer
+from src.transport import UsbTransport
+
+LOG_FORMAT = "[%(asctime)s] <%(levelname)s> %(message)s"
+
+
+# Description of a session, passed to worker processes and sent to the
+# daemon (see `src/daemon.py`), hence a plain dict. `path` is the USB
+# port path of the device, or None to take the first device found.
+def make_job(
+    path,
+    output_dir,
+    mode,
+    payload_path=None,
+    payload_name=None,
+    simple_mode=False,
+    skip_remaining_data=False,
+    receive=False,
+    simulate_hw_code=None,
+    simulate_link="high-speed",
+    trace=False,
+    fresh=False,
+    lean=False,
+    log_level=logging.INFO,
+):
+    if mode not in ("identify", "payload"):
+        raise RuntimeError(f"Unknown mode {mode}")
+    if mode == "payload" and not (payload_path or payload_name):
+        raise RuntimeError("Payload mode requires a payload")
+    return {
+        "path": path,
+        "output_dir": os.path.abspath(output_dir),
+        "mode": mode,
+        "payload_path": os.path.abspath(payload_path) if payload_path else None,
+        "payload_name": payload_name,
+        "simple_mode": simple_mode,
+        "skip_remaining_data": skip_remaining_data,
+        "receive": receive,
+        "simulate_hw_code": simulate_hw_code,
+        "simulate_link": simulate_link,
+        "trace": trace,
+        "fresh": fresh,
+        "lean": lean,
+        "log_level": log_level,
+    }
+
+
+# Transport for a job. `options` are passed to UsbTransport.
+def create_transport(job, **options):
+    if job["simulate_hw_code"]:
+        device = SimulatedDevice(job["simulate_hw_code"])
+        return SimulatedTransport(device, job["simulate_link"])
+    return UsbTransport(job["path"], **options)
+
+
+# Run a job (see `run_session`) over `transport` and return its result.
+# Errors are logged and reported in the result, along with the metrics of
+# the session (see `src/metrics.py`). With `trace` set the timeline of
+# the session is saved to OUTPUT_DIR/trace.json (see `src/trace.py`).
+def execute_job(job, transport):
+    output_dir = job["output_dir"]
+    result = {
+        "path": job["path"],
+        "status": "ok",
+        "error": None,
+        "platform": None,
+        "handshake_latency": None,
+        "dumps": [],
+    }
+    started = time.monotonic()
+
+    manager = None
+    brom = None
+    tracer = Tracer() if job.get("trace") else None
+    try:
+        transport.start()
+        brom = BromProtocol(transport)
+        if tracer:
+            brom.set_tracer(tracer)
+        brom.handshake()
+        result["handshake_latency"] = time.monotonic() - transport.arrived_at
+
+        # A simulated device would pass for every real board of its model
+        fingerprints = None
+        if not job["simulate_hw_code"]:
+            fingerprints = FingerprintCache(refresh=job.get("fresh", False))
+        manager = DeviceManager(brom, output_dir, fingerprints, job.get("lean", False))
+        if tracer:
+            manager.add_observer(tracer)
+        if job["mode"] == "identify":
+            manager.identify()
+        else:
+            if job["payload_name"]:
+                payload = cached_payload(job["payload_name"])
+            else:
+                payload = map_file(job["payload_path"])
+            manager.replay(payload, job["simple_mode"], job["skip_remaining_data"])
+            if job["receive"]:
+                for dump in manager.receive_data():
+                    result["dumps"].append(
+                        {
+                            "file": os.path.basename(dump.path),
+                            "size": dump.received,
+                            "crc32": f"{dump.crc32:08X}",
+                            "sha256": dump.sha256.hexdigest(),
+                        }
+                    )
+    except Exception as e:
+        logging.critical("Session error!", exc_info=True)
+        result["status"] = "failed"
+        result["error"] = str(e)
+    finally:
+        if manager and manager.platform:
+            result["platform"] = type(manager.platform).__name__
+        try:
+            transport.stop()
+        except Exception:
+            logging.warning("Could not stop transport", exc_info=True)
+        if tracer:
+            tracer.save(
+                os.path.join(output_dir, "trace.json"),
+                result["platform"] or job["path"] or "spft-replay",
+            )
+
+    result["elapsed"] = time.monotonic() - started
+    result["metrics"] = (brom.metrics if brom else Metrics()).to_dict()
+    return result
+
+
+# Session of a single device in multi-device mode. `job` is a dict with
+# the device path and the options of spft-replay; it must be picklable
+# because the session runs in a worker process. The log and the dumps
+# and the metrics of the session are saved to `job["output_dir"]`.
+def run_session(job):
+    output_dir = job["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+
+    add_log_levels()
+    handler = logging.FileHandler(os.path.join(output_dir, "session.log"))
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.basicConfig(level=job["log_level"], handlers=[handler], force=True)
+
+    result = execute_job(job, create_transport(job))
+    Metrics.from_dict(result.pop("metrics")).save(
+        os.path.join(output_dir, "metrics.json")
+    )
+    with open(os.path.join(output_dir, "result.json"), "w") as fos:
+        json.dump(result, fos, indent=2)
+    return result
+
+
+# Run every job in its own worker process and save an aggregate summary
+# and metrics to `output_dir`. Sessions don't share anything but the USB
+# bus, so each phone is handled as fast as it would be on its own. The
+# metrics are also added to the totals in `metrics_path` if set.
+def run_sessions(jobs, output_dir, workers=None, metrics_path=None):
+    # Only needed in multi-device mode, not worth importing for every run
+    import multiprocessing
+
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or len(jobs)
+    logging.info(f"Starting {len(jobs)} sessions in {workers} worker processes")
+
+    started = time.monotonic()
+    results = []
+    # Forked children would inherit the parent's libusb state
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers) as pool:
+        for result in pool.imap_unordered(run_session, jobs):
+            received = sum(dump["size"] for dump in result["dumps"])
+            logging.info(
+                f"{result['path']}: {result['status']} "
+                f"in {result['elapsed']:.1f} s, {received} bytes received"
+                + (f" ({result['error']})" if result["error"] else "")
+            )
+            results.append(result)
+    elapsed = time.monotonic() - started
+
+    received = sum(dump["size"] for r in results for dump in r["dumps"])
+    summary = {
+        "devices": len(results),
+        "succeeded": sum(1 for r in results if r["status"] == "ok"),
+        "failed": sum(1 for r in results if r["status"] != "ok"),
+        "elapsed": elapsed,
+        "received": received,
+        "throughput": received / elapsed if elapsed else 0,
+        "sessions": sorted(results, key=lambda r: r["path"]),
+    }
+    with open(os.path.join(output_dir, "summary.json"), "w") as fos:
+        json.dump(summary, fos, indent=2)
+
+    metrics = Metrics()
+    metrics.sessions = 0
+    for job in jobs:
+        path = os.path.join(job["output_dir"], "metrics.json")
+        if os.path.exists(path):
+            metrics.merge(Metrics.load(path))
+    metrics.save(os.path.join(output_dir, "metrics.json"))
+    if metrics_path:
+        accumulate_metrics(metrics_path, metrics)
+
+    logging.info(
+        f"{summary['succeeded']} out of {summary['devices']} sessions succeeded "
+        f"in {elapsed:.1f} s, {received} bytes received "
+        f"({summary['throughput'] / 1024:.1f} kB/s in total)"
+    )
+    return summary
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+# get path to the payloads directory next to spft-replay
+PAYLOADS_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../payloads")
+)
+
+
+# Content-addressed cache of piggyback payloads built by `payloads/Makefile`.
+#
+# A piggyback payload is the patched Download Agent of a SoC with the
+# payload code appended. Its cache key is derived from the hashes of
+# everything it is made of: the original DA, the patch offset, the
+# linker script, the init code linked into every payload and the compiled
+# payload object. A payload is stored once per content
+# (objects/<sha256>.bin) no matter how many keys refer to it, and the
+# least recently used entries are evicted when the cache grows over
+# `max_size` bytes.
+#
+# Hashes of input files are remembered along with their size and mtime,
+# so an unchanged file is never read again. The index is protected by a
+# file lock because several spft-replay processes may share the cache.
+#
+# Usage:
+#     cache = PayloadCache()
+#     payload = cache.get("mt6589", "usb-dump")
+class PayloadCache:
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, root=None, max_size=DEFAULT_MAX_SIZE, payloads_dir=None):
+        self.payloads_dir = payloads_dir or PAYLOADS_DIR
+        self.root = root or os.path.join(self.payloads_dir, "build", "cache")
+        self.max_size = max_size
+        self.index_path = os.path.join(self.root, "index.json")
+        self.patch_offsets = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Read the index, let the caller modify it and save it back
+    @contextmanager
+    def locked_index(self):
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        with open(os.path.join(self.root, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.index_path) as fis:
+                    index = json.load(fis)
+            except (OSError, ValueError):
+                index = {"entries": {}, "files": {}}
+            yield index
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as fos:
+                json.dump(index, fos, indent=1)
+            os.replace(tmp_path, self.index_path)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, "objects", f"{digest}.bin")
+
+    # SHA-256 of a file, only computed again when its size or mtime change
+    def file_hash(self, index, path):
+        st = os.stat(path)
+        known = index["files"].get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as fis:
+            for chunk in iter(lambda: fis.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        index["files"][path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    # Patch offset of the DA of `soc`, as passed to scripts/patch-da.py
+    def patch_offset(self, soc):
+        if soc in self.patch_offsets:
+            return self.patch_offsets[soc]
+        with open(os.path.join(self.payloads_dir, "Makefile")) as fis:
+            makefile = fis.read()
+        match = re.search(
+            rf"^\$\(OUT_DIR\)/{soc}-da-patched\.bin:"
+            r".*?patch-da\.py.*?(0x[0-9a-fA-F]+)",
+            makefile,
+            re.MULTILINE | re.DOTALL,
+        )
+        if not match:
+            raise RuntimeError(f"No Download Agent patch for {soc} in the Makefile")
+        self.patch_offsets[soc] = int(match.group(1), 16)
+        return self.patch_offsets[soc]
+
+    # Files a piggyback payload is built from, see `payloads/Makefile`
+    def inputs(self, soc, name):
+        build_dir = os.path.join(self.payloads_dir, "build")
+        out_dir = os.path.join(build_dir, "out", "piggyback")
+        return {
+            "da": os.path.join(build_dir, "aux", f"{soc}-da-original.bin"),
+            "ld": os.path.join(self.payloads_dir, "include", soc, "memory.ld"),
+            "init": os.path.join(out_dir, f"{soc}-init-piggyback.o"),
+            "object": os.path.join(out_dir, f"{soc}-{name}.o"),
+        }
+
+    def release_path(self, soc, name):
+        return os.path.join(
+            self.payloads_dir, "build", "release", "piggyback", f"{soc}-{name}.bin"
+        )
+
+    def key(self, index, soc, name):
+        key = hashlib.sha256(f"piggyback:{soc}:{name}".encode())
+        key.update(f":{self.patch_offset(soc):08x}".encode())
+        for role, path in sorted(self.inputs(soc, name).items()):
+            if not os.path.exists(path):
+                raise RuntimeError(
+                    f"Missing {path}, build payloads with `make TARGET={soc}` first"
+                )
+            key.update(f":{role}={self.file_hash(index, path)}".encode())
+        return key.hexdigest()
+
+    # Return the piggyback payload `name` built for `soc`. On a miss the
+    # release built by make is added to the cache, as long as it is not
+    # older than any of its inputs.
+    def get(self, soc, name):
+        with self.locked_index() as index:
+            key = self.key(index, soc, name)
+            entry = index["entries"].get(key)
+            if entry and os.path.exists(self.object_path(entry["object"])):
+                self.hits += 1
+                entry["used"] = time.time()
+                with open(self.object_path(entry["object"]), "rb") as fis:
+                    return fis.read()
+
+            self.misses += 1
+            path = self.release_path(soc, name)
+            inputs = self.inputs(soc, name).values()
+            newest_input = max(os.stat(p).st_mtime for p in inputs)
+            if not os.path.exists(path) or os.stat(path).st_mtime < newest_input:
+                raise RuntimeError(
+                    f"{path} is missing or outdated, "
+                    f"rebuild payloads with `make TARGET={soc}`"
+                )
+            with open(path, "rb") as fis:
+                data = fis.read()
+            self.put(index, key, data)
+            logging.info(f"Added {soc}-{name} to the payload cache")
+            return data
+
+    def put(self, index, key, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as fos:
+                fos.write(data)
+            os.replace(tmp_path, path)
+        index["entries"][key] = {
+            "object": digest,
+            "size": len(data),
+            "used": time.time(),
+        }
+        self.evict(index)
+
+    # Drop least recently used entries until the objects fit in max_size
+    def evict(self, index):
+        entries = index["entries"]
+        sizes = {entry["object"]: entry["size"] for entry in entries.values()}
+        total = sum(sizes.values())
+        for key in sorted(entries, key=lambda k: entries[k]["used"]):
+            if total <= self.max_size:
+                break
+            digest = entries.pop(key)["object"]
+            if any(entry["object"] == digest for entry in entries.values()):
+                continue  # still referenced by another key
+            total -= sizes[digest]
+            try:
+                os.unlink(self.object_path(digest))
+            except OSError:
+                pass
+            logging.debug(f"Evicted {digest} from the payload cache")
+
+
+# Payload resolver for `DeviceManager.replay`: returns the cached payload
+# `name` built for the detected platform
+def cached_payload(name, cache=None):
+    cache = cache or PayloadCache()
+
+    def resolve(platform):
+        soc = type(platform).__name__.lower()
+        payload = cache.get(soc, name)
+        logging.info(f"Using payload {soc}-{name} ({len(payload)} bytes)")
+        return payload
+
+    return resolve
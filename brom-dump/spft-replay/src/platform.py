@@ -1,47 +1,95 @@
 import logging
 import os
-import random
 from abc import ABC, abstractmethod
 
-from src.common import as_0x, as_hex, target_config_to_string
+from src.common import as_0x, as_hex, map_file, target_config_to_string
+from src.payload_cache import PAYLOADS_DIR
+from src.ramsize import detect_ram_size
+from src.replay import (
+    READ16,
+    READ32,
+    WRITE16,
+    WRITE32,
+    Call,
+    ReplayPlan,
+    Step,
+    profile_rows,
+)
 
 
 class AbstractPlatform(ABC):
+    # Register traffic of the replay stages, see `src.replay.Step`. The
+    # stage methods below replay their tables by default, platforms only
+    # override them when a stage needs more than that.
+    TABLES = {}
+    # Stages that only query the device. They are skipped when the device
+    # is known from an earlier session (see `src/fingerprint.py`).
+    QUERY_STAGES = ["identify_chip", "identify_software"]
+
     @abstractmethod
     def __init__(self, brom):
         self.brom = brom
+        # IDs, versions, register values and RAM sizes of the device,
+        # remembered for the next session. Taken from the fingerprint
+        # cache if the device is `known`.
+        self.facts = {}
+        self.known = False
+        # Replay the lean profile instead of the verbatim SP Flash Tool flow,
+        # see `profile_rows`
+        self.lean = False
+
+    # Execute the table of a stage and return the values of its reads.
+    # Tables are compiled once per platform class and profile, on first use.
+    def replay_table(self, stage):
+        cls = type(self)
+        if "plans" not in vars(cls):
+            cls.plans = {}
+        key = (stage, self.lean)
+        if key not in cls.plans:
+            cls.plans[key] = ReplayPlan(self.table_rows(stage))
+        return cls.plans[key].execute(self.brom)
+
+    def table_rows(self, stage):
+        return profile_rows(type(self).TABLES.get(stage, []), self.lean)
 
-    @abstractmethod
     def identify_chip(self):
-        pass
+        self.remember_reads("identify_chip", self.replay_table("identify_chip"))
+
+    def remember_register(self, addr, value):
+        self.facts.setdefault("registers", {})[as_0x(addr)] = value
+
+    # Remember the values of the reads of a table
+    def remember_reads(self, stage, values):
+        steps = [
+            step
+            for step in self.table_rows(stage)
+            if isinstance(step, Step) and step.op in (READ16, READ32)
+        ]
+        for step, value in zip(steps, values):
+            self.remember_register(step.addr, value)
 
     # Initialize power subsystem of a target device. This might include
     # setting up an embedded PMIC (mt6573) or changing some settings
     # related the the 2nd CPU code (mt6577).
-    @abstractmethod
     def init_pmic(self):
-        pass
+        self.replay_table("init_pmic")
 
-    @abstractmethod
     def disable_watchdog(self):
-        pass
+        self.replay_table("disable_watchdog")
 
     # Initialize real-time clock hardware
-    @abstractmethod
     def init_rtc(self):
-        pass
+        self.replay_table("init_rtc")
 
     # Usually at this stage SP Flash Tool tries to request ME ID and
     # versions of BROM and Preloader. I could not think of any better
     # name for this function.
-    @abstractmethod
     def identify_software(self):
-        pass
+        self.replay_table("identify_software")
 
     # Initialize external memory interface
-    @abstractmethod
     def init_emi(self):
-        pass
+        self.replay_table("init_emi")
 
     # Push payload bytes to the device
     @abstractmethod
@@ -62,132 +110,183 @@ class AbstractPlatform(ABC):
 
 
 class MT6252(AbstractPlatform):
+    SRAM_BASE = 0x08000000
+    SRAM_START = 0x08004000
+    SRAM_MAX_SIZE = 0x800000
+    # Extracted from SP Flash Tool by `payloads/Makefile`
+    DA_1ST_STAGE_PATH = os.path.join(PAYLOADS_DIR, "build/aux/mt6252-da-1st-stage.bin")
+
+    TABLES = {
+        "identify_chip": [
+            Step(
+                READ16, 0x80000000, check_status=False, name="Register", verbatim=True
+            ),
+            Step(
+                READ16, 0x80000008, check_status=False, name="Register", verbatim=True
+            ),
+            Step(
+                READ16, 0x8000000C, check_status=False, name="Register", verbatim=True
+            ),
+            # <BROM_DLL.log> Old chip-recognition flow... (brom_base.cpp:1654)
+            Step(READ16, 0x80010000, check_status=False, verbatim=True),  # HW version
+            Step(READ16, 0x80010008, check_status=False),  # HW code
+            Step(READ16, 0x8001000C, check_status=False),  # HW subcode
+            # <BROM_DLL.log> New chip-recognition flow... (brom_base.cpp:1565)
+            Step(READ16, 0x80010000, check_status=False),  # HW version
+            Step(READ16, 0x80010004, check_status=False),  # SW version
+        ],
+        "disable_watchdog": [
+            Step(WRITE16, 0x80030000, 0x2200, check_status=False),
+        ],
+        "init_rtc": [
+            # 2 repeating addresses
+            Step(
+                READ16,
+                0x810B0000,
+                check_status=False,
+                name="RTC register",
+                verbatim=True,
+            ),
+            Step(
+                READ16,
+                0x810B0000,
+                check_status=False,
+                name="RTC register",
+                verbatim=True,
+            ),
+            Step(
+                READ16,
+                0x810B0050,
+                check_status=False,
+                name="RTC register",
+                verbatim=True,
+            ),
+            Step(WRITE16, 0x810B0010, 0x0000, check_status=False),
+            Step(WRITE16, 0x810B0008, 0x0000, check_status=False),
+            Step(WRITE16, 0x810B000C, 0x0000, check_status=False),
+            Step(WRITE16, 0x810B0074, 0x0001, check_status=False),
+            Step(READ16, 0x810B0000, check_status=False, verbatim=True),  # 0x0008
+            Step(WRITE16, 0x810B0050, 0xA357, check_status=False),
+            Step(WRITE16, 0x810B0054, 0x67D2, check_status=False),
+            Step(WRITE16, 0x810B0074, 0x0001, check_status=False),
+            Step(READ16, 0x810B0000, check_status=False, verbatim=True),  # 0x0008
+            Step(READ16, 0x810B0000, check_status=False, verbatim=True),  # 0x0008
+            Step(WRITE16, 0x810B0068, 0x586A, check_status=False),
+            Step(WRITE16, 0x810B0074, 0x0001, check_status=False),
+            Step(READ16, 0x810B0000, check_status=False, verbatim=True),  # 0x0008
+            Step(WRITE16, 0x810B0068, 0x9136, check_status=False),
+            Step(WRITE16, 0x810B0074, 0x0001, check_status=False),
+            Step(READ16, 0x810B0000, check_status=False, verbatim=True),  # 0x0008
+            Step(
+                READ16,
+                0x810B0058,
+                check_status=False,
+                name="RTC register",
+                verbatim=True,
+            ),
+            Step(WRITE16, 0x810B0058, 0x00F1, check_status=False),
+            Step(WRITE16, 0x810B0000, 0x430E, check_status=False),
+            Step(WRITE16, 0x810B0074, 0x0001, check_status=False),
+            Step(READ16, 0x810B0000, check_status=False, verbatim=True),  # 0x000E
+            Step(WRITE16, 0x810B0068, 0x0000, check_status=False),
+            Step(WRITE16, 0x810B0074, 0x0001, check_status=False),
+            Step(READ16, 0x810B0000, check_status=False, verbatim=True),  # 0x000E
+        ],
+        "init_emi": [
+            Step(WRITE16, 0x80030000, 0x2200, check_status=False),  # disable WDT
+            Step(WRITE32, 0x81000044, 0xFFFFFB80, check_status=False),
+            Step(
+                READ32,
+                0x81000074,
+                check_status=False,
+                name="EMI register",
+                verbatim=True,
+            ),
+            Step(
+                READ32,
+                0x81000004,
+                check_status=False,
+                name="EMI register",
+                verbatim=True,
+            ),
+            Step(
+                WRITE32,
+                SRAM_START,
+                [0x523C3C3C, 0x425F4D41, 0x4E494745, 0x003E3E3E],
+                check_status=False,
+            ),
+        ],
+    }
+
     def __init__(self, brom):
         super().__init__(brom)
 
-        # Try to read the 1st-stage DA as early as possible. If we fail
-        # here now, the device won't be stuck waiting for us later.
-        self.da_1st_stage = None
+        self.sram_size = None
 
-        # get path to platform.py
-        path = os.path.abspath(__file__)
-        # relative paths like this are evil but I had no other ideas :(
-        path = os.path.join(path, "../../../payloads/build/aux/mt6252-da-1st-stage.bin")
-        logging.info(f"Loading 1st-stage DA from {path}")
-        with open(os.path.abspath(path), "rb") as fis:
-            self.da_1st_stage = fis.read()
+        # Check for the 1st-stage DA as early as possible. If we fail here
+        # now, the device won't be stuck waiting for us later. The file is
+        # only mapped when the payload is sent.
+        if not os.path.isfile(MT6252.DA_1ST_STAGE_PATH):
+            raise RuntimeError(
+                f"Missing {MT6252.DA_1ST_STAGE_PATH}, "
+                "build payloads with `make TARGET=mt6252` first"
+            )
 
     def identify_chip(self):
-        for addr in [0x80000000, 0x80000008, 0x8000000C]:
-            val = self.brom.read16(addr, check_status=False)
-            logging.replay(f"{as_0x(addr)}: {as_hex(val, 2)}")
-        # <BROM_DLL.log> Old chip-recognition flow... (brom_base.cpp:1654)
-        hw_ver = self.brom.read16(0x80010000, check_status=False)
-        hw_code = self.brom.read16(0x80010008, check_status=False)
-        hw_sub_code = self.brom.read16(0x8001000C, check_status=False)
-        # <BROM_DLL.log> New chip-recognition flow... (brom_base.cpp:1565)
-        hw_ver = self.brom.read16(0x80010000, check_status=False)
-        sw_ver = self.brom.read16(0x80010004, check_status=False)
+        values = self.replay_table("identify_chip")
+        self.remember_reads("identify_chip", values)
+        hw_code, hw_sub_code, hw_ver, sw_ver = values[-4:]
         logging.info(f"HW code: {as_hex(hw_code, 2)}")
         logging.info(f"HW subcode: {as_hex(hw_sub_code, 2)}")
         logging.info(f"HW version: {as_hex(hw_ver, 2)}")
         logging.info(f"SW version: {as_hex(sw_ver, 2)}")
 
-    def init_pmic(self):
-        pass
-
-    def disable_watchdog(self):
-        self.brom.write16(0x80030000, 0x2200, check_status=False)
-
-    def init_rtc(self):
-        for addr in [0x810B0000, 0x810B0000, 0x810B0050]:  # 2 repeating addresses
-            val = self.brom.read16(addr, check_status=False)
-            logging.replay(f"RTC register {as_0x(addr)} == {as_hex(val, 2)}")
-
-        self.brom.write16(0x810B0010, 0x0000, check_status=False)
-        self.brom.write16(0x810B0008, 0x0000, check_status=False)
-        self.brom.write16(0x810B000C, 0x0000, check_status=False)
-        self.brom.write16(0x810B0074, 0x0001, check_status=False)
-        val = self.brom.read16(0x810B0000, check_status=False)  # 0x0008
-
-        self.brom.write16(0x810B0050, 0xA357, check_status=False)
-        self.brom.write16(0x810B0054, 0x67D2, check_status=False)
-        self.brom.write16(0x810B0074, 0x0001, check_status=False)
-        val = self.brom.read16(0x810B0000, check_status=False)  # 0x0008
-
-        val = self.brom.read16(0x810B0000, check_status=False)  # 0x0008
-
-        self.brom.write16(0x810B0068, 0x586A, check_status=False)
-        self.brom.write16(0x810B0074, 0x0001, check_status=False)
-        val = self.brom.read16(0x810B0000, check_status=False)  # 0x0008
-
-        self.brom.write16(0x810B0068, 0x9136, check_status=False)
-        self.brom.write16(0x810B0074, 0x0001, check_status=False)
-        val = self.brom.read16(0x810B0000, check_status=False)  # 0x0008
-
-        val = self.brom.read16(0x810B0058, check_status=False)
-        logging.replay(f"RTC register 0x810B0058: {as_hex(val, 2)}")
-        self.brom.write16(0x810B0058, 0x00F1, check_status=False)
-        self.brom.write16(0x810B0000, 0x430E, check_status=False)
-        self.brom.write16(0x810B0074, 0x0001, check_status=False)
-        val = self.brom.read16(0x810B0000, check_status=False)  # 0x000E
-
-        self.brom.write16(0x810B0068, 0x0000, check_status=False)
-        self.brom.write16(0x810B0074, 0x0001, check_status=False)
-        val = self.brom.read16(0x810B0000, check_status=False)  # 0x000E
-
     def identify_software(self):
         val = self.brom.get_brom_version()
         logging.replay(f"BROM version: {as_hex(val, 1)}")
-        val = self.brom.get_preloader_version()
+        self.facts["brom_version"] = val
+        if not self.lean:
+            val = self.brom.get_preloader_version()
 
     def init_emi(self):
-        MT6252_SRAM_START = 0x08004000
-        self.brom.write16(0x80030000, 0x2200, check_status=False)  # disable WDT again
-        self.brom.write32(0x81000044, 0xFFFFFB80, check_status=False)
+        self.replay_table("init_emi")
 
-        for addr in [0x81000074, 0x81000004]:
-            val = self.brom.read32(addr, check_status=False)
-            logging.replay(f"EMI register {as_0x(addr)} == {as_hex(val, 2)}")
-
-        self.brom.write32(
-            MT6252_SRAM_START,
-            [0x523C3C3C, 0x425F4D41, 0x4E494745, 0x003E3E3E],
+        logging.replay("Detect external SRAM size")
+        ram_sizes = self.facts.setdefault("ram_sizes", {})
+        self.sram_size, probes = detect_ram_size(
+            self.brom,
+            MT6252.SRAM_BASE,
+            MT6252.SRAM_MAX_SIZE,
+            ram_sizes.get(as_0x(MT6252.SRAM_BASE)),
             check_status=False,
         )
-
-        for addr in range(0x08104000, 0x08804000 + 1, 0x80000):
-            val = self.brom.read32(addr, 4, check_status=False)
-            logging.replay(f"Memory at {as_0x(addr)}: {as_hex(val)}")
-
-        logging.replay("Detect external SRAM size")
-        ext_sram_sz = 0
-        for addr in range(
-            0x08804000, MT6252_SRAM_START - 1, -0x80000
-        ):  # backward check
-            val = random.sample(range(0, 0xFFFFFFFF), 4)
-            self.brom.write32(addr - 4, val, check_status=False)
-            test = self.brom.read32(addr - 4, 4, check_status=False)
-            if val == test:
-                ext_sram_sz = addr - MT6252_SRAM_START
-                break
-        if ext_sram_sz:
+        if self.sram_size:
+            ram_sizes[as_0x(MT6252.SRAM_BASE)] = self.sram_size
             logging.replay(
-                f"SRAM size: {as_0x(ext_sram_sz)} ({ext_sram_sz // 1024} kB)"
+                f"SRAM size: {as_0x(self.sram_size)} "
+                f"({self.sram_size // 1024} kB, {probes} probes)"
             )
         else:
             logging.warning("Could not detect SRAM size!")
 
     def send_payload(self, payload):
         logging.replay("Push 1st-stage DA")
-        self.brom.send_da_legacy(0x40005000, self.da_1st_stage)
-        val = self.brom.checksum_legacy(0x08100000, len(self.da_1st_stage))
+        logging.info(f"Loading 1st-stage DA from {MT6252.DA_1ST_STAGE_PATH}")
+        da_1st_stage = map_file(MT6252.DA_1ST_STAGE_PATH)
+        self.brom.send_da_legacy(0x40005000, da_1st_stage)
+        val = self.brom.checksum_legacy(0x08100000, len(da_1st_stage))
         logging.replay(f"Received DA checksum: {as_hex(val, 2)}")
 
         logging.replay("Push 2nd-stage DA (our payload)")
-        self.brom.send_da_legacy(0x08100000, payload)
+        expected = self.brom.send_da_legacy(0x08100000, payload)
         val = self.brom.checksum_legacy(0x08100000, len(payload))
         logging.replay(f"Received DA checksum: {as_hex(val, 2)}")
+        # The byte order of the legacy checksum hasn't been confirmed on a
+        # real device yet, so a mismatch must not abort the replay
+        if val != expected:
+            logging.warning(
+                f"DA checksum mismatch: {as_hex(val, 2)} != {as_hex(expected, 2)}"
+            )
 
     def jump_to_payload(self):
         self.brom.jump_da(0x40005000, check_status=False)
@@ -198,83 +297,79 @@ class MT6252(AbstractPlatform):
 
 
 class MT6573(AbstractPlatform):
+    TABLES = {
+        "identify_chip": [
+            Call("get_hw_code", verbatim=True),
+            Step(READ16, 0x70026000, check_status=False, name="HW version"),
+            Step(READ16, 0x70026004, check_status=False, name="SW version"),
+        ],
+        "init_pmic": [
+            Step(WRITE16, 0x7002FE84, 0xFF04, 0xFF00),  # KPLED_CON1
+            Step(WRITE16, 0x7002FA0C, 0x2079, 0x3079),  # CHR_CON3
+            Step(WRITE16, 0x7002FA0C, 0x20F9, 0x2079),  # CHR_CON3
+            Step(WRITE16, 0x7002FA08, 0x5200, 0x4700),  # CHR_CON2
+            Step(WRITE16, 0x7002FA18, 0x0000, 0x0010),  # CHR_CON6
+            Step(WRITE16, 0x7002FA00, 0x7AB2, 0x62B2),  # CHR_CON0
+            Step(WRITE16, 0x7002FA20, 0x0800, 0x0000),  # CHR_CON8
+            Step(WRITE16, 0x7002FA28, 0x0100, 0x0000),  # CHR_CON10
+            Step(WRITE16, 0x7002FA24, 0x0180, 0x0080),  # CHR_CON9
+        ],
+        "disable_watchdog": [
+            Step(WRITE16, 0x70025000, 0x2200),
+            Call("get_preloader_version", verbatim=True),
+        ],
+        "init_rtc": [
+            Step(READ16, 0x70014000, name="RTC register", verbatim=True),
+            Step(READ16, 0x70014050, name="RTC register", verbatim=True),
+            Step(READ16, 0x70014054, name="RTC register", verbatim=True),
+            Step(WRITE16, 0x70014010, 0x0000),  # Enable all alarm IRQs
+            Step(WRITE16, 0x70014008, 0x0000),  # Disable all IRQ generations
+            Step(WRITE16, 0x7001400C, 0x0000),  # Disable all counter IRQs
+            Step(WRITE16, 0x70014074, 0x0001),  # Commit changes
+            Step(READ16, 0x70014000, verbatim=True),  # 0x0008
+            Step(WRITE16, 0x70014050, 0xA357),  # Write reference value
+            Step(WRITE16, 0x70014054, 0x67D2),  # Write reference value
+            Step(WRITE16, 0x70014074, 0x0001),  # Commit changes
+            Step(READ16, 0x70014000, verbatim=True),  # 0x0008
+            Step(WRITE16, 0x70014068, 0x586A),  # Unlock RTC protection (part 1)
+            Step(WRITE16, 0x70014074, 0x0001),  # Commit changes
+            Step(READ16, 0x70014000, verbatim=True),  # 0x0008
+            Step(WRITE16, 0x70014068, 0x9136),  # Unlock RTC protection (part 2)
+            Step(WRITE16, 0x70014074, 0x0001),  # Commit changes
+            Step(READ16, 0x70014000, verbatim=True),  # 0x0008
+            # Enable bus writes + PMIC RTC + auto mode
+            Step(WRITE16, 0x70014000, 0x430E),
+            Step(WRITE16, 0x70014074, 0x0001),  # Commit changes
+            Step(READ16, 0x70014000, verbatim=True),  # 0x000E
+        ],
+        "init_emi": [
+            Step(READ32, 0x70000000, name="EMI_GENA", verbatim=True),
+            Step(WRITE32, 0x70000000, 0x00000002),
+        ],
+    }
+
     def __init__(self, brom):
         super().__init__(brom)
 
-    def identify_chip(self):
-        self.brom.get_hw_code()
-        hw_ver = self.brom.read16(0x70026000, check_status=False)
-        sw_ver = self.brom.read16(0x70026004, check_status=False)
-        logging.replay(f"HW version: {as_hex(hw_ver, 2)}")
-        logging.replay(f"SW version: {as_hex(sw_ver, 2)}")
-
-    def init_pmic(self):
-        self.brom.write16_verify(0x7002FE84, 0xFF04, 0xFF00)  # KPLED_CON1
-        self.brom.write16_verify(0x7002FA0C, 0x2079, 0x3079)  # CHR_CON3
-        self.brom.write16_verify(0x7002FA0C, 0x20F9, 0x2079)  # CHR_CON3
-        self.brom.write16_verify(0x7002FA08, 0x5200, 0x4700)  # CHR_CON2
-        self.brom.write16_verify(0x7002FA18, 0x0000, 0x0010)  # CHR_CON6
-        self.brom.write16_verify(0x7002FA00, 0x7AB2, 0x62B2)  # CHR_CON0
-        self.brom.write16_verify(0x7002FA20, 0x0800, 0x0000)  # CHR_CON8
-        self.brom.write16_verify(0x7002FA28, 0x0100, 0x0000)  # CHR_CON10
-        self.brom.write16_verify(0x7002FA24, 0x0180, 0x0080)  # CHR_CON9
-
-    def disable_watchdog(self):
-        self.brom.write16(0x70025000, 0x2200)
-        self.brom.get_preloader_version()
-
-    def init_rtc(self):
-        for addr in [0x70014000, 0x70014050, 0x70014054]:
-            val = self.brom.read16(addr)
-            logging.replay(f"RTC register {as_0x(addr)} == {as_hex(val, 2)}")
-
-        self.brom.write16(0x70014010, 0x0000)  # Enable all alarm IRQs
-        self.brom.write16(0x70014008, 0x0000)  # Disable all IRQ generations
-        self.brom.write16(0x7001400C, 0x0000)  # Disable all counter IRQs
-        self.brom.write16(0x70014074, 0x0001)  # Commit changes
-        val = self.brom.read16(0x70014000)  # 0x0008
-
-        self.brom.write16(0x70014050, 0xA357)  # Write reference value
-        self.brom.write16(0x70014054, 0x67D2)  # Write reference value
-        self.brom.write16(0x70014074, 0x0001)  # Commit changes
-        val = self.brom.read16(0x70014000)  # 0x0008
-
-        self.brom.write16(0x70014068, 0x586A)  # Unlock RTC protection (part 1)
-        self.brom.write16(0x70014074, 0x0001)  # Commit changes
-        val = self.brom.read16(0x70014000)  # 0x0008
-
-        self.brom.write16(0x70014068, 0x9136)  # Unlock RTC protection (part 2)
-        self.brom.write16(0x70014074, 0x0001)  # Commit changes
-        val = self.brom.read16(0x70014000)  # 0x0008
-
-        self.brom.write16(
-            0x70014000, 0x430E
-        )  # Enable bus writes + PMIC RTC + auto mode
-        self.brom.write16(0x70014074, 0x0001)  # Commit changes
-        val = self.brom.read16(0x70014000)  # 0x000E
-
     def identify_software(self):
         val = self.brom.get_me_id()
         logging.replay(f"ME ID: {as_hex(val)}")
-        val = self.brom.get_me_id()
+        self.facts["me_id"] = val.hex()
+        if not self.lean:
+            val = self.brom.get_me_id()
 
         val = self.brom.get_target_config()
         for line in target_config_to_string(val):
             logging.replay(line)
-        val = self.brom.get_target_config()
+        self.facts["target_config"] = val
+        if not self.lean:
+            val = self.brom.get_target_config()
 
         val = self.brom.get_brom_version()
         logging.replay(f"BROM version: {as_hex(val, 1)}")
-        val = self.brom.get_preloader_version()
-
-    def init_emi(self):
-        MT6573_EMI_GENA = 0x70000000
-        val = self.brom.read32(MT6573_EMI_GENA)
-        self.brom.write32(MT6573_EMI_GENA, 0x00000002)
-        logging.replay(
-            f"EMI_GENA ({as_0x(MT6573_EMI_GENA)}) "
-            f"set to {as_hex(0x2)}, was {as_hex(val)}"
-        )
+        self.facts["brom_version"] = val
+        if not self.lean:
+            val = self.brom.get_preloader_version()
 
     def send_payload(self, payload):
         val = self.brom.send_da(0x90005000, len(payload), 0, payload)
@@ -292,85 +387,85 @@ class MT6573(AbstractPlatform):
 
 
 class MT6577(AbstractPlatform):
+    TABLES = {
+        "init_pmic": [
+            Step(READ32, 0xC0009024, verbatim=True),  # PWR_CTL1
+            Step(READ32, 0xC0009010, verbatim=True),  # RST_CTL0
+            Step(WRITE32, 0xC0009010, 0x03000002),
+            Step(WRITE32, 0xC0009010, 0x03000000),
+            Step(READ32, 0xC0009010, verbatim=True),
+        ],
+        "disable_watchdog": [
+            Step(READ16, 0xC0000000, verbatim=True),
+            Step(WRITE16, 0xC0000000, 0x2264),
+            Call("get_preloader_version", verbatim=True),
+        ]
+        + [
+            Step(READ16, addr, name="TOPRGU register", verbatim=True)
+            for addr in range(0xC0000000, 0xC0000018 + 1, 4)
+        ],
+        "init_rtc": [
+            Step(READ16, 0xC1003000, verbatim=True),  # 0008
+            Step(READ16, 0xC1003050, verbatim=True),  # 0000
+            Step(READ16, 0xC1003054, verbatim=True),  # 0000
+            Step(WRITE16, 0xC1003010, 0x0000),  # RTC_AL_MASK
+            Step(WRITE16, 0xC1003008, 0x0000),  # RTC_IRQ_EN
+            Step(WRITE16, 0xC100300C, 0x0000),  # RTC_CII_EN
+            Step(WRITE16, 0xC1003074, 0x0001),  # Commit changes
+            Step(READ16, 0xC1003000, verbatim=True),  # 0008
+            Step(WRITE16, 0xC1003050, 0xA357),  # Write reference value
+            Step(WRITE16, 0xC1003054, 0x67D2),  # Write reference value
+            Step(WRITE16, 0xC1003074, 0x0001),  # Commit changes
+            Step(READ16, 0xC1003000, verbatim=True),  # 0008
+            Step(WRITE16, 0xC1003068, 0x586A),  # Unlock RTC protection (part 1)
+            Step(WRITE16, 0xC1003074, 0x0001),  # Commit changes
+            Step(READ16, 0xC1003000, verbatim=True),  # 0008
+            Step(WRITE16, 0xC1003068, 0x9136),  # Unlock RTC protection (part 2)
+            Step(WRITE16, 0xC1003074, 0x0001),  # Commit changes
+            Step(READ16, 0xC1003000, verbatim=True),  # 0008
+            # Enable bus writes + PMIC RTC + auto mode
+            Step(WRITE16, 0xC1003000, 0x430E),
+            Step(WRITE16, 0xC1003074, 0x0001),  # Commit changes
+            Step(READ16, 0xC1003000, verbatim=True),  # 000E
+        ],
+        "init_emi": [
+            # 00000000 on my device
+            Step(READ32, 0xC0003070, name="EMI_GENA", verbatim=True),
+            Step(WRITE32, 0xC0003070, 0x00000002),
+        ],
+    }
+
     def __init__(self, brom):
         super().__init__(brom)
 
     def identify_chip(self):
-        self.brom.get_hw_code()
+        if not self.lean:
+            self.brom.get_hw_code()
         hw_dict = self.brom.get_hw_sw_ver()
         logging.replay(f"HW subcode: {as_hex(hw_dict[0], 2)}")
         logging.replay(f"HW version: {as_hex(hw_dict[1], 2)}")
         logging.replay(f"SW version: {as_hex(hw_dict[2], 2)}")
-
-    def init_pmic(self):
-        val = self.brom.read32(0xC0009024)  # PWR_CTL1
-        val = self.brom.read32(0xC0009010)  # RST_CTL0
-        self.brom.write32(0xC0009010, 0x03000002)
-        self.brom.write32(0xC0009010, 0x03000000)
-        val = self.brom.read32(0xC0009010)
-
-    def disable_watchdog(self):
-        val = self.brom.read16(0xC0000000)
-        self.brom.write16(0xC0000000, 0x2264)
-
-        val = self.brom.get_preloader_version()
-
-        for addr in range(0xC0000000, 0xC0000018 + 1, 4):
-            val = self.brom.read16(addr)
-            logging.replay(f"TOPRGU register {as_0x(addr)} == {as_hex(val)}")
-
-    def init_rtc(self):
-        val = self.brom.read16(0xC1003000)  # 0008
-        val = self.brom.read16(0xC1003050)  # 0000
-        val = self.brom.read16(0xC1003054)  # 0000
-
-        self.brom.write16(0xC1003010, 0x0000)  # RTC_AL_MASK
-        self.brom.write16(0xC1003008, 0x0000)  # RTC_IRQ_EN
-        self.brom.write16(0xC100300C, 0x0000)  # RTC_CII_EN
-        self.brom.write16(0xC1003074, 0x0001)  # Commit changes
-        val = self.brom.read16(0xC1003000)  # 0008
-
-        self.brom.write16(0xC1003050, 0xA357)  # Write reference value
-        self.brom.write16(0xC1003054, 0x67D2)  # Write reference value
-        self.brom.write16(0xC1003074, 0x0001)  # Commit changes
-        val = self.brom.read16(0xC1003000)  # 0008
-
-        self.brom.write16(0xC1003068, 0x586A)  # Unlock RTC protection (part 1)
-        self.brom.write16(0xC1003074, 0x0001)  # Commit changes
-        val = self.brom.read16(0xC1003000)  # 0008
-
-        self.brom.write16(0xC1003068, 0x9136)  # Unlock RTC protection (part 2)
-        self.brom.write16(0xC1003074, 0x0001)  # Commit changes
-        val = self.brom.read16(0xC1003000)  # 0008
-
-        self.brom.write16(
-            0xC1003000, 0x430E
-        )  # Enable bus writes + PMIC RTC + auto mode
-        self.brom.write16(0xC1003074, 0x0001)  # Commit changes
-        val = self.brom.read16(0xC1003000)  # 000E
+        self.facts["version"] = list(hw_dict)
 
     def identify_software(self):
         val = self.brom.get_me_id()
         logging.replay(f"ME ID: {as_hex(val)}")
-        val = self.brom.get_me_id()  # Again
+        self.facts["me_id"] = val.hex()
+        if not self.lean:
+            val = self.brom.get_me_id()  # Again
 
         val = self.brom.get_target_config()
         for line in target_config_to_string(val):
             logging.replay(line)
-        val = self.brom.get_target_config()
+        self.facts["target_config"] = val
+        if not self.lean:
+            val = self.brom.get_target_config()
 
         val = self.brom.get_brom_version()
         logging.replay(f"BROM version: {as_hex(val, 1)}")
-        val = self.brom.get_preloader_version()
-
-    def init_emi(self):
-        MT6577_EMI_GENA = 0xC0003070
-        val = self.brom.read32(MT6577_EMI_GENA)  # 00000000 on my device
-        self.brom.write32(MT6577_EMI_GENA, 0x00000002)
-        logging.replay(
-            f"EMI_GENA ({as_0x(MT6577_EMI_GENA)}) "
-            f"set to {as_hex(0x2)}, was {as_hex(val)}"
-        )
+        self.facts["brom_version"] = val
+        if not self.lean:
+            val = self.brom.get_preloader_version()
 
     def send_payload(self, payload):
         val = self.brom.send_da(0xC2000000, len(payload), 0, payload)
@@ -384,6 +479,12 @@ class MT6577(AbstractPlatform):
 
 
 class MT6580(AbstractPlatform):
+    TABLES = {
+        "disable_watchdog": [
+            Step(WRITE32, 0x10007000, 0x22000064, response=0x0001),  # TOPRGU_WDT_MODE
+        ],
+    }
+
     def __init__(self, brom):
         super().__init__(brom)
 
@@ -392,37 +493,31 @@ class MT6580(AbstractPlatform):
         logging.replay(f"HW subcode: {as_hex(hw_dict[0], 2)}")
         logging.replay(f"HW version: {as_hex(hw_dict[1], 2)}")
         logging.replay(f"SW version: {as_hex(hw_dict[2], 2)}")
+        self.facts["version"] = list(hw_dict)
         # The 0x10009000~0x1000A000 region is allocated to EFUSE controller.
         # It is barely documented even in datasheets but the specified offset
         # should contain some sort of additional SoC revision codes.
         val = self.brom.read32(0x10009040)
         logging.replay(f"0x10009040: {as_hex(val)}")
-
-    def init_pmic(self):
-        pass
-
-    def disable_watchdog(self):
-        self.brom.write32(
-            0x10007000, 0x22000064, expected_response=0x0001
-        )  # TOPRGU_WDT_MODE
-
-    def init_rtc(self):
-        pass
+        self.remember_register(0x10009040, val)
 
     def identify_software(self):
-        val = self.brom.get_preloader_version()
-        val = self.brom.get_me_id()
+        if not self.lean:
+            val = self.brom.get_preloader_version()
+            val = self.brom.get_me_id()
         val = self.brom.get_me_id()  # repeated twice
         logging.replay(f"ME ID: {as_hex(val)}")
-        val = self.brom.get_target_config()
+        self.facts["me_id"] = val.hex()
+        if not self.lean:
+            val = self.brom.get_target_config()
         val = self.brom.get_target_config()  # repeated twice
         logging.replay(f"Target config: {as_hex(val)}")
+        self.facts["target_config"] = val
         val = self.brom.get_brom_version()
         logging.replay(f"BROM version: {as_hex(val, 1)}")
-        val = self.brom.get_preloader_version()
-
-    def init_emi(self):
-        pass
+        self.facts["brom_version"] = val
+        if not self.lean:
+            val = self.brom.get_preloader_version()
 
     def send_payload(self, payload):
         val = self.brom.send_da(0x200000, len(payload), 0, payload)
@@ -436,6 +531,12 @@ class MT6580(AbstractPlatform):
 
 
 class MT6582(AbstractPlatform):
+    TABLES = {
+        "disable_watchdog": [
+            Step(WRITE32, 0x10007000, 0x22000064, response=0x0001),  # TOPRGU_WDT_MOD
+        ],
+    }
+
     def __init__(self, brom):
         super().__init__(brom)
 
@@ -444,32 +545,22 @@ class MT6582(AbstractPlatform):
         logging.replay(f"HW subcode: {as_hex(hw_dict[0], 2)}")
         logging.replay(f"HW version: {as_hex(hw_dict[1], 2)}")
         logging.replay(f"SW version: {as_hex(hw_dict[2], 2)}")
+        self.facts["version"] = list(hw_dict)
         # The 0x10206000~0x10207000 region is allocated to EFUSE controller.
         # It is barely documented even in datasheets but the specified offset
         # should contain some sort of additional SoC revision codes.
         val = self.brom.read32(0x10206044)
         logging.replay(f"0x10206044: {as_hex(val)}")
-
-    def init_pmic(self):
-        pass
-
-    def disable_watchdog(self):
-        self.brom.write32(
-            0x10007000, 0x22000064, expected_response=0x0001
-        )  # TOPRGU_WDT_MOD
-
-    def init_rtc(self):
-        pass
+        self.remember_register(0x10206044, val)
 
     def identify_software(self):
-        val = self.brom.get_preloader_version()
+        if not self.lean:
+            val = self.brom.get_preloader_version()
         val = self.brom.get_me_id()
         logging.replay(f"ME ID: {as_hex(val)}")
-        val = self.brom.get_preloader_version()  # repeated twice
-        pass
-
-    def init_emi(self):
-        pass
+        self.facts["me_id"] = val.hex()
+        if not self.lean:
+            val = self.brom.get_preloader_version()  # repeated twice
 
     def send_payload(self, payload):
         val = self.brom.send_da(0x200000, len(payload), 0, payload)
@@ -483,6 +574,36 @@ class MT6582(AbstractPlatform):
 
 
 class MT6589(AbstractPlatform):
+    # identify_chip also enables the UART1 log
+    QUERY_STAGES = ["identify_software"]
+
+    TABLES = {
+        "init_pmic": [
+            Call("power_init", (0x80000000, 0)),
+            Call("power_read16", (0x000E,), verbatim=True),  # CHR_CON7
+            Call("set_power_reg", (0x000E, 0x1001, 0x1001)),  # CHR_CON7
+            Call("set_power_reg", (0x000C, 0x0049, 0x0041)),  # CHR_CON6
+            Call("set_power_reg", (0x0008, 0x000C, 0x000F)),  # CHR_CON4
+            Call("set_power_reg", (0x001A, 0x0000, 0x0010)),  # CHR_CON13
+            Call("set_power_reg", (0x0000, 0x007B, 0x0063)),  # CHR_CON0
+            Call("set_power_reg", (0x0020, 0x0009, 0x0001)),  # CHR_CON16
+            Call("power_deinit"),
+        ],
+        "disable_watchdog": [
+            Step(WRITE32, 0x10000000, 0x22002224),
+            Call("get_preloader_version", verbatim=True),
+        ]
+        + [
+            Step(READ32, addr, name="TOPRGU register", verbatim=True)
+            for addr in range(0x10000000, 0x10000018 + 1, 4)
+        ],
+        "init_emi": [
+            # 00000000 on my device
+            Step(READ32, 0x10203070, name="EMI_GENA", verbatim=True),
+            Step(WRITE32, 0x10203070, 0x00000002),
+        ],
+    }
+
     def __init__(self, brom):
         super().__init__(brom)
 
@@ -491,43 +612,15 @@ class MT6589(AbstractPlatform):
         logging.replay(f"HW subcode: {as_hex(hw_dict[0], 2)}")
         logging.replay(f"HW version: {as_hex(hw_dict[1], 2)}")
         logging.replay(f"SW version: {as_hex(hw_dict[2], 2)}")
+        self.facts["version"] = list(hw_dict)
         self.brom.uart1_log_enable()
 
-    def init_pmic(self):
-        self.brom.power_init(0x80000000, 0)
-        val = self.brom.power_read16(0x000E)  # CHR_CON7
-        self.brom.set_power_reg(0x000E, 0x1001, 0x1001)  # CHR_CON7
-        self.brom.set_power_reg(0x000C, 0x0049, 0x0041)  # CHR_CON6
-        self.brom.set_power_reg(0x0008, 0x000C, 0x000F)  # CHR_CON4
-        self.brom.set_power_reg(0x001A, 0x0000, 0x0010)  # CHR_CON13
-        self.brom.set_power_reg(0x0000, 0x007B, 0x0063)  # CHR_CON0
-        self.brom.set_power_reg(0x0020, 0x0009, 0x0001)  # CHR_CON16
-        self.brom.power_deinit()
-
-    def disable_watchdog(self):
-        self.brom.write32(0x10000000, 0x22002224)
-
-        val = self.brom.get_preloader_version()
-        for addr in range(0x10000000, 0x10000018 + 1, 4):
-            val = self.brom.read32(addr)
-            logging.replay(f"TOPRGU register {as_0x(addr)} == {as_hex(val)}")
-
-    def init_rtc(self):
-        pass
-
     def identify_software(self):
         val = self.brom.get_brom_version()
         logging.replay(f"BROM version: {as_hex(val, 1)}")
-        val = self.brom.get_preloader_version()  # Again..?
-
-    def init_emi(self):
-        MT6589_EMI_GENA = 0x10203070
-        val = self.brom.read32(MT6589_EMI_GENA)  # 00000000 on my device
-        self.brom.write32(MT6589_EMI_GENA, 0x00000002)
-        logging.replay(
-            f"EMI_GENA ({as_0x(MT6589_EMI_GENA)}) "
-            f"set to {as_hex(0x2)}, was {as_hex(val)}"
-        )
+        self.facts["brom_version"] = val
+        if not self.lean:
+            val = self.brom.get_preloader_version()  # Again..?
 
     def send_payload(self, payload):
         val = self.brom.send_da(0x12000000, len(payload), 0, payload)
@@ -0,0 +1,101 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import logging
+import random
+
+from src.common import as_0x
+
+
+# Find the size of RAM starting at `base` without knowing anything about
+# the memory controller. `max_size` and `granularity` must be powers of
+# two, `base` must be aligned to `max_size`.
+#
+# A probe writes a unique random pattern to the last word below a size
+# boundary and reads it back. Probes are batched: all patterns are
+# written by one pipeline that also reads them back, and they are written
+# from the highest address down. If the memory is mirrored, the write to
+# a lower boundary clobbers the aliases above it, so an alias never
+# passes for real memory. Undecoded addresses don't keep the pattern.
+#
+# The power-of-two boundaries are probed in a single batch. If RAM is not
+# a power of two, the size between the last boundary that has passed and
+# the next one is then found with a binary search.
+#
+# Usage:
+#     sizer = RamSizer(brom, 0x08000000, 0x800000, check_status=False)
+#     size = sizer.detect()
+class RamSizer:
+    def __init__(self, brom, base, max_size, granularity=0x80000, check_status=True):
+        self.brom = brom
+        self.base = base
+        self.max_size = max_size
+        self.granularity = granularity
+        self.check_status = check_status
+        self.probes = 0  # addresses tested
+        self.batches = 0  # pipelines executed, i.e. round trips
+
+    # Returns for every size in `sizes` whether the word right below it
+    # is backed by memory that is not aliased by any other size in the batch
+    def probe(self, sizes):
+        patterns = random.sample(range(1, 1 << 32), len(sizes))
+        addrs = [self.base + size - 4 for size in sizes]
+        with self.brom.pipeline() as pipeline:
+            for addr, pattern in sorted(zip(addrs, patterns), reverse=True):
+                pipeline.write32(addr, pattern, check_status=self.check_status)
+            for addr in addrs:
+                pipeline.read32(addr, check_status=self.check_status)
+        self.probes += len(sizes)
+        self.batches += 1
+        return [value == pattern for value, pattern in zip(pipeline.results, patterns)]
+
+    def detect(self):
+        boundaries = []
+        size = self.granularity
+        while size <= self.max_size:
+            boundaries.append(size)
+            size *= 2
+
+        low = 0  # the largest size known to be good
+        for boundary, passed in zip(boundaries, self.probe(boundaries)):
+            if not passed:
+                break
+            low = boundary
+        if not low or low == self.max_size:
+            return low
+
+        # The lowest power of two above has failed. Memory above `low`
+        # could only alias what is `low` bytes below it.
+        high = min(low * 2, self.max_size + self.granularity)
+        while high - low > self.granularity:
+            mid = (low + high) // 2 // self.granularity * self.granularity
+            if all(self.probe([mid, mid - low])):
+                low = mid
+            else:
+                high = mid
+        return low
+
+    # Check a size found before with a single batch: it must pass and the
+    # next size must not, neither as real memory nor as an alias of the
+    # first boundary
+    def verify(self, size):
+        if size >= self.max_size:
+            return self.probe([size])[0]
+        sizes = [size, size + self.granularity]
+        if size != self.granularity:
+            sizes.append(self.granularity)
+        results = self.probe(sizes)
+        return results[0] and not results[1]
+
+
+# Detect the size of RAM at `base`, trying `known_size` first, e.g. the
+# size found in an earlier session with the same device (see
+# `src/fingerprint.py`). A known size is verified because boards with the
+# same chip may have different RAM. Returns the size and the number of
+# probes used.
+def detect_ram_size(brom, base, max_size, known_size=None, **options):
+    sizer = RamSizer(brom, base, max_size, **options)
+    if known_size and sizer.verify(known_size):
+        logging.debug(f"Known RAM size {as_0x(known_size)} is still valid")
+        return known_size, sizer.probes
+    return sizer.detect(), sizer.probes
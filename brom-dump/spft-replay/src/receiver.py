@@ -0,0 +1,131 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import hashlib
+import itertools
+import logging
+import os
+import time
+import zlib
+
+# Framing of the usb-dump piggyback, see `payloads/src/piggyback/usb-dump.c`.
+# HELLO_FLAGS is followed by a word of HELLO_FLAG_* bits, HELLO means none.
+MAGIC_HELLO = 0x3E4D746B  # >Mtk
+MAGIC_HELLO_FLAGS = 0x3E4D7446  # >MtF
+MAGIC_GOODBYE = 0x4D746B3C  # <Mtk
+HELLO_FLAG_RLE = 1 << 0
+HELLO_FLAG_CHUNKED = 1 << 1  # see src/chunkdump.py
+
+# Word-level run-length encoding of regions. Every token is a big-endian
+# word: RLE_RUN | N is followed by one word repeated N times and N alone
+# by N literal words, both in memory order.
+RLE_RUN = 0x80000000
+RLE_MIN_RUN = 256  # words, shorter runs don't pay for 2 more transfers
+
+
+# Reference implementation of the encoder of usb-dump-rle, `data` must be
+# a whole number of words
+def encode_rle(data):
+    data = memoryview(data).cast("B")
+    words = data.cast("I")
+    result = bytearray()
+    literal = 0  # first word not encoded yet
+    i = 0
+    for _, group in itertools.groupby(words):
+        run = sum(1 for _ in group)
+        if run >= RLE_MIN_RUN:
+            if literal < i:
+                result += (i - literal).to_bytes(4, "big")
+                result += data[literal * 4 : i * 4]
+            result += (RLE_RUN | run).to_bytes(4, "big")
+            result += data[i * 4 : i * 4 + 4]
+            literal = i + run
+        i += run
+    if literal < i:
+        result += (i - literal).to_bytes(4, "big")
+        result += data[literal * 4 :]
+    return bytes(result)
+
+
+# Output file for a memory region sent by a dump payload. The data is
+# written to disk as it arrives and hashed on the fly, so memory usage
+# does not depend on the region size. With `resume_from` the first bytes
+# of an existing file are kept (and hashed) and the data is appended to
+# them.
+class DumpFile:
+    REPORT_INTERVAL = 0.5  # seconds
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path, size, resume_from=0):
+        self.path = path
+        self.size = size
+        self.received = 0
+        self.resumed = resume_from
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0
+
+        if resume_from:
+            self.fos = open(path, "r+b")
+            self.hash_existing(resume_from)
+        else:
+            self.fos = open(path, "wb")
+        # Reserve the space upfront so a full disk is detected right away
+        if size and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self.fos.fileno(), 0, size)
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+
+    def hash_existing(self, size):
+        while self.received < size:
+            data = self.fos.read(min(size - self.received, DumpFile.HASH_CHUNK_SIZE))
+            if not data:
+                raise RuntimeError(f"{self.path} is shorter than {size} bytes")
+            self.sha256.update(data)
+            self.crc32 = zlib.crc32(data, self.crc32)
+            self.received += len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        self.fos.write(data)
+        self.sha256.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.received += len(data)
+
+        now = time.monotonic()
+        if now - self.reported_at >= DumpFile.REPORT_INTERVAL:
+            self.report(now)
+
+    def rate(self, now=None):
+        elapsed = (now or time.monotonic()) - self.started_at
+        return (self.received - self.resumed) / elapsed if elapsed > 0 else 0
+
+    def report(self, now):
+        self.reported_at = now
+        rate = self.rate(now)
+        perc = int(self.received / self.size * 100) if self.size else 100
+        eta = (self.size - self.received) / rate if rate else 0
+        logging.info(
+            f"Received {self.received} out of {self.size} bytes ({perc}%), "
+            f"{rate / 1024:.1f} kB/s, ETA {eta:.0f} s"
+        )
+
+    def close(self):
+        if not self.fos:
+            return
+        # Drop the preallocated tail if the transfer has been cut short
+        if self.received < self.size:
+            self.fos.truncate(self.received)
+        self.fos.close()
+        self.fos = None
+
+        logging.info(
+            f"Saved {self.received} bytes to {self.path} "
+            f"({self.rate() / 1024:.1f} kB/s)"
+        )
+        logging.info(f"CRC32: {self.crc32:08X}")
+        logging.info(f"SHA-256: {self.sha256.hexdigest()}")
@@ -0,0 +1,204 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import logging
+from collections import namedtuple
+
+from src.common import as_0x, as_hex
+
+READ16 = "read16"
+READ32 = "read32"
+WRITE16 = "write16"
+WRITE32 = "write32"
+
+WIDTHS = {READ16: 16, READ32: 32, WRITE16: 16, WRITE32: 32}
+
+# A row of a replay table, i.e. one register command seen in SP Flash Tool
+# traffic.
+#
+# For reads, `value` is the number of words to read (1 if omitted) and
+# `reference` is the value seen in the traffic dump; a different value is
+# reported as a warning. The value is logged if the step has a `name`.
+#
+# For writes, `value` is a word or a list of words. If `reference` is set,
+# the write is verified like `write16_verify` does: the register is read
+# before the write and compared with `reference`, then it's read back and
+# compared with `value`. `response` is the status BROM should reply with.
+#
+# `verbatim` marks steps that are only there because SP Flash Tool sends
+# them, e.g. reads whose values nobody uses. The lean profile drops them.
+Step = namedtuple(
+    "Step",
+    "op addr value reference check_status response name verbatim",
+    defaults=(None, None, True, 0, None, False),
+)
+
+# A row of a replay table that calls a BromProtocol method, e.g.
+# `Call("get_preloader_version")`. Its result is not used.
+Call = namedtuple("Call", "method args verbatim", defaults=((), False))
+
+
+# Rows of a table replayed with the verbatim SP Flash Tool flow, or with
+# the lean profile that leaves out the `verbatim` rows. Both profiles must
+# leave the device in the same state, see `benchmarks/lean-replay.py`.
+def profile_rows(table, lean=False):
+    return [row for row in table if not (lean and row.verbatim)]
+
+
+# Register command of a compiled plan. It may cover several table steps:
+# `parts` holds a (step, role, words) tuple for each of them, where role
+# is one of the Command.* constants.
+class Command:
+    READ = 0  # plain read of a step
+    BEFORE = 1  # verification read before a write
+    AFTER = 2  # verification read after a write
+    WRITE = 3
+
+    def __init__(self, is_write, width, addr, words, check_status, response):
+        self.is_write = is_write
+        self.width = width
+        self.addr = addr
+        self.words = words  # values to write or amount of words to read
+        self.check_status = check_status
+        self.response = response
+        self.parts = []
+
+    def size(self):
+        words = len(self.words) if self.is_write else self.words
+        return words * self.width // 8
+
+    # Merge `other` into this command if it continues it: same kind of
+    # command and its address follows the last word of this one.
+    def merge(self, other):
+        if (
+            self.is_write != other.is_write
+            or self.width != other.width
+            or self.check_status != other.check_status
+            or self.response != other.response
+            or self.addr + self.size() != other.addr
+        ):
+            return False
+        self.words = self.words + other.words
+        self.parts += other.parts
+        return True
+
+
+# Replay table compiled into an execution plan. Consecutive register
+# commands are sent as pipelined batches, so a batch costs a single round
+# trip plus one for every write whose arguments are checked (see
+# BromPipeline) no matter how many reads and status checks it holds.
+# Commands that access consecutive addresses are merged into one command
+# with several words. Calls can depend on anything that happened before
+# them, so they end the current batch.
+#
+# A table is compiled once and can then be executed any number of times.
+class ReplayPlan:
+    MAX_BATCH_SIZE = 64  # commands
+
+    def __init__(self, table, merge=True):
+        self.blocks = []  # lists of commands (batches) or calls
+        self.compile(table, merge)
+
+    def __len__(self):
+        return sum(len(block) if isinstance(block, list) else 1 for block in self)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def compile(self, table, merge):
+        batch = None
+        for step in table:
+            if isinstance(step, Call):
+                self.blocks.append(step)
+                batch = None
+                continue
+
+            for command in ReplayPlan.expand(step):
+                if batch and merge and batch[-1].merge(command):
+                    continue
+                if not batch or len(batch) >= ReplayPlan.MAX_BATCH_SIZE:
+                    batch = []
+                    self.blocks.append(batch)
+                batch.append(command)
+
+    # Turn a table step into register commands
+    @staticmethod
+    def expand(step):
+        if step.op not in WIDTHS:
+            raise RuntimeError(f"Unknown replay operation {step.op}")
+        width = WIDTHS[step.op]
+
+        def read(role, amount=1):
+            command = Command(False, width, step.addr, amount, step.check_status, 0)
+            command.parts.append((step, role, amount))
+            return command
+
+        if step.op in (READ16, READ32):
+            return [read(Command.READ, step.value or 1)]
+
+        words = step.value if isinstance(step.value, list) else [step.value]
+        write = Command(True, width, step.addr, words, step.check_status, step.response)
+        write.parts.append((step, Command.WRITE, len(words)))
+        if step.reference is None:
+            return [write]
+        return [read(Command.BEFORE), write, read(Command.AFTER)]
+
+    # Run the plan. Returns values of read steps in table order: an int
+    # for single-word reads and a list otherwise.
+    def execute(self, brom):
+        results = []
+        for block in self.blocks:
+            if isinstance(block, Call):
+                getattr(brom, block.method)(*block.args)
+                continue
+
+            with brom.pipeline() as pipeline:
+                for command in block:
+                    if command.is_write:
+                        write = getattr(pipeline, f"write{command.width}")
+                        write(
+                            command.addr,
+                            command.words,
+                            command.response,
+                            command.check_status,
+                        )
+                    else:
+                        read = getattr(pipeline, f"read{command.width}")
+                        read(command.addr, command.words, command.check_status)
+
+            values = iter(pipeline.results)
+            for command in block:
+                if command.is_write:
+                    continue
+                words = next(values)
+                words = words if isinstance(words, list) else [words]
+                for step, role, amount in command.parts:
+                    value = words[:amount] if amount > 1 else words[0]
+                    words = words[amount:]
+                    ReplayPlan.check(step, role, value)
+                    if role == Command.READ:
+                        results.append(value)
+        return results
+
+    @staticmethod
+    def check(step, role, value):
+        size = WIDTHS[step.op] // 8
+        if role == Command.AFTER:
+            if value != step.value:
+                logging.warning(
+                    f"Set {as_0x(step.addr)} "
+                    f"to {as_hex(step.value, size=size)} but "
+                    f"it is {as_hex(value, size=size)}"
+                )
+            return
+
+        if step.reference is not None and value != step.reference:
+            logging.warning(
+                f"Read {as_0x(step.addr)}, "
+                f"got {as_hex(value, size=size)} but "
+                f"reference is {as_hex(step.reference, size=size)}"
+            )
+        if role == Command.READ and step.name:
+            logging.replay(
+                f"{step.name} {as_0x(step.addr)} == {as_hex(value, size=size)}"
+            )
@@ -0,0 +1,667 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import copy
+import logging
+import os
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+import zlib
+
+from src.chunkdump import CHUNK_HEADER, CMD_READ
+from src.common import as_0x, as_hex, report_write_progress, to_bytes
+from src.receiver import (
+    HELLO_FLAG_CHUNKED,
+    HELLO_FLAG_RLE,
+    MAGIC_GOODBYE,
+    MAGIC_HELLO,
+    MAGIC_HELLO_FLAGS,
+    encode_rle,
+)
+from src.transport import AbstractTransport, UsbTransport
+
+# (latency per transfer in seconds, bandwidth in bytes per second)
+LINK_PRESETS = {
+    # 1 ms frames, ~8 Mbit/s of useful bulk bandwidth
+    "full-speed": (0.001, 1000 * 1000),
+    # 125 us microframes, ~280 Mbit/s of useful bulk bandwidth
+    "high-speed": (0.000125, 35 * 1000 * 1000),
+    # no delays at all, useful for measuring host-side overhead only
+    "ideal": (0, 0),
+}
+
+# Reference values below come from the traffic captures of my devices
+# where possible, the rest are made up but consistent with what the
+# replay code in `platform.py` expects.
+DEVICE_PROFILES = {
+    0x6250: {  # MT6252CA, legacy protocol
+        "legacy": True,
+        "brom_version": 0x01,
+        "registers": {
+            0x80010000: 0xCF00,  # HW version
+            0x80010004: 0x0101,  # SW version
+            0x80010008: 0x6250,  # HW code
+            0x8001000C: 0x8B00,  # HW subcode
+            0x810B0000: 0x0008,  # RTC_BBPU
+        },
+        # 4 MiB of external SRAM, nothing is decoded above it
+        "holes": [(0x08400000, 0x09000000)],
+        "da_trailer": b"\x00" * 4,
+        # BROM, SRAM and DA, see payloads/include/mt6252/hw-api.h
+        "dump_regions": [
+            (0x48000000, 0x8000),
+            (0x40000000, 0xC000),
+            (0x08100000, 0x20000),
+        ],
+    },
+    0x6573: {
+        "hw_sw_ver": (0x8A00, 0xCA00, 0x0000),
+        "registers": {
+            0x70026000: 0xCA00,  # HW version
+            0x70026004: 0x0000,  # SW version
+            0x7002FE84: 0xFF00,  # KPLED_CON1
+            0x7002FA0C: 0x3079,  # CHR_CON3
+            0x7002FA08: 0x4700,  # CHR_CON2
+            0x7002FA18: 0x0010,  # CHR_CON6
+            0x7002FA00: 0x62B2,  # CHR_CON0
+            0x7002FA24: 0x0080,  # CHR_CON9
+            0x70014000: 0x0008,  # RTC_BBPU
+        },
+        "da_trailer": b"\xC0\x03\x02\x83",
+        # BROM, SRAM and DA, see payloads/include/mt6573/hw-api.h
+        "dump_regions": [
+            (0x48000000, 0x10000),
+            (0x40000000, 0x40000),
+            (0x90005000, 0x1B000),
+        ],
+    },
+    0x6575: {  # MT6575E2, handled as MT6577
+        "hw_sw_ver": (0x8B00, 0xCB00, 0xE201),
+        "registers": {
+            0xC0000000: 0x0000,  # TOPRGU_WDT_MODE
+            0xC1003000: 0x0008,  # RTC_BBPU
+        },
+        # BROM, SRAM and DA, see payloads/include/mt6577/hw-api.h
+        "dump_regions": [
+            (0xFFFF0000, 0x10000),
+            (0xF0000000, 0x10000),
+            (0xC2000000, 0x40000),
+        ],
+    },
+    0x6580: {
+        "hw_sw_ver": (0x8A00, 0xCA00, 0x0000),
+        "write_status": 0x0001,
+        "write_protected": [(0x00000000, 0x10000)],  # BROM
+        "registers": {
+            0x10009040: 0x00000000,  # EFUSE
+        },
+        # BROM, SRAM and DA, see payloads/include/mt6580/hw-api.h
+        "dump_regions": [
+            (0x00000000, 0x10000),
+            (0x100000, 0x12000),
+            (0x200000, 0x20000),
+        ],
+    },
+    0x6582: {
+        "hw_sw_ver": (0x8A00, 0xCA00, 0x0000),
+        "write_status": 0x0001,
+        "write_protected": [(0x00000000, 0x10000)],  # BROM
+        "registers": {
+            0x10206044: 0x00000000,  # EFUSE
+        },
+        # BROM, SRAM and DA, see payloads/include/mt6582/hw-api.h
+        "dump_regions": [
+            (0x00000000, 0x10000),
+            (0x100000, 0x10000),
+            (0x200000, 0x20000),
+        ],
+    },
+    0x6583: {  # MT6589
+        "hw_sw_ver": (0x8A00, 0xCA00, 0x0000),
+        "pmic": {
+            0x0000: 0x0063,  # CHR_CON0
+            0x0008: 0x000F,  # CHR_CON4
+            0x000C: 0x0041,  # CHR_CON6
+            0x000E: 0x1001,  # CHR_CON7
+            0x001A: 0x0010,  # CHR_CON13
+            0x0020: 0x0001,  # CHR_CON16
+        },
+        # DRAM info, EMMC CID etc. sent by the original DA
+        "da_trailer": b"\x00" * 21 + b"\x15\x01\x00\x4D" + b"\x00" * 12,
+        "da_ack": b"\x5A",
+        # BROM, SRAM and DA, see payloads/include/mt6589/hw-api.h
+        "dump_regions": [
+            (0x00000000, 0x10000),
+            (0x100000, 0x10000),
+            (0x12000000, 0x40000),
+        ],
+    },
+}
+
+DEFAULT_PROFILE = {
+    "legacy": False,
+    "hw_sw_ver": (0x8A00, 0xCA00, 0x0000),
+    "brom_version": 0x05,
+    "me_id": bytes(range(16)),
+    "target_config": 0x00000000,
+    "write_status": 0x0000,
+    # (start, end): register writes are rejected with `reject_status` and
+    # their words are not taken, e.g. BROM itself
+    "write_protected": [],
+    "reject_status": 0x1D0C,  # made up
+    "registers": {},
+    "pmic": {},
+    "aliases": [],  # (start, size, span): [start, start+span) wraps every `size`
+    "holes": [],  # (start, end): writes are ignored, reads return zeroes
+    "da_trailer": b"",  # sent by the "original DA" right after the jump
+    "da_ack": b"",  # expected from the host after the trailer
+    "dump_regions": [],  # (addr, size) sent by the "usb-dump payload"
+    "dump_flags": 0,  # HELLO_FLAG_*, e.g. HELLO_FLAG_RLE for usb-dump-rle
+    # Faults of usb-dump-chunked: number of the chunk request (from 0) ->
+    # "corrupt" (flip a bit of the data), "drop" (no reply) or "stop"
+    # (no reply to this and any later request, like an unplugged cable)
+    "dump_faults": {},
+}
+
+
+# Checksum of the DA as computed by BROM: XOR of 16-bit little-endian words
+def da_checksum(data):
+    checksum = 0
+    for i in range(0, len(data) - 1, 2):
+        checksum ^= data[i] | data[i + 1] << 8
+    return checksum
+
+
+# Sparse byte-addressable memory split into pages. Aliases and holes
+# must be page aligned.
+class Memory:
+    PAGE_SIZE = 0x1000
+
+    def __init__(self, aliases=(), holes=()):
+        self.pages = {}
+        self.aliases = list(aliases)
+        self.holes = list(holes)
+
+    # Physical address of `addr`, or None if nothing is decoded there
+    def translate(self, addr):
+        for start, end in self.holes:
+            if start <= addr < end:
+                return None
+        for start, size, span in self.aliases:
+            if start <= addr < start + span:
+                return start + (addr - start) % size
+        return addr
+
+    def chunks(self, addr, size):
+        while size:
+            n = min(size, Memory.PAGE_SIZE - addr % Memory.PAGE_SIZE)
+            yield addr, n
+            addr += n
+            size -= n
+
+    def read(self, addr, size):
+        result = bytearray()
+        for chunk_addr, n in self.chunks(addr, size):
+            phys = self.translate(chunk_addr)
+            page = None if phys is None else self.pages.get(phys // Memory.PAGE_SIZE)
+            if page is None:
+                result += bytes(n)
+            else:
+                off = phys % Memory.PAGE_SIZE
+                result += page[off : off + n]
+        return bytes(result)
+
+    def write(self, addr, data):
+        pos = 0
+        for chunk_addr, n in self.chunks(addr, len(data)):
+            phys = self.translate(chunk_addr)
+            if phys is not None:
+                page = self.pages.setdefault(
+                    phys // Memory.PAGE_SIZE, bytearray(Memory.PAGE_SIZE)
+                )
+                off = phys % Memory.PAGE_SIZE
+                page[off : off + n] = data[pos : pos + n]
+            pos += n
+
+    def read_int(self, addr, size):
+        return int.from_bytes(self.read(addr, size), "little")
+
+    def write_int(self, addr, value, size):
+        self.write(addr, value.to_bytes(size, "little"))
+
+
+# Emulation of a BROM-mode device. The firmware is written as generators
+# that yield the amount of bytes they need next and receive these bytes
+# once the host has sent them. Replies are appended to `outbuf`.
+class SimulatedDevice:
+    def __init__(self, hw_code, **overrides):
+        self.hw_code = hw_code
+        self.profile = copy.deepcopy(DEFAULT_PROFILE)
+        self.profile.update(copy.deepcopy(DEVICE_PROFILES.get(hw_code, {})))
+        self.profile.update(overrides)
+
+        self.memory = Memory(self.profile["aliases"], self.profile["holes"])
+        for addr, value in self.profile["registers"].items():
+            self.memory.write_int(addr, value, 4)
+        self.pmic = dict(self.profile["pmic"])
+
+        self.commands = {
+            0xA1: self.cmd_legacy_write16,
+            0xA2: self.cmd_legacy_read16,
+            0xA4: self.cmd_checksum_legacy,
+            0xA8: self.cmd_jump_da_legacy,
+            0xAD: self.cmd_send_da_legacy,
+            0xAE: self.cmd_legacy_write32,
+            0xAF: self.cmd_legacy_read32,
+            0xC4: self.cmd_power_init,
+            0xC5: self.cmd_power_deinit,
+            0xC6: self.cmd_power_read16,
+            0xC7: self.cmd_power_write16,
+            0xD0: self.cmd_read16,
+            0xD1: self.cmd_read32,
+            0xD2: self.cmd_write16,
+            0xD4: self.cmd_write32,
+            0xD5: self.cmd_jump_da,
+            0xD7: self.cmd_send_da,
+            0xD8: self.cmd_get_target_config,
+            0xDB: self.cmd_uart1_log_enable,
+            0xE1: self.cmd_get_me_id,
+            0xFC: self.cmd_get_hw_sw_ver,
+            0xFD: self.cmd_get_hw_code,
+            0xFE: self.cmd_get_preloader_version,
+            0xFF: self.cmd_get_brom_version,
+        }
+        self.executed = []  # opcodes in order of execution
+        self.jumped_to = None
+
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.program = self.firmware()
+        self.need = next(self.program)
+
+    # Bytes sent by the host
+    def feed(self, data):
+        self.inbuf += data
+        while self.need and len(self.inbuf) >= self.need:
+            chunk = bytes(self.inbuf[: self.need])
+            del self.inbuf[: self.need]
+            self.need = self.program.send(chunk)
+
+    # Bytes to be received by the host
+    def take(self, size):
+        data = bytes(self.outbuf[:size])
+        del self.outbuf[:size]
+        return data
+
+    def emit(self, data):
+        self.outbuf += data
+
+    def recv_echo(self, size):
+        data = yield size
+        self.emit(data)
+        return int.from_bytes(data, "big")
+
+    def status(self, value=0):
+        self.emit(to_bytes(value, 2))
+
+    def firmware(self):
+        yield from self.handshake()
+        while self.jumped_to is None:
+            (cmd,) = yield 1
+            handler = self.commands.get(cmd)
+            self.executed.append(cmd)
+            if cmd != 0xFF:  # everything but "Get BROM version" is echoed
+                self.emit(bytes([cmd]))
+            if handler:
+                yield from handler()
+            else:
+                logging.warning(f"Simulator: unknown command {as_hex(cmd, 1)}")
+        yield from self.payload()
+        while True:  # the payload has finished, ignore everything
+            yield 1
+
+    def handshake(self):
+        sequence = b"\xA0\x0A\x50\x05"
+        i = 0
+        while i < len(sequence):
+            (byte,) = yield 1
+            if byte == sequence[i]:
+                self.emit(bytes([~byte & 0xFF]))
+                i += 1
+            else:
+                self.emit(bytes([byte]))
+                i = 1 if byte == sequence[0] else 0
+
+    # Behavior of the code the host has jumped to: the original DA sends
+    # some data and waits for an acknowledgement, then the usb-dump
+    # piggyback sends the requested regions.
+    def payload(self):
+        self.emit(self.profile["da_trailer"])
+        if self.profile["da_ack"]:
+            yield len(self.profile["da_ack"])
+
+        regions = self.profile["dump_regions"]
+        flags = self.profile["dump_flags"]
+        if regions and flags & HELLO_FLAG_CHUNKED:
+            yield from self.chunked_payload(regions)
+        elif regions:
+            if flags:
+                self.emit(to_bytes(MAGIC_HELLO_FLAGS, 4))
+                self.emit(to_bytes(flags, 4))
+            else:
+                self.emit(to_bytes(MAGIC_HELLO, 4))
+            for addr, size in regions:
+                self.emit(to_bytes(size, 4))
+                data = self.memory.read(addr, size)
+                self.emit(encode_rle(data) if flags & HELLO_FLAG_RLE else data)
+            self.emit(to_bytes(MAGIC_GOODBYE, 4))
+
+    # usb-dump-chunked, see `payloads/src/piggyback/usb-dump-chunked.c`
+    def chunked_payload(self, regions):
+        self.emit(to_bytes(MAGIC_HELLO_FLAGS, 4))
+        self.emit(to_bytes(HELLO_FLAG_CHUNKED, 4))
+        self.emit(to_bytes(len(regions), 4))
+        for addr, size in regions:
+            self.emit(struct.pack(">II", addr, size))
+
+        faults = self.profile["dump_faults"]
+        requests = 0
+        stopped = False
+        while True:
+            cmd = int.from_bytes((yield 4), "big")
+            if cmd == MAGIC_GOODBYE:
+                self.emit(to_bytes(MAGIC_GOODBYE, 4))
+                return
+            if cmd != CMD_READ:
+                continue
+            region, offset, length = CHUNK_HEADER.unpack((yield CHUNK_HEADER.size))
+            fault = faults.get(requests)
+            requests += 1
+            stopped = stopped or fault == "stop"
+            if stopped or fault == "drop":
+                continue
+
+            addr, size = regions[region] if region < len(regions) else (0, 0)
+            if offset + length > size:
+                length = 0
+            data = bytearray(self.memory.read(addr + offset, length))
+            crc = zlib.crc32(data)
+            if fault == "corrupt" and data:
+                data[len(data) // 2] ^= 0x01
+            self.emit(CHUNK_HEADER.pack(region, offset, length))
+            self.emit(bytes(data) + to_bytes(crc, 4))
+
+    def read_words(self, width, check_status):
+        addr = yield from self.recv_echo(4)
+        amount = yield from self.recv_echo(4)
+        if check_status:
+            self.status()
+        for i in range(amount):
+            value = self.memory.read_int(addr + i * width, width)
+            self.emit(to_bytes(value, width))
+        if check_status:
+            self.status()
+
+    def write_words(self, width, check_status):
+        addr = yield from self.recv_echo(4)
+        amount = yield from self.recv_echo(4)
+        if check_status:
+            end = addr + amount * width
+            for start, stop in self.profile["write_protected"]:
+                if addr < stop and start < end:
+                    self.status(self.profile["reject_status"])
+                    return
+            self.status(self.profile["write_status"])
+        for i in range(amount):
+            value = yield from self.recv_echo(width)
+            self.memory.write_int(addr + i * width, value, width)
+        if check_status:
+            self.status(self.profile["write_status"])
+
+    def cmd_read16(self):
+        yield from self.read_words(2, True)
+
+    def cmd_read32(self):
+        yield from self.read_words(4, True)
+
+    def cmd_legacy_read16(self):
+        yield from self.read_words(2, False)
+
+    def cmd_legacy_read32(self):
+        yield from self.read_words(4, False)
+
+    def cmd_write16(self):
+        yield from self.write_words(2, True)
+
+    def cmd_write32(self):
+        yield from self.write_words(4, True)
+
+    def cmd_legacy_write16(self):
+        yield from self.write_words(2, False)
+
+    def cmd_legacy_write32(self):
+        yield from self.write_words(4, False)
+
+    def cmd_get_hw_code(self):
+        if self.profile["legacy"]:
+            return  # legacy BROM echoes the command but doesn't reply
+        self.emit(to_bytes(self.hw_code, 2))
+        self.status()
+        yield from ()
+
+    def cmd_get_hw_sw_ver(self):
+        for value in self.profile["hw_sw_ver"]:
+            self.emit(to_bytes(value, 2))
+        self.status()
+        yield from ()
+
+    def cmd_get_target_config(self):
+        self.emit(to_bytes(self.profile["target_config"], 4))
+        self.status()
+        yield from ()
+
+    def cmd_get_me_id(self):
+        me_id = self.profile["me_id"]
+        self.emit(to_bytes(len(me_id), 4))
+        self.emit(me_id)
+        self.status()
+        yield from ()
+
+    def cmd_get_preloader_version(self):
+        yield from ()  # not available in BROM mode, the echo is the answer
+
+    def cmd_get_brom_version(self):
+        self.emit(to_bytes(self.profile["brom_version"], 1))
+        yield from ()
+
+    def cmd_uart1_log_enable(self):
+        self.status()
+        yield from ()
+
+    def cmd_power_init(self):
+        yield from self.recv_echo(4)  # register
+        yield from self.recv_echo(4)  # value
+        self.status()
+
+    def cmd_power_deinit(self):
+        self.status()
+        yield from ()
+
+    def cmd_power_read16(self):
+        reg = yield from self.recv_echo(2)
+        self.status()  # ack
+        self.status()  # PMIC read status
+        self.emit(to_bytes(self.pmic.get(reg, 0), 2))
+
+    def cmd_power_write16(self):
+        reg = yield from self.recv_echo(2)
+        self.pmic[reg] = yield from self.recv_echo(2)
+        self.status()  # ack
+        self.status()  # PMIC write status
+
+    def cmd_send_da(self):
+        addr = yield from self.recv_echo(4)
+        size = yield from self.recv_echo(4)
+        yield from self.recv_echo(4)  # signature length
+        self.status()
+        da = yield size
+        self.memory.write(addr, da)
+        logging.debug(f"Simulator: received {size} bytes of DA at {as_0x(addr)}")
+        self.emit(to_bytes(da_checksum(da), 2))
+        self.status()
+
+    def cmd_send_da_legacy(self):
+        addr = yield from self.recv_echo(4)
+        words = yield from self.recv_echo(4)
+        da = bytearray((yield words * 2))
+        da[0::2], da[1::2] = da[1::2], da[0::2]  # undo the byte swap
+        self.memory.write(addr, da)
+
+    def cmd_checksum_legacy(self):
+        addr = yield from self.recv_echo(4)
+        words = yield from self.recv_echo(4)
+        self.emit(to_bytes(da_checksum(self.memory.read(addr, words * 2)), 2))
+
+    def cmd_jump_da(self):
+        self.jumped_to = yield from self.recv_echo(4)
+        self.status()
+
+    def cmd_jump_da_legacy(self):
+        self.jumped_to = yield from self.recv_echo(4)
+
+
+# Transport connected to a SimulatedDevice. Every transfer is accounted
+# by the link model, so the wall time a real device would need can be
+# estimated (or reproduced with `realtime=True`) without any hardware.
+class SimulatedTransport(AbstractTransport):
+    PACKET_SIZE = 1024  # same as UsbTransport.write
+
+    def __init__(self, device, link="high-speed", realtime=False):
+        self.device = device
+        self.latency, self.bandwidth = LINK_PRESETS[link]
+        self.realtime = realtime
+        self.modeled_time = 0
+        self.transfers = 0
+        self.round_trips = 0  # reads, i.e. times the host waited for the device
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+    def start(self):
+        self.arrived_at = time.monotonic()
+        hw_code = as_hex(self.device.hw_code, 2)
+        logging.info(f"Simulating a device with HW code {hw_code}")
+
+    def stop(self):
+        logging.info(
+            f"Simulated transport has stopped! {self.transfers} transfers, "
+            f"{self.round_trips} round trips, "
+            f"{self.bytes_out} bytes out, {self.bytes_in} bytes in, "
+            f"modeled time {self.modeled_time:.3f} s"
+        )
+
+    def account(self, size, waited=0):
+        delay = self.latency + waited
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        self.modeled_time += delay
+        self.transfers += 1
+        if self.realtime and delay:
+            time.sleep(delay)
+
+    def read(self, size=1, timeout=-1):
+        timeout = timeout if timeout > 0 else UsbTransport.BROM_TIMEOUT
+
+        data = self.device.take(size)
+        self.round_trips += 1
+        # A real transfer would block until the timeout expires
+        self.account(len(data), timeout / 1000 if len(data) < size else 0)
+        self.bytes_in += len(data)
+        if self.metrics:
+            self.metrics.record_read(size, len(data))
+        if self.capture:
+            self.capture.record_in(0x81, size, data, time.time())
+        if logging.root.isEnabledFor(logging.BROM_IO):
+            logging.brom_io(f"<- {as_hex(data)}")
+        return data
+
+    def write(self, data, size=1, timeout=-1, progress=True):
+        if isinstance(data, int):
+            data = to_bytes(data, size)
+
+        data_sz = len(data)
+        for off_start in range(0, data_sz, SimulatedTransport.PACKET_SIZE):
+            off_end = min(off_start + SimulatedTransport.PACKET_SIZE, data_sz)
+            chunk = bytes(data[off_start:off_end])
+            if logging.root.isEnabledFor(logging.BROM_IO):
+                logging.brom_io(f"-> {as_hex(chunk)}")
+            if self.capture:
+                self.capture.record_out(0x01, chunk, time.time())
+            self.account(len(chunk))
+            self.bytes_out += len(chunk)
+            self.device.feed(chunk)
+            if progress:
+                report_write_progress(off_start, off_end, data_sz)
+        if self.metrics:
+            self.metrics.record_write(data_sz)
+
+
+# Serve a SimulatedDevice on a pseudo-terminal, standing in for a serial
+# port: open `port` with UartTransport like a real USB-UART adapter. With
+# `realtime=True` replies are paced by the baudrate the port is set to,
+# 10 bits per byte as with 8N1.
+class PtyDevice:
+    def __init__(self, device, realtime=False):
+        self.device = device
+        self.realtime = realtime
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)  # until the transport configures the port
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        logging.info(f"Simulated device is listening on {self.port}")
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # Baudrate the port has been set to by the host
+    def baudrate(self):
+        speeds = {
+            getattr(termios, name): int(name[1:])
+            for name in dir(termios)
+            if name[0] == "B" and name[1:].isdigit()
+        }
+        return speeds.get(termios.tcgetattr(self.master)[5], 0)
+
+    def serve(self):
+        while self.running:
+            pending = len(self.device.outbuf)
+            readable, writable, _ = select.select(
+                [self.master], [self.master] if pending else [], [], 0.05
+            )
+            if readable:
+                try:
+                    self.device.feed(os.read(self.master, 4096))
+                except OSError:
+                    pass  # nobody has the port open
+            if writable:
+                data = self.device.take(4096)
+                baudrate = self.baudrate() if self.realtime else 0
+                if baudrate:
+                    time.sleep(len(data) * 10 / baudrate)
+                written = os.write(self.master, data)
+                self.device.outbuf[:0] = data[written:]
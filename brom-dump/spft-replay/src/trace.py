@@ -0,0 +1,126 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import json
+import os
+import time
+
+from src.common import as_0x
+
+
+# Short description of command arguments for the trace: addresses and
+# values in hex, buffers by their size
+def describe(args):
+    result = []
+    for arg in args:
+        if isinstance(arg, bool):
+            result.append(str(arg))
+        elif isinstance(arg, int):
+            result.append(as_0x(arg))
+        elif isinstance(arg, (bytes, bytearray, memoryview)):
+            result.append(f"{len(arg)} bytes")
+        elif isinstance(arg, list) and len(arg) <= 8:
+            result.append(f"[{', '.join(describe(arg))}]")
+        else:
+            result.append(type(arg).__name__)
+    return result
+
+
+# Timeline of a session in the Chrome trace-event format, which opens in
+# chrome://tracing and https://ui.perfetto.dev. Spans nest by time:
+# the stages of DeviceManager, the BROM commands executed in them (every
+# command, including those called by other commands) and the transfers
+# of the transport with their sizes. The duration of a read is the time
+# spent waiting for the device.
+#
+# Usage:
+#     tracer = Tracer()
+#     brom.set_tracer(tracer)
+#     manager.add_observer(tracer)
+#     ...
+#     tracer.save("trace.json", "MT6589")
+class Tracer:
+    PID = 1
+    TID = 1
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.stages = {}  # name -> start time
+
+    # Complete event between two time.perf_counter() timestamps
+    def span(self, name, category, started, finished, args=None):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((started - self.origin) * 1e6, 3),  # us
+            "dur": round((finished - started) * 1e6, 3),
+            "pid": Tracer.PID,
+            "tid": Tracer.TID,
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def stage_started(self, name):
+        self.stages[name] = time.perf_counter()
+
+    def stage_finished(self, name):
+        self.span(name, "stage", self.stages.pop(name), time.perf_counter())
+
+    def save(self, path, process_name="spft-replay"):
+        metadata = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": Tracer.PID,
+                "args": {"name": process_name},
+            },
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": Tracer.PID,
+                "tid": Tracer.TID,
+                "args": {"name": "session"},
+            },
+        ]
+        trace = {"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as fos:
+            json.dump(trace, fos)
+
+
+# Asynchronous transport (or AsyncTransportAdapter) that records every
+# call in a Tracer. Only used while tracing, so it costs nothing otherwise.
+class TracingTransport:
+    def __init__(self, transport, tracer):
+        self.transport = transport
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    async def read(self, size=1, timeout=-1):
+        return bytes(await self.read_view(size, timeout))
+
+    async def read_view(self, size=1, timeout=-1):
+        started = time.perf_counter()
+        data = await self.transport.read_view(size, timeout)
+        args = {"requested": size, "received": len(data)}
+        if len(data) < size:
+            args["timeout"] = True
+        self.tracer.span("read", "usb", started, time.perf_counter(), args)
+        return data
+
+    async def write(self, data, size=1, timeout=-1, progress=True):
+        started = time.perf_counter()
+        await self.transport.write(data, size, timeout, progress)
+        written = size if isinstance(data, int) else len(data)
+        args = {"size": written}
+        self.tracer.span("write", "usb", started, time.perf_counter(), args)
+
+    async def echo(self, words, size=1):
+        started = time.perf_counter()
+        await self.transport.echo(words, size)
+        self.tracer.span("echo", "usb", started, time.perf_counter(), {"size": size})
@@ -3,16 +3,33 @@
 
 import array
 import logging
+import select
 import time
 from abc import ABC, abstractmethod
 
-import usb
-import usb.backend.libusb1
-
+from src.buffer import RxBuffer
 from src.common import as_hex, from_bytes, report_write_progress, to_bytes
+from src.discovery import BROM_PID, BROM_VID, DeviceWatcher, libusb1_device_path
+
+
+def check_reply(test, gold):
+    if test != gold:
+        test = as_hex(test)
+        gold = as_hex(gold)
+        raise RuntimeError(f"Unexpected output, expected {gold} got {test}")
 
 
 class AbstractTransport(ABC):
+    # Optional recorder of raw traffic (see `src/capture.py`). Transports
+    # must check it before doing any extra work so that disabled capture
+    # costs nothing.
+    capture = None
+    # time.monotonic() timestamp of the moment the device has been found
+    arrived_at = None
+    # Metrics of the session (see `src/metrics.py`) set by BromProtocol.
+    # Transports record every read and write in them.
+    metrics = None
+
     @abstractmethod
     def __init__(self):
         pass
@@ -30,14 +47,19 @@ class AbstractTransport(ABC):
         pass
 
     @abstractmethod
-    def write(self, data, size=1, timeout=-1):
+    def write(self, data, size=1, timeout=-1, progress=True):
         pass
 
+    # Transports with an internal receive buffer may override this to
+    # avoid copying. The returned view is valid until the next read.
+    def read_view(self, size=1, timeout=-1):
+        return memoryview(self.read(size, timeout))
+
+    def set_capture(self, capture):
+        self.capture = capture
+
     def check(self, test, gold):
-        if test != gold:
-            test = as_hex(test)
-            gold = as_hex(gold)
-            raise RuntimeError(f"Unexpected output, expected {gold} got {test}")
+        check_reply(test, gold)
 
     def echo(self, words, size=1):
         self.write(words, size)
@@ -45,38 +67,44 @@ class AbstractTransport(ABC):
 
 
 class UsbTransport(AbstractTransport):
-    BROM_VID = 0x0E8D
-    BROM_PID = 0x0003
+    BROM_VID = BROM_VID
+    BROM_PID = BROM_PID
     BROM_BAUDRATE = 115200
     BROM_TIMEOUT = 3 * 1000  # ms
 
-    def __init__(self):
-        self.backend = None
+    # `path` selects the device plugged into a specific port (see
+    # `src.discovery.usb_device_path`), otherwise the first device found is used.
+    # An already initialized pyusb `backend` can be shared between sessions.
+    # `reset_delay` is how long `stop` waits for the device to settle after
+    # the reset; callers that wait for the next device anyway may skip it.
+    def __init__(self, path=None, backend=None, reset_delay=1.0):
+        self.path = path
+        self.backend = backend
+        self.reset_delay = reset_delay
+        self.usb = None
         self.device = None
         self.ep_in = None
         self.ep_out = None
-        self.rxbuffer = array.array("B")
+        self.rxbuffer = RxBuffer()
 
     def start(self):
-        logging.info("Init backend")
-        self.backend = usb.backend.libusb1.get_backend()
+        # pyusb and the libusb backend are only loaded by the sessions that
+        # use them, simulated and UART sessions start faster without
+        import usb.backend.libusb1
+        import usb.util
+
+        self.usb = usb
+        if not self.backend:
+            logging.info("Init backend")
+            self.backend = usb.backend.libusb1.get_backend()
         if not self.backend:
             raise RuntimeError("Could not initialize the libusb1 backend")
 
-        logging.info(
-            f"Waiting for device in BROM mode "
-            f"({as_hex(UsbTransport.BROM_VID, 2)}:{as_hex(UsbTransport.BROM_PID, 2)})"
-        )
-        while not self.device:
-            self.device = usb.core.find(
-                idVendor=UsbTransport.BROM_VID,
-                idProduct=UsbTransport.BROM_PID,
-                backend=self.backend,
-            )
-            if self.device:
-                break
-            time.sleep(0.25)
-        logging.info("Found device")
+        watcher = DeviceWatcher(self.backend, self.path)
+        self.device = watcher.wait()
+        self.arrived_at = watcher.arrived_at
+        if self.capture:
+            self.capture.set_device(self.device.bus, self.device.address)
 
         try:
             if self.device.is_kernel_driver_active(0):
@@ -133,11 +161,11 @@ class UsbTransport(AbstractTransport):
         )
 
     def stop(self):
-        self.rxbuffer = array.array("B")
+        self.rxbuffer.clear()
 
         try:
-            usb.util.release_interface(self.device, 0)
-            usb.util.release_interface(self.device, 1)
+            self.usb.util.release_interface(self.device, 0)
+            self.usb.util.release_interface(self.device, 1)
         except Exception:
             logging.debug("USB: Could not release interfaces")
 
@@ -153,43 +181,66 @@ class UsbTransport(AbstractTransport):
                 logging.debug(f"USB: Could not reattach kernel driver on interface {i}")
 
         try:
-            usb.util.dispose_resources(self.device)
+            self.usb.util.dispose_resources(self.device)
         except Exception:
             logging.debug("USB: Could not dispose resources")
 
         self.device = None
-        time.sleep(1)
+        if self.reset_delay:
+            time.sleep(self.reset_delay)
 
         logging.info("USB transport has stopped!")
 
-    def read(self, size=1, timeout=-1):
-        timeout = timeout if timeout > 0 else UsbTransport.BROM_TIMEOUT
-
-        while len(self.rxbuffer) < size:
-            try:
-                self.rxbuffer.extend(
-                    self.ep_in.read(self.ep_in.wMaxPacketSize, timeout)
+    # Fetch up to `max_size` bytes from the IN endpoint in one bulk transfer
+    def bulk_read(self, max_size, timeout):
+        submitted_at = time.time() if self.capture else 0
+        try:
+            data = self.ep_in.read(max_size, timeout)
+        except self.usb.core.USBError as e:
+            if self.capture:
+                self.capture.record_in(
+                    self.ep_in.bEndpointAddress,
+                    max_size,
+                    b"",
+                    submitted_at,
+                    -(e.errno or 0),
                 )
-            except usb.core.USBError as e:
-                if e.errno == 110:
-                    self.device.reset()
-                break
-        if size <= len(self.rxbuffer):
-            result = self.rxbuffer[:size]
-            self.rxbuffer = self.rxbuffer[size:]
-        else:
-            result = self.rxbuffer
-            self.rxbuffer = array.array("B")
+            if e.errno == 110:
+                self.device.reset()
+            return None
+        if self.capture:
+            self.capture.record_in(
+                self.ep_in.bEndpointAddress, max_size, data, submitted_at
+            )
+        return data
+
+    # Same as `read` but returns a memoryview pointing into the receive
+    # buffer instead of a copy. The view is valid until the next read.
+    def read_view(self, size=1, timeout=-1):
+        timeout = timeout if timeout > 0 else UsbTransport.BROM_TIMEOUT
 
-        result = bytes(result)
-        logging.brom_io(f"<- {as_hex(result)}")
+        if len(self.rxbuffer) < size:
+            self.rxbuffer.fill(
+                size,
+                lambda max_size: self.bulk_read(max_size, timeout),
+                self.ep_in.wMaxPacketSize,
+            )
+        result = self.rxbuffer.take_view(size)
+        if self.metrics:
+            self.metrics.record_read(size, len(result))
+        if logging.root.isEnabledFor(logging.BROM_IO):
+            logging.brom_io(f"<- {as_hex(bytes(result))}")
         return result
 
-    def write(self, data, size=1, timeout=-1):
+    def read(self, size=1, timeout=-1):
+        return bytes(self.read_view(size, timeout))
+
+    def write(self, data, size=1, timeout=-1, progress=True):
         timeout = timeout if timeout > 0 else UsbTransport.BROM_TIMEOUT
 
-        if type(data) != bytes:
+        if isinstance(data, int):
             data = to_bytes(data, size)
+        data = memoryview(data).cast("B")  # slice any buffer without copying it
 
         data_sz = len(data)
         # pkt_sz = self.ep_out.wMaxPacketSize
@@ -199,9 +250,377 @@ class UsbTransport(AbstractTransport):
         while off_start < data_sz:
             remaining = data_sz - off_start
             off_end = off_start + (pkt_sz if remaining > pkt_sz else remaining)
-            chunk = data[off_start:off_end]
-            logging.brom_io(f"-> {as_hex(chunk)}")
-            self.ep_out.write(data[off_start:off_end], timeout)
-            report_write_progress(off_start, off_end, data_sz)
+            chunk = bytes(data[off_start:off_end])
+            if logging.root.isEnabledFor(logging.BROM_IO):
+                logging.brom_io(f"-> {as_hex(chunk)}")
+            if self.capture:
+                submitted_at = time.time()
+                self.ep_out.write(chunk, timeout)
+                self.capture.record_out(
+                    self.ep_out.bEndpointAddress, chunk, submitted_at
+                )
+            else:
+                self.ep_out.write(chunk, timeout)
+            if progress:
+                report_write_progress(off_start, off_end, data_sz)
 
             off_start += pkt_sz
+        if self.metrics:
+            self.metrics.record_write(data_sz)
+
+
+# Expose a synchronous transport through the asynchronous interface used
+# by AsyncBromProtocol. None of the methods ever suspend.
+class AsyncTransportAdapter:
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def read(self, size=1, timeout=-1):
+        return self.transport.read(size, timeout)
+
+    async def read_view(self, size=1, timeout=-1):
+        return self.transport.read_view(size, timeout)
+
+    async def write(self, data, size=1, timeout=-1, progress=True):
+        self.transport.write(data, size, timeout, progress)
+
+    async def echo(self, words, size=1):
+        self.transport.echo(words, size)
+
+    def check(self, test, gold):
+        self.transport.check(test, gold)
+
+
+# USB transport built on the asynchronous transfer API of libusb (through
+# the python-libusb1 package). Several bulk IN transfers are kept in
+# flight all the time so incoming data is already buffered by the time
+# it's requested, and outgoing data is split into packets submitted
+# without waiting for each other. libusb file descriptors are polled by
+# the asyncio event loop, so the interpreter is never blocked and many
+# devices can be served by one loop.
+#
+# Every IN transfer is wMaxPacketSize bytes long by default: BROM does
+# not send zero-length packets, so a bigger transfer may wait for the
+# timeout when a reply happens to be a multiple of the packet size.
+class AsyncUsbTransport:
+    IN_TRANSFERS = 8
+    OUT_TRANSFERS = 8
+    OUT_PACKET_SIZE = 1024  # SP Flash Tool seems to ignore wMaxPacketSize
+
+    capture = None
+    metrics = None
+
+    # `path` and `reset_delay` have the same meaning as for UsbTransport
+    def __init__(
+        self, path=None, transfers=IN_TRANSFERS, transfer_size=0, reset_delay=1.0
+    ):
+        self.path = path
+        self.transfers = transfers
+        self.transfer_size = transfer_size
+        self.reset_delay = reset_delay
+        self.arrived_at = None
+        self.asyncio = None
+        self.usb1 = None
+        self.loop = None
+        self.context = None
+        self.handle = None
+        self.ep_in = None
+        self.ep_out = None
+        self.pollfds = []
+        self.in_flight = []
+        self.out_flight = set()
+        self.running = False
+        self.rxbuffer = RxBuffer()
+        self.rx_event = None
+        self.stopped = None
+
+    def set_capture(self, capture):
+        self.capture = capture
+
+    def check(self, test, gold):
+        check_reply(test, gold)
+
+    async def start(self):
+        # python-libusb1 is only required by this transport, and asyncio
+        # only by the transports that run on an event loop
+        import asyncio
+
+        import usb1
+
+        self.asyncio = asyncio
+        self.usb1 = usb1
+        self.loop = self.asyncio.get_running_loop()
+        self.rx_event = self.asyncio.Event()
+        self.stopped = self.asyncio.Event()
+
+        logging.info("Init libusb context")
+        self.context = usb1.USBContext()
+        self.context.open()
+
+        logging.info(
+            f"Waiting for device in BROM mode "
+            f"({as_hex(BROM_VID, 2)}:{as_hex(BROM_PID, 2)})"
+            + (f" at {self.path}" if self.path else "")
+        )
+        # Same polling as DeviceWatcher, without blocking the event loop
+        interval = DeviceWatcher.MIN_POLL_INTERVAL
+        while True:
+            started = self.loop.time()
+            self.handle = self.open_device()
+            if self.handle:
+                break
+            scan_time = self.loop.time() - started
+
+            interval = scan_time / DeviceWatcher.POLL_DUTY_CYCLE
+            interval = max(interval, DeviceWatcher.MIN_POLL_INTERVAL)
+            interval = min(interval, DeviceWatcher.MAX_POLL_INTERVAL)
+            await self.asyncio.sleep(interval)
+        self.arrived_at = time.monotonic()
+        if self.capture:
+            device = self.handle.getDevice()
+            self.capture.set_device(device.getBusNumber(), device.getDeviceAddress())
+
+        try:
+            self.handle.setAutoDetachKernelDriver(True)
+        except usb1.USBError:
+            raise RuntimeError("USB: Cannot detach kernel driver")
+
+        try:
+            self.handle.setConfiguration(1)
+            self.handle.claimInterface(0)
+            self.handle.claimInterface(1)
+        except usb1.USBError:
+            raise RuntimeError("USB: Cannot claim interface")
+
+        for setting in self.handle.getDevice().iterSettings():
+            if setting.getClass() != 0xA:  # CDC data interface
+                continue
+            for endpoint in setting:
+                if endpoint.getAddress() & usb1.ENDPOINT_IN:
+                    self.ep_in = endpoint.getAddress()
+                    if not self.transfer_size:
+                        self.transfer_size = endpoint.getMaxPacketSize()
+                else:
+                    self.ep_out = endpoint.getAddress()
+        if self.ep_in is None or self.ep_out is None:
+            raise RuntimeError("USB: Cannot configure endpoints")
+
+        try:
+            self.handle.controlWrite(
+                0x21,
+                0x20,
+                0,
+                0,
+                to_bytes(UsbTransport.BROM_BAUDRATE, 4, "<") + b"\x00\x00\x08",
+            )
+        except usb1.USBError:
+            raise RuntimeError("USB: Cannot set baudrate")
+
+        for fd, events in self.context.getPollFDList():
+            self.add_pollfd(fd, events)
+        self.context.setPollFDNotifiers(self.add_pollfd, self.remove_pollfd)
+
+        self.running = True
+        for _ in range(self.transfers):
+            transfer = self.handle.getTransfer()
+            transfer.setBulk(
+                self.ep_in, self.transfer_size, callback=self.on_in_transfer
+            )
+            transfer.submit()
+            self.in_flight.append(transfer)
+
+        logging.info(
+            "Async USB transport has successfully started! "
+            "Waiting for further commands..."
+        )
+
+    # Open the device in BROM mode connected to `path`, or the first one
+    # found if no path is set. Returns None if there's no such device yet.
+    def open_device(self):
+        for device in self.context.getDeviceIterator(skip_on_error=True):
+            if device.getVendorID() != BROM_VID or device.getProductID() != BROM_PID:
+                continue
+            path = libusb1_device_path(device)
+            if self.path and path != self.path:
+                continue
+            try:
+                handle = device.open()
+            except self.usb1.USBError:
+                logging.debug(f"USB: Could not open device at {path}")
+                continue
+            logging.info(f"Found device at {path}")
+            return handle
+        return None
+
+    async def stop(self):
+        self.running = False
+        for transfer in self.in_flight + list(self.out_flight):
+            try:
+                transfer.cancel()
+            except self.usb1.USBError:
+                pass  # already completed
+        # Cancelled transfers complete through the event loop like the
+        # others, the last callback wakes us up
+        self.check_stopped()
+        try:
+            await self.asyncio.wait_for(
+                self.stopped.wait(), UsbTransport.BROM_TIMEOUT / 1000
+            )
+        except self.asyncio.TimeoutError:
+            logging.debug("USB: Transfers are still pending after cancellation")
+        self.in_flight = []
+        self.rxbuffer.clear()
+
+        self.context.setPollFDNotifiers()
+        for fd in list(self.pollfds):
+            self.remove_pollfd(fd)
+
+        for i in range(0, 2):
+            try:
+                self.handle.releaseInterface(i)
+            except self.usb1.USBError:
+                logging.debug(f"USB: Could not release interface {i}")
+
+        try:
+            self.handle.resetDevice()
+        except self.usb1.USBError:
+            logging.debug("USB: Could not reset device")
+
+        self.handle.close()
+        self.handle = None
+        self.context.close()
+        self.context = None
+        if self.reset_delay:
+            await self.asyncio.sleep(self.reset_delay)
+
+        logging.info("Async USB transport has stopped!")
+
+    def add_pollfd(self, fd, events, *_):
+        if events & select.POLLIN:
+            self.loop.add_reader(fd, self.handle_events)
+        if events & select.POLLOUT:
+            self.loop.add_writer(fd, self.handle_events)
+        self.pollfds.append(fd)
+
+    def remove_pollfd(self, fd, *_):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        if fd in self.pollfds:
+            self.pollfds.remove(fd)
+
+    # Called once a transfer has completed, `stop` waits until none is left
+    def check_stopped(self):
+        if self.running or self.out_flight:
+            return
+        if not any(transfer.isSubmitted() for transfer in self.in_flight):
+            self.stopped.set()
+
+    # Called by the event loop when libusb has something to process.
+    # Transfer callbacks run from here, i.e. on the event loop thread.
+    def handle_events(self):
+        self.context.handleEventsTimeout(0)
+
+    def on_in_transfer(self, transfer):
+        status = transfer.getStatus()
+        if status == self.usb1.TRANSFER_COMPLETED:
+            data = transfer.getBuffer()[: transfer.getActualLength()]
+            if self.capture:
+                self.capture.record_in(
+                    self.ep_in, self.transfer_size, data, time.time()
+                )
+            self.rxbuffer.append(data)
+            self.rx_event.set()
+        elif status != self.usb1.TRANSFER_CANCELLED:
+            logging.debug(f"USB: IN transfer failed with status {status}")
+
+        if self.running and status != self.usb1.TRANSFER_NO_DEVICE:
+            transfer.submit()
+        else:
+            self.check_stopped()
+
+    # The returned view is only valid until the next `await`
+    async def read_view(self, size=1, timeout=-1):
+        timeout = timeout if timeout > 0 else UsbTransport.BROM_TIMEOUT
+        deadline = self.loop.time() + timeout / 1000
+
+        while len(self.rxbuffer) < size:
+            self.rx_event.clear()
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await self.asyncio.wait_for(self.rx_event.wait(), remaining)
+            except self.asyncio.TimeoutError:
+                break
+
+        result = self.rxbuffer.take_view(size)
+        if self.metrics:
+            self.metrics.record_read(size, len(result))
+        if logging.root.isEnabledFor(logging.BROM_IO):
+            logging.brom_io(f"<- {as_hex(bytes(result))}")
+        return result
+
+    async def read(self, size=1, timeout=-1):
+        return bytes(await self.read_view(size, timeout))
+
+    def submit_out(self, chunk, timeout):
+        future = self.loop.create_future()
+        submitted_at = time.time()
+
+        def on_out_transfer(transfer):
+            self.out_flight.discard(transfer)
+            self.check_stopped()
+            status = transfer.getStatus()
+            completed = status == self.usb1.TRANSFER_COMPLETED
+            if self.capture:
+                self.capture.record_out(
+                    self.ep_out, chunk, submitted_at, 0 if completed else -5  # EIO
+                )
+            if future.done():
+                return
+            if completed:
+                future.set_result(transfer.getActualLength())
+            else:
+                future.set_exception(
+                    RuntimeError(f"USB: OUT transfer failed with status {status}")
+                )
+
+        transfer = self.handle.getTransfer()
+        transfer.setBulk(self.ep_out, chunk, callback=on_out_transfer, timeout=timeout)
+        transfer.submit()
+        self.out_flight.add(transfer)  # keep it alive until it completes
+        return future
+
+    async def write(self, data, size=1, timeout=-1, progress=True):
+        timeout = timeout if timeout > 0 else UsbTransport.BROM_TIMEOUT
+
+        if isinstance(data, int):
+            data = to_bytes(data, size)
+        data = memoryview(data).cast("B")
+
+        data_sz = len(data)
+        pkt_sz = AsyncUsbTransport.OUT_PACKET_SIZE
+
+        # Up to OUT_TRANSFERS packets are in flight, libusb completes them
+        # in submission order.
+        pending = []
+        off_start = 0
+        off_done = 0
+        while off_start < data_sz or pending:
+            while off_start < data_sz and len(pending) < self.OUT_TRANSFERS:
+                off_end = min(off_start + pkt_sz, data_sz)
+                chunk = bytes(data[off_start:off_end])
+                if logging.root.isEnabledFor(logging.BROM_IO):
+                    logging.brom_io(f"-> {as_hex(chunk)}")
+                pending.append(self.submit_out(chunk, timeout))
+                off_start = off_end
+
+            off_done += await pending.pop(0)
+            if progress:
+                report_write_progress(0, off_done, data_sz)
+        if self.metrics:
+            self.metrics.record_write(data_sz)
+
+    async def echo(self, words, size=1):
+        await self.write(words, size)
+        self.check(from_bytes(await self.read(size), size), words)
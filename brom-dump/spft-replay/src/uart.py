@@ -0,0 +1,148 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import logging
+import os
+import select
+import termios
+import time
+
+from src.buffer import RxBuffer
+from src.common import as_hex, report_write_progress, to_bytes
+from src.transport import AbstractTransport
+
+
+# Transport over a serial port, e.g. a USB-UART adapter connected to UART1
+# of the device. The port is opened in non-blocking mode and every read or
+# write waits for it with select(), so timeouts are precise and nothing
+# blocks past them. Incoming data is received in READ_SIZE blocks into an
+# RxBuffer, so small reads of a reply don't cost a system call each.
+#
+# BROM talks at 115200 baud. A DA or a payload that supports a faster
+# rate can switch to it with `set_baudrate` once both sides agree.
+class UartTransport(AbstractTransport):
+    BROM_BAUDRATE = 115200
+    BROM_TIMEOUT = 3 * 1000  # ms
+    READ_SIZE = 4096
+    WRITE_SIZE = 4096
+
+    def __init__(self, port, baudrate=BROM_BAUDRATE):
+        self.port = port
+        self.baudrate = baudrate
+        self.fd = None
+        self.rxbuffer = RxBuffer()
+
+    def start(self):
+        if self.capture:
+            logging.warning("UART traffic can't be saved to a pcapng capture")
+        logging.info(f"Opening {self.port} at {self.baudrate} baud")
+        try:
+            self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError as e:
+            raise RuntimeError(f"UART: Cannot open {self.port}: {e.strerror}")
+        self.configure(self.baudrate, termios.TCSANOW)
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+        self.arrived_at = time.monotonic()
+        logging.info(
+            "UART transport has successfully started! Waiting for further commands..."
+        )
+
+    def stop(self):
+        self.rxbuffer.clear()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        logging.info("UART transport has stopped!")
+
+    # Raw 8N1 without flow control. `when` is a termios.TCSA* constant.
+    def configure(self, baudrate, when):
+        speed = getattr(termios, f"B{baudrate}", None)
+        if speed is None:
+            raise RuntimeError(f"UART: Unsupported baudrate {baudrate}")
+        attrs = termios.tcgetattr(self.fd)
+        attrs[0] = 0  # iflag
+        attrs[1] = 0  # oflag
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL  # cflag
+        attrs[3] = 0  # lflag
+        attrs[4] = attrs[5] = speed
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(self.fd, when, attrs)
+
+    # Switch to another baudrate after the data sent so far has left the port
+    def set_baudrate(self, baudrate):
+        logging.info(f"UART: Switching to {baudrate} baud")
+        self.configure(baudrate, termios.TCSADRAIN)
+        self.baudrate = baudrate
+
+    # Read whatever is available, up to `max_size` bytes, waiting until
+    # `deadline` for anything to arrive
+    def receive(self, max_size, deadline):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return b""
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return b""
+            try:
+                data = os.read(self.fd, max_size)
+            except BlockingIOError:
+                continue
+            if data:
+                return data
+
+    # Same as `read` but returns a memoryview pointing into the receive
+    # buffer instead of a copy. The view is valid until the next read.
+    def read_view(self, size=1, timeout=-1):
+        timeout = timeout if timeout > 0 else UartTransport.BROM_TIMEOUT
+        deadline = time.monotonic() + timeout / 1000
+
+        if len(self.rxbuffer) < size:
+            self.rxbuffer.fill(
+                size,
+                lambda max_size: self.receive(max_size, deadline),
+                UartTransport.READ_SIZE,
+            )
+        result = self.rxbuffer.take_view(size)
+        if self.metrics:
+            self.metrics.record_read(size, len(result))
+        if logging.root.isEnabledFor(logging.BROM_IO):
+            logging.brom_io(f"<- {as_hex(bytes(result))}")
+        return result
+
+    def read(self, size=1, timeout=-1):
+        return bytes(self.read_view(size, timeout))
+
+    # `timeout` is the longest time the port may accept no data at all, so
+    # big writes at a low baudrate don't time out as long as they progress
+    def write(self, data, size=1, timeout=-1, progress=True):
+        timeout = timeout if timeout > 0 else UartTransport.BROM_TIMEOUT
+
+        if isinstance(data, int):
+            data = to_bytes(data, size)
+        data = memoryview(data).cast("B")
+
+        data_sz = len(data)
+        off_start = 0
+        deadline = time.monotonic() + timeout / 1000
+        while off_start < data_sz:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f"UART: Write timed out after {off_start} bytes")
+            _, writable, _ = select.select([], [self.fd], [], remaining)
+            if not writable:
+                continue
+            chunk = data[off_start : off_start + UartTransport.WRITE_SIZE]
+            try:
+                written = os.write(self.fd, chunk)
+            except BlockingIOError:
+                continue
+            if logging.root.isEnabledFor(logging.BROM_IO):
+                logging.brom_io(f"-> {as_hex(bytes(chunk[:written]))}")
+            if progress:
+                report_write_progress(off_start, off_start + written, data_sz)
+            off_start += written
+            deadline = time.monotonic() + timeout / 1000
+        if self.metrics:
+            self.metrics.record_write(data_sz)
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2023 arzamas-16 <https://github.com/arzamas-16>
+
+import logging
+import os
+import struct
+import time
+import zlib
+
+from src.common import as_0x
+from src.receiver import DumpFile
+
+# Binary frames sent by standalone payloads over UART, see
+# `payloads/include/standalone-util.h`. Every frame is a header, data and
+# CRC32 of both, all little-endian:
+#     magic "MtkF", type u8, flags u8, seq u16, addr u32, size u32
+# REGION starts a region of `size` bytes at `addr`. DATA carries `size`
+# bytes of memory at `addr`. FILL stands for `size` bytes repeating the
+# 32-bit word it carries. DONE ends the dump.
+FRAME_MAGIC = b"MtkF"
+FRAME_HEADER = struct.Struct("<4sBBHII")
+FRAME_REGION = 0x01
+FRAME_DATA = 0x02
+FRAME_FILL = 0x03
+FRAME_DONE = 0x04
+MAX_BLOCK_SIZE = 64 * 1024  # larger sizes can only come from a corrupt header
+
+
+# Size of the data that follows the header of a frame, None if the header
+# makes no sense
+def frame_data_size(frame_type, size):
+    if frame_type == FRAME_DATA:
+        return size if size <= MAX_BLOCK_SIZE else None
+    if frame_type == FRAME_FILL:
+        return 4
+    if frame_type in (FRAME_REGION, FRAME_DONE):
+        return 0
+    return None
+
+
+def encode_frame(frame_type, seq, addr=0, size=0, data=b""):
+    frame = FRAME_HEADER.pack(FRAME_MAGIC, frame_type, 0, seq & 0xFFFF, addr, size)
+    frame += data
+    return frame + struct.pack("<I", zlib.crc32(frame))
+
+
+# Reference implementation of `payloads/src/standalone/uart-dump.c`:
+# frames of a dump of `regions`, a list of (addr, data)
+def encode_dump(regions, block_size=1024):
+    seq = 0
+    frames = []
+    for addr, data in regions:
+        frames.append(encode_frame(FRAME_REGION, seq, addr, len(data)))
+        seq += 1
+        for offset in range(0, len(data), block_size):
+            block = data[offset : offset + block_size]
+            if block == block[:4] * (len(block) // 4):
+                frame_type, block_data = FRAME_FILL, block[:4]
+            else:
+                frame_type, block_data = FRAME_DATA, block
+            frames.append(
+                encode_frame(frame_type, seq, addr + offset, len(block), block_data)
+            )
+            seq += 1
+    frames.append(encode_frame(FRAME_DONE, seq))
+    return b"".join(frames)
+
+
+# Streaming decoder of a framed dump. Feed it data as it arrives and the
+# regions are written to OUTPUT_DIR/dump-N.bin right away. Nothing is
+# retransmitted: frames that fail the CRC check are dropped, the decoder
+# resynchronizes on the next magic and the missing ranges are zero-filled
+# in the output and listed in `bad_ranges`. Text printed by the payload
+# between frames is ignored.
+class FrameDecoder:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.buffer = bytearray()
+        self.dumps = []
+        self.dump = None
+        self.region_end = 0
+        self.position = 0  # address of the next expected byte
+        self.next_seq = None
+        self.bad_frames = 0
+        self.lost_frames = 0
+        self.bad_ranges = []  # (addr, size)
+        self.done = False
+
+    def feed(self, data):
+        self.buffer += data
+        while not self.done:
+            start = self.buffer.find(FRAME_MAGIC)
+            if start < 0:
+                # keep what could be the beginning of the next magic
+                del self.buffer[: max(len(self.buffer) - len(FRAME_MAGIC) + 1, 0)]
+                return
+            del self.buffer[:start]
+            if len(self.buffer) < FRAME_HEADER.size:
+                return
+
+            _, frame_type, _, seq, addr, size = FRAME_HEADER.unpack_from(self.buffer)
+            data_size = frame_data_size(frame_type, size)
+            if data_size is None:
+                del self.buffer[:1]  # not a frame after all
+                continue
+            frame_size = FRAME_HEADER.size + data_size + 4
+            if len(self.buffer) < frame_size:
+                return
+
+            frame = bytes(self.buffer[:frame_size])
+            (crc,) = struct.unpack_from("<I", frame, frame_size - 4)
+            if zlib.crc32(frame[:-4]) != crc:
+                self.bad_frames += 1
+                logging.warning(f"UART dump: bad frame #{seq} at {as_0x(addr)}")
+                del self.buffer[:1]
+                continue
+            del self.buffer[:frame_size]
+
+            if self.next_seq is not None and seq != self.next_seq:
+                lost = (seq - self.next_seq) & 0xFFFF
+                self.lost_frames += lost
+                logging.warning(f"UART dump: {lost} frames lost before #{seq}")
+            self.next_seq = (seq + 1) & 0xFFFF
+            self.handle(frame_type, addr, size, frame[FRAME_HEADER.size : -4])
+
+    def handle(self, frame_type, addr, size, data):
+        if frame_type == FRAME_REGION:
+            self.close_region()
+            path = os.path.join(self.output_dir, f"dump-{len(self.dumps) + 1}.bin")
+            logging.info(f"Reading {size} bytes at {as_0x(addr)} into {path}")
+            self.dump = DumpFile(path, size)
+            self.dumps.append(self.dump)
+            self.position = addr
+            self.region_end = addr + size
+        elif frame_type == FRAME_DONE:
+            self.close_region()
+            self.done = True
+        elif not self.dump:
+            logging.warning(f"UART dump: data at {as_0x(addr)} outside of a region")
+        elif addr < self.position:
+            logging.debug(f"UART dump: duplicate block at {as_0x(addr)}")
+        else:
+            self.skip_to(addr)
+            if frame_type == FRAME_FILL:
+                data = data * (size // 4)
+            self.dump.write(data)
+            self.position += size
+
+    # Zero-fill the blocks that have been lost up to `addr`
+    def skip_to(self, addr):
+        addr = min(addr, self.region_end)
+        if addr <= self.position:
+            return
+        self.bad_ranges.append((self.position, addr - self.position))
+        logging.warning(
+            f"UART dump: {addr - self.position} bytes at {as_0x(self.position)} "
+            "are missing, filled with zeros"
+        )
+        self.dump.write(bytes(addr - self.position))
+        self.position = addr
+
+    def close_region(self):
+        if self.dump:
+            self.skip_to(self.region_end)
+            self.dump.close()
+            self.dump = None
+
+    # Finish the dump when no more data will arrive
+    def finish(self):
+        # A header with a corrupt size leaves the decoder waiting for data
+        # that will never come, the frames behind it are still buffered
+        while not self.done and self.buffer.startswith(FRAME_MAGIC):
+            self.bad_frames += 1
+            logging.warning("UART dump: incomplete frame at the end of the stream")
+            del self.buffer[:1]
+            self.feed(b"")
+        if not self.done:
+            logging.warning("UART dump: the stream has ended before DONE")
+        self.close_region()
+        if self.bad_frames or self.lost_frames:
+            logging.warning(
+                f"UART dump: {self.bad_frames} bad and {self.lost_frames} lost "
+                f"frames, {sum(size for _, size in self.bad_ranges)} bytes missing"
+            )
+        return self.dumps
+
+
+# Receive a framed dump from a UartTransport that has been started before
+# the payload. Gives up when nothing arrives for `idle_timeout` seconds.
+def receive_uart_dump(transport, output_dir, idle_timeout=10):
+    logging.info(f"Waiting for the framed dump on {transport.port}")
+    os.makedirs(output_dir, exist_ok=True)
+    decoder = FrameDecoder(output_dir)
+    # The transport may have buffered the beginning already
+    decoder.feed(transport.rxbuffer.take_view(len(transport.rxbuffer)))
+    while not decoder.done:
+        data = transport.receive(transport.READ_SIZE, time.monotonic() + idle_timeout)
+        if not data:
+            break
+        decoder.feed(data)
+    return decoder.finish()